@@ -141,6 +141,14 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'asclepias_broker.monitoring.tasks.rerun_event_errors',
         'schedule':  crontab(hour=21, minute=0)
     },
+    'index_dirty_groups': {
+        'task': 'asclepias_broker.search.tasks.index_dirty_groups',
+        'schedule': timedelta(minutes=1),
+    },
+    'archive_events': {
+        'task': 'asclepias_broker.events.tasks.archive_events',
+        'schedule': crontab(hour=2, minute=0),
+    },
 }
 
 SENTRY_DSN = None
@@ -310,6 +318,81 @@ APP_DEFAULT_SECURE_HEADERS['session_cookie_secure'] = True
 #: Determines if the search index will be updated after ingesting an event
 ASCLEPIAS_SEARCH_INDEXING_ENABLED = False
 
+#: Instead of updating the search index at the end of every event, record the
+#: groups touched by events and index them periodically with the
+#: ``index_dirty_groups`` task, which trades some freshness for much fewer
+#: index updates of frequently touched groups.
+ASCLEPIAS_SEARCH_INDEXING_DEBOUNCED = False
+
+#: Number of dirty groups indexed at once by the ``index_dirty_groups`` task
+ASCLEPIAS_SEARCH_DIRTY_GROUPS_BATCH_SIZE = 1000
+
+#: Default and maximum number of results per page of the ``/citations`` and
+#: ``/db-relationships`` endpoints, which is also the number of results
+#: fetched at once when streaming them
+ASCLEPIAS_SEARCH_PAGE_SIZE = 1000
+
+#: Number of links stored per event when ingesting a newline-delimited stream
+ASCLEPIAS_EVENT_STREAM_CHUNK_SIZE = 100
+
+#: Celery queue of each event processing lane. Events submitted by users,
+#: events generated by the harvesters and reruns of failed events are sent to
+#: the queue of their lane (``None`` uses the default queue), so that each
+#: lane can be consumed by workers with their own concurrency and prefetch
+#: settings, e.g.
+#: ``celery worker -Q events.rerun --concurrency 1 --prefetch-multiplier 1``.
+ASCLEPIAS_EVENT_QUEUES = {
+    'user': None,
+    'harvester': None,
+    'rerun': None,
+}
+
+#: Number of partitions of each lane queue (``0`` disables them). Events are
+#: routed by the Version groups of their source identifiers to the
+#: ``<queue>.<partition>`` queue (``events.<partition>`` for lanes on the
+#: default queue), and each partition queue is meant to be consumed by a
+#: single worker process, so that events of the same groups are processed in
+#: order instead of waiting for each other's locks.
+ASCLEPIAS_EVENT_PARTITIONS = 0
+
+#: Partition suffix of the queue of the events whose sources span several
+#: partitions, e.g. ``events.user.shared``. It is meant to be consumed by a
+#: single worker process too, so that these events are serialized among
+#: themselves, and only wait for the locks of the partition workers.
+ASCLEPIAS_EVENT_PARTITIONS_SHARED_QUEUE = 'shared'
+
+#: Maximum number of rerun events waiting to be processed at the same time
+ASCLEPIAS_EVENT_RERUN_MAX_IN_FLIGHT = 100
+
+#: Number of events fetched at once when rerunning events
+ASCLEPIAS_EVENT_RERUN_BATCH_SIZE = 500
+
+#: Age in days after which the payloads of processed events are compressed
+#: into the payload archive (``None`` disables the archival)
+ASCLEPIAS_EVENT_ARCHIVE_AFTER_DAYS = None
+
+#: Compression codec of archived event payloads, ``gzip`` or ``zstd`` (which
+#: requires the ``zstandard`` package)
+ASCLEPIAS_EVENT_ARCHIVE_CODEC = 'gzip'
+
+#: Seconds after which a rerun stops (keeping its checkpoint) when none of its
+#: in-flight events is processed
+ASCLEPIAS_EVENT_RERUN_STALL_TIMEOUT = 10 * 60
+
+#: Number of rows streamed or bulk-loaded at once by the offline graph builder
+ASCLEPIAS_GRAPH_BUILD_BATCH_SIZE = 10000
+
+#: Number of violations streamed or repaired at once by ``graph check``
+ASCLEPIAS_GRAPH_CHECK_BATCH_SIZE = 10000
+
+#: Number of times a grouping transaction is run when the advisory locks it
+#: needs are held by other workers (see :mod:`asclepias_broker.graph.locks`)
+ASCLEPIAS_GRAPH_LOCK_ATTEMPTS = 5
+
+#: Number of identifiers whose groups are cached by each worker (``0``
+#: disables the cache)
+ASCLEPIAS_GRAPH_GROUP_CACHE_SIZE = 100000
+
 # JSONSchemas
 # ===========
 JSONSCHEMAS_HOST = 'https://schemas.asclepias.github.io'
@@ -8,9 +8,14 @@
 """Core database models."""
 
 import enum
+import hashlib
 import uuid
+from typing import Dict, Iterable, Tuple
 
+import idutils
 from invenio_db import db
+from isbn import ISBNError
+from sqlalchemy import and_, or_, select, union_all
 from sqlalchemy.schema import Index, UniqueConstraint
 from sqlalchemy_utils.models import Timestamp
 from sqlalchemy_utils.types import UUIDType
@@ -26,6 +31,15 @@ class Relation(enum.Enum):
     IsRelatedTo = 5
 
 
+#: Schemes whose identifier values are case-sensitive
+CASE_SENSITIVE_SCHEMES = {'ads', 'ark', 'url'}
+
+
+def _default_value_hash(context):
+    params = context.get_current_parameters()
+    return Identifier.compute_hash(params['value'], params['scheme'])
+
+
 class Identifier(db.Model, Timestamp):
     """Identifier model."""
 
@@ -40,16 +54,68 @@ class Identifier(db.Model, Timestamp):
     id = db.Column(UUIDType, default=uuid.uuid4, primary_key=True)
     value = db.Column(db.String, index=True)
     scheme = db.Column(db.String, index=True)
+    #: Hash of the normalized scheme and value (see :meth:`compute_hash`),
+    #: by which identifiers are looked up. Identifiers created before it was
+    #: added are backfilled by ``graph dedup-identifiers``.
+    value_hash = db.Column(
+        db.String(64), unique=True, default=_default_value_hash)
 
     def __repr__(self):
         """String representation of the Identifier."""
         return f"<{self.scheme}: {self.value}>"
 
+    @staticmethod
+    def compute_hash(value: str, scheme: str) -> str:
+        """Compute the hash of the normalized scheme and value.
+
+        Values are normalized with ``idutils`` and lowercased, unless their
+        scheme is one of the :data:`CASE_SENSITIVE_SCHEMES`, so that e.g.
+        DOIs differing only in case have the same hash.
+        """
+        scheme = scheme.lower()
+        try:
+            value = idutils.normalize_pid(value, scheme)
+        except (AttributeError, ISBNError):
+            # Values that do not match their scheme are hashed as they are
+            pass
+        if scheme not in CASE_SENSITIVE_SCHEMES:
+            value = value.lower()
+        return hashlib.sha256(f'{scheme}:{value}'.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def get_many(
+        cls, keys: Iterable[Tuple[str, str]]
+    ) -> Dict[str, 'Identifier']:
+        """Get identifiers from their ``(value, scheme)`` pairs.
+
+        Identifiers are matched by their hash. Identifiers whose hash is not
+        backfilled yet only match their exact value, and identifiers with a
+        hash are preferred over them.
+
+        :returns: The identifiers by hash.
+        """
+        keys = set(keys)
+        hashes = {cls.compute_hash(value, scheme) for value, scheme in keys}
+        if not hashes:
+            return {}
+        query = cls.query.filter(or_(
+            cls.value_hash.in_(hashes),
+            and_(cls.value_hash.is_(None),
+                 cls.value.in_({value for value, _ in keys}))))
+        identifiers = {}
+        for identifier in query:
+            value_hash = identifier.value_hash or \
+                cls.compute_hash(identifier.value, identifier.scheme)
+            if value_hash in hashes and (
+                    value_hash not in identifiers or identifier.value_hash):
+                identifiers[value_hash] = identifier
+        return identifiers
+
     @classmethod
     def get(cls, value=None, scheme=None, **kwargs):
-        """Get the identifier from the database."""
-        return cls.query.filter_by(
-            value=value, scheme=scheme).one_or_none()
+        """Get the identifier from the database, by its hash."""
+        return cls.get_many([(value, scheme)]).get(
+            cls.compute_hash(value, scheme))
 
     def fetch_or_create_id(self):
         """Fetches from the database or creates an id for the identifier."""
@@ -72,20 +138,36 @@ class Identifier(db.Model, Timestamp):
         if as_relation:
             return q.all()
         else:
-            siblings = set(sum([[item.source, item.target] for item in q], []))
+            siblings = {i for item in q for i in (item.source, item.target)}
             if siblings:
                 return list(siblings)
             else:
                 return [self, ]
 
     def get_identities(self):
-        """Get the fully-expanded list of 'Identical' Identifiers."""
-        ids = next_ids = set([self])
-        while next_ids:
-            grp = set(sum([item._get_identities() for item in next_ids], []))
-            next_ids = grp - ids
-            ids |= grp
-        return list(ids)
+        """Get the fully-expanded list of 'Identical' Identifiers.
+
+        The closure of the ``IsIdenticalTo`` relationships (in both
+        directions) is computed with a single recursive query, where
+        ``UNION`` stops at the already visited identifiers.
+        """
+        is_identical = Relationship.relation == Relation.IsIdenticalTo
+        edges = union_all(
+            select([Relationship.source_id.label('id'),
+                    Relationship.target_id.label('identical_id')])
+            .where(is_identical),
+            select([Relationship.target_id, Relationship.source_id])
+            .where(is_identical),
+        ).alias('identical_edges')
+        ids = (
+            select([Identifier.id.label('id')])
+            .where(Identifier.id == self.id)
+            .cte('identities', recursive=True))
+        ids = ids.union(
+            select([edges.c.identical_id])
+            .select_from(edges.join(ids, edges.c.id == ids.c.id)))
+        identities = Identifier.query.join(ids, Identifier.id == ids.c.id)
+        return identities.all() or [self]
 
     def get_parents(self, rel_type, as_relation=False):
         """Get all parents of given Identifier for given relation."""
@@ -125,8 +207,7 @@ class Relationship(db.Model, Timestamp):
     __table_args__ = (
         UniqueConstraint('source_id', 'target_id', 'relation',
                          name='uq_relationship_source_target_relation'),
-        Index('ix_relationship_source', 'source_id'),
-        Index('ix_relationship_target', 'target_id'),
+        Index('ix_relationship_target_relation', 'target_id', 'relation'),
         Index('ix_relationship_relation', 'relation'),
     )
 
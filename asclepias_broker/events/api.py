@@ -6,28 +6,51 @@
 # under the terms of the MIT License; see LICENSE file for more details.
 """Events API."""
 
+import hashlib
+import json
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Iterable, Iterator, List, Optional, Union
+
 import jsonschema
 from flask import current_app
 from invenio_db import db
 from marshmallow.exceptions import \
     ValidationError as MarshmallowValidationError
+from sqlalchemy import and_, null, or_
 from werkzeug.local import LocalProxy
 
+from ..core.models import Identifier
+from ..graph.models import GroupM2M, Identifier2Group
 from ..graph.tasks import process_event
 from ..jsonschemas import EVENT_SCHEMA, SCHOLIX_SCHEMA
 from ..schemas.loaders import RelationshipSchema
-from .models import Event, EventStatus
+from .errors import EventStreamValidationError
+from .models import Event, EventOrigin, EventPayloadArchive, EventStatus
 
+_SCHEMAS = {
+    'event.json': EVENT_SCHEMA,
+    'scholix-v3.json': SCHOLIX_SCHEMA,
+}
 
-def _jsonschema_validator_func():
-    schema_host = current_app.config['JSONSCHEMAS_HOST']
+
+@lru_cache(maxsize=None)
+def _build_jsonschema_validator(schema_name: str, schema_host: str):
+    schema = _SCHEMAS[schema_name]
     schema_store = {
-        f'{schema_host}/scholix-v3.json': SCHOLIX_SCHEMA,
-        f'{schema_host}/event.json': EVENT_SCHEMA,
-    }
-    resolver = jsonschema.RefResolver(
-        schema_host, EVENT_SCHEMA, schema_store)
-    return jsonschema.Draft4Validator(EVENT_SCHEMA, resolver=resolver)
+        f'{schema_host}/{name}': s for name, s in _SCHEMAS.items()}
+    resolver = jsonschema.RefResolver(schema_host, schema, schema_store)
+    return jsonschema.Draft4Validator(schema, resolver=resolver)
+
+
+def _jsonschema_validator_func():
+    return _build_jsonschema_validator(
+        'event.json', current_app.config['JSONSCHEMAS_HOST'])
+
+
+def _scholix_validator_func():
+    return _build_jsonschema_validator(
+        'scholix-v3.json', current_app.config['JSONSCHEMAS_HOST'])
 
 
 class EventAPI:
@@ -36,49 +59,230 @@ class EventAPI:
     _jsonschema_validator = LocalProxy(_jsonschema_validator_func)
     """Event JSONSchema validator."""
 
+    _scholix_validator = LocalProxy(_scholix_validator_func)
+    """Scholix link JSONSchema validator."""
+
+    @staticmethod
+    def parse_link(payload: dict) -> list:
+        """Parse a Scholix link payload without accessing the database.
+
+        :returns: The normalized ``[source_value, source_scheme, relation,
+            target_value, target_scheme]`` of the link, which the worker
+            reuses instead of loading the payload again.
+        """
+        # NOTE: raises `marshmallow.exceptions.ValidationError`
+        rel = RelationshipSchema().load(payload)
+        return [rel.source.value, rel.source.scheme, rel.relation.name,
+                rel.target.value, rel.target.scheme]
+
     @classmethod
-    def validate_payload(cls, event):
-        """Validate the event payload."""
+    def validate_payload(cls, event) -> List[list]:
+        """Validate the event payload.
+
+        :returns: The parsed links of the event payloads.
+        """
         # TODO: Use invenio-jsonschemas/jsonresolver instead of this
         # Validate against Event JSONSchema
         # NOTE: raises `jsonschemas.ValidationError`
         cls._jsonschema_validator.validate(event)
 
         # Validate using marshmallow loader
+        parsed = []
         for payload in event:
-            errors = RelationshipSchema(check_existing=True).validate(payload)
-            if errors:
-                raise MarshmallowValidationError(str(errors) + "payload" +  str(payload))
+            try:
+                parsed.append(cls.parse_link(payload))
+            except MarshmallowValidationError as exc:
+                raise MarshmallowValidationError(
+                    str(exc.messages) + "payload" + str(payload))
+        return parsed
+
+    @classmethod
+    def validate_link(cls, payload: dict) -> list:
+        """Validate a single Scholix link payload.
+
+        :returns: The parsed link.
+        """
+        # NOTE: raises `jsonschemas.ValidationError`
+        cls._scholix_validator.validate(payload)
+        return cls.parse_link(payload)
 
     @classmethod
     def handle_event(cls, event: dict, no_index: bool = False,
-                     user_id: int = None, eager: bool = False) -> Event:
+                     user_id: int = None, eager: bool = False,
+                     origin: str = EventOrigin.User) -> Event:
         """Handle an event payload."""
-        cls.validate_payload(event)
-        event_obj = Event(payload=event, status=EventStatus.New,
-                          user_id=user_id)
+        parsed = cls.validate_payload(event)
+        return cls._create_event(
+            event, parsed=parsed, no_index=no_index, user_id=user_id,
+            eager=eager, origin=origin)
+
+    @classmethod
+    def handle_event_stream(
+        cls, lines: Iterable[Union[str, bytes]], chunk_size: int = None,
+        no_index: bool = False, user_id: int = None, eager: bool = False,
+        origin: str = EventOrigin.User
+    ) -> Iterator[Event]:
+        """Handle a stream of newline-delimited Scholix links.
+
+        Every line is validated as soon as it is read. The valid links are
+        cut into events of ``chunk_size`` payloads, which are stored and sent
+        for processing as they fill up, so only one chunk is kept in memory.
+
+        :raises EventStreamValidationError: on the first invalid line. Events
+            yielded before the error are already stored.
+        """
+        chunk_size = chunk_size or \
+            current_app.config['ASCLEPIAS_EVENT_STREAM_CHUNK_SIZE']
+        chunk, parsed = [], []
+        for line_number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                payload = json.loads(line)
+                link = cls.validate_link(payload)
+            except jsonschema.ValidationError as exc:
+                raise EventStreamValidationError(line_number, exc.message)
+            except MarshmallowValidationError as exc:
+                raise EventStreamValidationError(
+                    line_number, str(exc.messages))
+            except ValueError as exc:
+                raise EventStreamValidationError(line_number, str(exc))
+            chunk.append(payload)
+            parsed.append(link)
+            if len(chunk) >= chunk_size:
+                yield cls._create_event(
+                    chunk, parsed=parsed, no_index=no_index,
+                    user_id=user_id, eager=eager, origin=origin)
+                chunk, parsed = [], []
+        if chunk:
+            yield cls._create_event(
+                chunk, parsed=parsed, no_index=no_index, user_id=user_id,
+                eager=eager, origin=origin)
+
+    @classmethod
+    def _create_event(cls, event: List[dict], parsed: List[list] = None,
+                      no_index: bool = False, user_id: int = None,
+                      eager: bool = False,
+                      origin: str = EventOrigin.User) -> Event:
+        """Store an already validated event payload and process it."""
+        event_obj = Event(payload=event, parsed=parsed,
+                          status=EventStatus.New, user_id=user_id,
+                          origin=origin)
         db.session.add(event_obj)
         db.session.commit()
-        event_uuid = str(event_obj.id)
-        idx_enabled = current_app.config['ASCLEPIAS_SEARCH_INDEXING_ENABLED'] \
-            and (not no_index)
-        task = process_event.s(
-            event_uuid=event_uuid, indexing_enabled=idx_enabled)
-        if eager:
-            task.apply(throw=True)
-        else:
-            task.apply_async()
+        cls._dispatch(event_obj, origin, no_index=no_index, eager=eager)
         return event_obj
-    
+
     @classmethod
-    def rerun_event(cls, event: Event, no_index: bool, eager:bool = False):
-        event_uuid = str(event.id)
+    def _dispatch(cls, event: Event, lane: str, no_index: bool = False,
+                  eager: bool = False):
+        """Send the event for processing on the queue of its lane."""
         idx_enabled = current_app.config['ASCLEPIAS_SEARCH_INDEXING_ENABLED'] \
             and (not no_index)
         task = process_event.s(
-            event_uuid=event_uuid, indexing_enabled=idx_enabled)
+            event_uuid=str(event.id), indexing_enabled=idx_enabled)
         if eager:
             task.apply(throw=True)
         else:
-            task.apply_async()
+            queue = current_app.config['ASCLEPIAS_EVENT_QUEUES'].get(lane)
+            partitions = current_app.config['ASCLEPIAS_EVENT_PARTITIONS']
+            if partitions:
+                partition = cls.get_partition(event, partitions)
+                if partition is None:
+                    partition = current_app.config[
+                        'ASCLEPIAS_EVENT_PARTITIONS_SHARED_QUEUE']
+                queue = f'{queue or "events"}.{partition}'
+            task.apply_async(queue=queue)
+
+    @classmethod
+    def get_partition(cls, event: Event, partitions: int) -> Optional[int]:
+        """Get the partition of an event's source identifiers.
+
+        Source identifiers are keyed by their current Version group if they
+        are known, and by their value otherwise, so that the events of all
+        the versions of a work (which are locked together while grouping)
+        share a partition. Events whose sources span several partitions have
+        no partition, and go to the shared queue of the lane instead, see
+        ``ASCLEPIAS_EVENT_PARTITIONS_SHARED_QUEUE``. Events with the same
+        targets (e.g. ``A Cites C`` and ``B Cites C``) can still run in
+        parallel on different partitions, where the grouping locks keep them
+        consistent.
+
+        :returns: The partition, or ``None`` if the event spans several.
+        """
+        parsed = event.parsed or \
+            [cls.parse_link(p) for p in event.get_payload()]
+        id_keys = {tuple(link[0:2]) for link in parsed}
+        if not id_keys:
+            return 0
+        # Identifiers are keyed by hash, so that values differing only in
+        # case go to the same partition
+        groups = dict.fromkeys(
+            Identifier.compute_hash(value, scheme)
+            for value, scheme in id_keys)
+        rows = (
+            db.session.query(
+                Identifier.value, Identifier.scheme, Identifier.value_hash,
+                GroupM2M.group_id)
+            .join(Identifier2Group,
+                  Identifier2Group.identifier_id == Identifier.id)
+            .join(GroupM2M,
+                  GroupM2M.subgroup_id == Identifier2Group.group_id)
+            .filter(or_(
+                Identifier.value_hash.in_(groups),
+                and_(Identifier.value_hash.is_(None),
+                     Identifier.value.in_({v for v, _ in id_keys})))))
+        for value, scheme, value_hash, group_id in rows:
+            value_hash = value_hash or Identifier.compute_hash(value, scheme)
+            if value_hash in groups:
+                groups[value_hash] = group_id
+        partition_keys = [
+            str(group_id) if group_id else value_hash
+            for value_hash, group_id in groups.items()]
+        event_partitions = {
+            int.from_bytes(
+                hashlib.blake2b(k.encode(), digest_size=8).digest(), 'big')
+            % partitions
+            for k in partition_keys}
+        if len(event_partitions) == 1:
+            return event_partitions.pop()
+
+    @classmethod
+    def rerun_event(cls, event: Event, no_index: bool, eager:bool = False):
+        cls._dispatch(
+            event, EventOrigin.Rerun, no_index=no_index, eager=eager)
         return event
+
+    @classmethod
+    def archive_events(cls, days: int, codec: str = None,
+                       batch_size: int = 1000) -> int:
+        """Archive the payloads of events processed more than days ago.
+
+        The payloads are compressed into ``EventPayloadArchive`` rows and
+        removed from the events, from where they are rehydrated on demand by
+        ``Event.get_payload``.
+
+        :returns: The number of archived events.
+        """
+        codec = codec or current_app.config['ASCLEPIAS_EVENT_ARCHIVE_CODEC']
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        query = (
+            Event.query.outerjoin(EventPayloadArchive)
+            .filter(
+                Event.status == EventStatus.Done,
+                Event.updated < cutoff,
+                EventPayloadArchive.event_id.is_(None))
+            .order_by(Event.created, Event.id)
+        )
+        archived = 0
+        while True:
+            events = query.limit(batch_size).all()
+            if not events:
+                return archived
+            for event in events:
+                EventPayloadArchive.create(event, codec=codec)
+                # Parsed links are only needed while processing
+                event.payload = null()
+                event.parsed = null()
+            db.session.commit()
+            archived += len(events)
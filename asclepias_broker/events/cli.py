@@ -11,15 +11,20 @@ from __future__ import absolute_import, print_function
 import datetime
 
 import json
+import multiprocessing
+import time
+from typing import Iterable, Tuple
 
 import click
 from flask.cli import with_appcontext
 from flask import current_app
+from invenio_db import db
 
 from ..utils import find_ext
 from .api import EventAPI
 from ..graph.tasks import process_event
-from .models import Event, EventStatus
+from .models import Event, EventPayloadArchive, EventStatus
+from .rerun import EventRerun
 
 
 @click.group()
@@ -27,24 +32,108 @@ def events():
     """Event CLI commands."""
 
 
+def _init_load_worker():
+    """Initialize a worker process with its own application and DB session."""
+    from invenio_app.factory import create_api
+    app = create_api()
+    app.app_context().push()
+
+
+def _load_file(args: Tuple[str, bool, bool]) -> Tuple[str, int, float, str]:
+    """Load the event of a single file.
+
+    :returns: The filename, number of payloads, duration and error (if any).
+    """
+    fn, no_index, eager = args
+    start = time.time()
+    try:
+        with open(fn, 'r') as fp:
+            data = json.load(fp)
+        EventAPI.handle_event(data, no_index=no_index, eager=eager)
+        return fn, len(data), time.time() - start, None
+    except Exception as exc:
+        db.session.rollback()
+        return fn, 0, time.time() - start, repr(exc)
+
+
+def _report_load_progress(results: Iterable[Tuple[str, int, float, str]],
+                          total: int, slowest: int = 10):
+    """Print live throughput of the loaded files and a final summary."""
+    start = time.time()
+    loaded, failed = [], []
+    n_payloads = 0
+    last_report = 0
+    for fn, payloads, duration, error in results:
+        if error:
+            failed.append((fn, error))
+        else:
+            loaded.append((duration, fn))
+            n_payloads += payloads
+        elapsed = max(time.time() - start, 1e-6)
+        done = len(loaded) + len(failed)
+        if elapsed - last_report >= 1 or done == total:
+            last_report = elapsed
+            click.echo(
+                f'\r[{done}/{total}] '
+                f'{len(loaded) / elapsed:.1f} events/s, '
+                f'{n_payloads / elapsed:.1f} payloads/s, '
+                f'{len(failed)} failed', nl=False)
+    click.echo()
+
+    elapsed = time.time() - start
+    click.secho(
+        f'Loaded {len(loaded)} events ({n_payloads} payloads) '
+        f'in {elapsed:.1f}s.', fg='green')
+    if failed:
+        click.secho(f'Failed to load {len(failed)} files:', fg='red')
+        for fn, error in failed:
+            click.echo(f'  {fn}: {error}')
+    if loaded:
+        click.echo('Slowest files:')
+        for duration, fn in sorted(loaded, reverse=True)[:slowest]:
+            click.echo(f'  {duration:.2f}s {fn}')
+
+
 @events.command('load')
 @click.argument(
     'jsondir_or_file',
     type=click.Path(exists=True, dir_okay=True, resolve_path=True))
 @click.option('--no-index', default=False, is_flag=True)
 @click.option('-e', '--eager', default=False, is_flag=True)
+@click.option('-j', '--jobs', default=1, type=click.IntRange(min=1),
+              help='Number of worker processes loading files in parallel.')
 @with_appcontext
-def load(jsondir_or_file: str, no_index: bool = False, eager: bool = False):
+def load(jsondir_or_file: str, no_index: bool = False, eager: bool = False,
+         jobs: int = 1):
     """Load events from a directory."""
     files = find_ext(jsondir_or_file, '.json')
-    with click.progressbar(files) as bar_files:
-        for fn in bar_files:
-            with open(fn, 'r') as fp:
-                data = json.load(fp)
-            try:
-                EventAPI.handle_event(data, no_index=no_index, eager=eager)
-            except ValueError:
-                pass
+    tasks = [(fn, no_index, eager) for fn in files]
+    if jobs > 1:
+        # Workers open their own connections
+        db.engine.dispose()
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(jobs, initializer=_init_load_worker) as pool:
+            _report_load_progress(
+                pool.imap_unordered(_load_file, tasks), len(files))
+    else:
+        _report_load_progress(map(_load_file, tasks), len(files))
+
+
+@events.command('archive')
+@click.option('-d', '--days', type=click.IntRange(min=0), default=None,
+              help='Archive events processed more than this many days ago.')
+@click.option('--codec', type=click.Choice(EventPayloadArchive.CODECS),
+              default=None)
+@with_appcontext
+def archive(days: int = None, codec: str = None):
+    """Archive the payloads of processed events."""
+    if days is None:
+        days = current_app.config['ASCLEPIAS_EVENT_ARCHIVE_AFTER_DAYS']
+    if days is None:
+        raise click.UsageError(
+            'Pass --days or set ASCLEPIAS_EVENT_ARCHIVE_AFTER_DAYS.')
+    archived = EventAPI.archive_events(days, codec=codec)
+    click.secho(f'Archived {archived} event payloads.', fg='green')
 
 @events.command('rerun')
 @click.option('-i','--id', default=None)
@@ -53,39 +142,63 @@ def load(jsondir_or_file: str, no_index: bool = False, eager: bool = False):
 @click.option('-p', '--processing', default=False, is_flag=True)
 @click.option('--no-index', default=False, is_flag=True)
 @click.option('--eager', default=False, is_flag=True)
+@click.option('--max-in-flight', default=None, type=click.IntRange(min=1),
+              help='Maximum number of events waiting to be processed.')
+@click.option('--restart', default=False, is_flag=True,
+              help='Ignore the checkpoint of an interrupted rerun.')
 @with_appcontext
-def rerun(id: str = None, all: bool = False, errors: bool = True, processing: bool = False, no_index: bool = False, eager: bool = False):
-    """Rerun failed or stuck events."""
+def rerun(id: str = None, all: bool = False, errors: bool = True, processing: bool = False, no_index: bool = False, eager: bool = False,
+          max_in_flight: int = None, restart: bool = False):
+    """Rerun failed or stuck events.
+
+    Reruns are checkpointed, so an interrupted rerun resumes from the last
+    dispatched event, unless ``--restart`` is passed.
+    """
     if id:
         rerun_id(id, no_index, eager)
         return
     if all:
         errors = True
         processing = True
+    options = dict(no_index=no_index, eager=eager,
+                   max_in_flight=max_in_flight, restart=restart)
     if processing:
-        rerun_processing(no_index, eager)
-        rerun_new(no_index, eager)
+        rerun_processing(**options)
+        rerun_new(**options)
     if errors:
-        rerun_errors(no_index, eager)
+        rerun_errors(**options)
 
 def rerun_id(id:str, no_index: bool, eager:bool = False):
         event = Event.get(id)
         if event:
             EventAPI.rerun_event(event, no_index=no_index, eager=eager)
 
-def rerun_processing(no_index: bool, eager:bool = False):
+def _run_rerun(name: str, query, restart: bool = False, **kwargs):
+    """Run a checkpointed rerun, reporting its progress."""
+    rerun = EventRerun(name, query, **kwargs)
+    if restart:
+        rerun.reset()
+    elif rerun.checkpoint:
+        click.echo(f'Resuming {name} rerun after event {rerun.checkpoint[1]}')
+
+    def _report(progress):
+        click.echo(f'\r{name}: {progress}', nl=False)
+
+    progress = rerun.run(on_progress=_report)
+    click.echo(f'\r{name}: {progress}')
+
+def rerun_processing(no_index: bool, eager:bool = False, **kwargs):
         yesterday = datetime.datetime.now() - datetime.timedelta(days = 1)
-        resp = Event.query.filter(Event.status == EventStatus.Processing, Event.created < str(yesterday)).all()
-        for event in resp:
-            EventAPI.rerun_event(event, no_index=no_index, eager=eager)
+        query = Event.query.filter(Event.status == EventStatus.Processing, Event.created < str(yesterday))
+        _run_rerun('processing', query, no_index=no_index, eager=eager,
+                   **kwargs)
 
-def rerun_new(no_index: bool, eager:bool = False):
+def rerun_new(no_index: bool, eager:bool = False, **kwargs):
         yesterday = datetime.datetime.now() - datetime.timedelta(days = 1)
-        resp = Event.query.filter(Event.status == EventStatus.New, Event.created < str(yesterday)).all()
-        for event in resp:
-            EventAPI.rerun_event(event, no_index=no_index, eager=eager)
+        query = Event.query.filter(Event.status == EventStatus.New, Event.created < str(yesterday))
+        _run_rerun('new', query, no_index=no_index, eager=eager, **kwargs)
 
-def rerun_errors(no_index: bool, eager:bool = False):
-        resp = Event.query.filter(Event.status == EventStatus.Error).all()
-        for event in resp:
-            EventAPI.rerun_event(event, no_index=no_index, eager=eager)
\ No newline at end of file
+def rerun_errors(no_index: bool, eager:bool = False, **kwargs):
+        query = Event.query.filter(Event.status == EventStatus.Error)
+        _run_rerun('errors', query, no_index=no_index, eager=eager,
+                   **kwargs)
\ No newline at end of file
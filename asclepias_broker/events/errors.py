@@ -20,3 +20,14 @@ class PayloadValidationRESTError(RESTException):
             self.code = code
         super(PayloadValidationRESTError, self).__init__(**kwargs)
         self.description = error_message
+
+
+class EventStreamValidationError(Exception):
+    """Invalid link in a newline-delimited event stream."""
+
+    def __init__(self, line: int, message: str):
+        """Initialize the exception with the offending line number."""
+        self.line = line
+        self.message = message
+        super(EventStreamValidationError, self).__init__(
+            f'Line {line}: {message}')
@@ -8,8 +8,11 @@
 """Event database models."""
 
 import enum
+import gzip
+import hashlib
+import json
 import uuid
-from typing import Union
+from typing import Iterable, List, Set, Union
 import datetime
 
 from invenio_accounts.models import User
@@ -21,6 +24,11 @@ from sqlalchemy import func
 
 from ..core.models import Identifier, Relationship
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 class EventStatus(enum.Enum):
     """Event status."""
@@ -38,6 +46,14 @@ class PayloadType(enum.Enum):
     Identifier = 2
 
 
+class EventOrigin:
+    """Event origins, which are also the processing lanes of the events."""
+
+    User = 'user'
+    Harvester = 'harvester'
+    Rerun = 'rerun'
+
+
 class Event(db.Model, Timestamp):
     """Event model."""
 
@@ -45,9 +61,15 @@ class Event(db.Model, Timestamp):
 
     id = db.Column(UUIDType, default=uuid.uuid4, primary_key=True)
     payload = db.Column(JSONType)
+    parsed = db.Column(JSONType, nullable=True)
+    """Links parsed from the payload on ingestion, reused when processing."""
 
     status = db.Column(db.Enum(EventStatus), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey(User.id), nullable=True)
+    origin = db.Column(db.String(32), nullable=True)
+    skipped_payloads = db.Column(db.Integer, nullable=True)
+    #: Seconds spent waiting for the grouping locks while processing
+    lock_wait = db.Column(db.Float, nullable=True)
 
     user = db.relationship(User)
 
@@ -55,6 +77,14 @@ class Event(db.Model, Timestamp):
     def get(cls, id: str = None, **kwargs):
         """Get the event from the database."""
         return cls.query.filter_by(id=id).one_or_none()
+
+    def get_payload(self) -> List[dict]:
+        """Get the payload, rehydrating it from the archive if needed."""
+        if self.payload is None and self.archive:
+            if getattr(self, '_archived_payload', None) is None:
+                self._archived_payload = self.archive.load()
+            return self._archived_payload
+        return self.payload
     
     @classmethod
     def getStatsFromLastWeek(cls):
@@ -62,7 +92,37 @@ class Event(db.Model, Timestamp):
         last_week = datetime.datetime.now() - datetime.timedelta(days = 7)
         resp = db.session.query(cls.status, func.count('*')).filter(cls.updated > str(last_week)).group_by(cls.status).all()
         return resp
-    
+
+    @classmethod
+    def getSkippedFromLastWeek(cls):
+        """Gets the number of duplicate payloads skipped in the last 7 days"""
+        last_week = datetime.datetime.now() - datetime.timedelta(days = 7)
+        return db.session.query(
+            func.coalesce(func.sum(cls.skipped_payloads), 0)
+        ).filter(cls.updated > str(last_week)).scalar()
+
+    @classmethod
+    def getLockWaitFromLastWeek(cls):
+        """Gets the seconds spent waiting for grouping locks in 7 days"""
+        last_week = datetime.datetime.now() - datetime.timedelta(days = 7)
+        return db.session.query(
+            func.coalesce(func.sum(cls.lock_wait), 0)
+        ).filter(cls.updated > str(last_week)).scalar()
+
+    @classmethod
+    def getBacklog(cls):
+        """Gets the number of events waiting to be processed per lane.
+
+        New and processing events are counted in the lane of their origin,
+        while failed events are counted in the rerun lane.
+        """
+        backlog = dict(db.session.query(cls.origin, func.count('*')).filter(
+            cls.status.in_([EventStatus.New, EventStatus.Processing])
+        ).group_by(cls.origin))
+        backlog[EventOrigin.Rerun] = cls.query.filter(
+            cls.status == EventStatus.Error).count()
+        return backlog
+
     def __repr__(self):
         """String representation of the event."""
         return f"<{self.id}: {self.created}>"
@@ -93,6 +153,110 @@ class ObjectEvent(db.Model, Timestamp):
         else:
             return Relationship.query.get(self.object_uuid)
 
+    @property
+    def payload(self) -> dict:
+        """Get the Scholix payload of the event the object comes from."""
+        return self.event.get_payload()[self.payload_index]
+
     def __repr__(self):
         """String representation of the object event."""
         return f"<{self.event_id}: {self.object_uuid}>"
+
+
+class PayloadHash(db.Model, Timestamp):
+    """Content hash of an already processed Scholix payload."""
+
+    __tablename__ = 'payloadhash'
+
+    hash = db.Column(db.String(64), primary_key=True)
+    event_id = db.Column(UUIDType, db.ForeignKey(Event.id), nullable=False)
+    payload_index = db.Column(db.Integer, nullable=False)
+    # Weak (non-FK) relation, like the objects of ``ObjectEvent``
+    relationship_id = db.Column(UUIDType, index=True)
+
+    @staticmethod
+    def compute(payload: dict) -> str:
+        """Compute the canonical content hash of a payload."""
+        canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False,
+                               separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def get_processed(cls, hashes: Iterable[str],
+                      exclude_event_id: uuid.UUID = None) -> Set[str]:
+        """Get the hashes of the given ones that were already processed.
+
+        :param exclude_event_id: Ignore the hashes stored by this event, e.g.
+            when it is rerun.
+        """
+        hashes = set(hashes)
+        if not hashes:
+            return set()
+        query = db.session.query(cls.hash).filter(cls.hash.in_(hashes))
+        if exclude_event_id:
+            query = query.filter(cls.event_id != exclude_event_id)
+        return {h for h, in query}
+
+    @classmethod
+    def delete_for_relationships(cls, relationship_ids: Iterable[uuid.UUID]):
+        """Forget the payloads of deleted relationships.
+
+        Resubmitted payloads of the relationships are then processed again.
+        """
+        relationship_ids = list(relationship_ids)
+        if relationship_ids:
+            (cls.query.filter(cls.relationship_id.in_(relationship_ids))
+             .delete(synchronize_session=False))
+
+    def __repr__(self):
+        """String representation of the payload hash."""
+        return f"<{self.hash}: {self.event_id}>"
+
+
+class EventPayloadArchive(db.Model, Timestamp):
+    """Compressed payload of an archived event."""
+
+    __tablename__ = 'eventpayloadarchive'
+
+    CODECS = ('gzip', 'zstd')
+
+    event_id = db.Column(UUIDType, db.ForeignKey(Event.id), primary_key=True)
+    codec = db.Column(db.String(16), nullable=False)
+    n_payloads = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    event = db.relationship(
+        Event, backref=db.backref('archive', uselist=False))
+
+    @classmethod
+    def create(cls, event: Event, codec: str = 'gzip'):
+        """Compress the payload of an event into a new archive."""
+        data = json.dumps(event.payload, separators=(',', ':')).encode('utf-8')
+        if codec == 'zstd':
+            if zstandard is None:
+                raise RuntimeError(
+                    "The 'zstandard' package is required for zstd archives.")
+            data = zstandard.ZstdCompressor().compress(data)
+        elif codec == 'gzip':
+            data = gzip.compress(data)
+        else:
+            raise ValueError(f"Unknown archive codec '{codec}'.")
+        archive = cls(event=event, codec=codec, data=data,
+                      n_payloads=len(event.payload))
+        db.session.add(archive)
+        return archive
+
+    def load(self) -> List[dict]:
+        """Decompress the archived payload."""
+        if self.codec == 'zstd':
+            if zstandard is None:
+                raise RuntimeError(
+                    "The 'zstandard' package is required for zstd archives.")
+            data = zstandard.ZstdDecompressor().decompress(self.data)
+        else:
+            data = gzip.decompress(self.data)
+        return json.loads(data.decode('utf-8'))
+
+    def __repr__(self):
+        """String representation of the event payload archive."""
+        return f"<{self.event_id}: {self.codec}>"
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 CERN.
+#
+# Asclepias Broker is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Resumable event reruns."""
+
+import time
+from datetime import datetime
+from typing import Callable, Dict, Iterator, Tuple
+
+from flask import current_app
+from invenio_cache import current_cache
+from invenio_db import db
+from sqlalchemy import and_, func, or_
+
+from ..utils import is_postgresql
+from .api import EventAPI
+from .models import Event, EventStatus
+
+
+class RerunProgress:
+    """Progress of an event rerun."""
+
+    def __init__(self):
+        """Initialize the counters."""
+        self.start = time.monotonic()
+        self.dispatched = 0
+        self.completed = 0
+        self.failed = 0
+        #: Whether the rerun stopped to wait for its dispatched events
+        self.waiting = False
+
+    @property
+    def rate(self) -> float:
+        """Dispatched events per second."""
+        elapsed = time.monotonic() - self.start
+        return self.dispatched / elapsed if elapsed else 0.0
+
+    def __str__(self):
+        """Progress summary."""
+        return (f'{self.dispatched} dispatched, {self.completed} completed, '
+                f'{self.failed} failed ({self.rate:.1f} events/s)')
+
+
+def _db_now() -> datetime:
+    """The current UTC time of the database."""
+    if is_postgresql():
+        return db.session.query(func.timezone('UTC', func.now())).scalar()
+    return db.session.query(func.current_timestamp()).scalar()
+
+
+class EventRerun:
+    """Rerun the events of a query, resuming from the last checkpoint.
+
+    Events are streamed with keyset pagination on ``(created, id)``, so
+    neither the events nor their tasks are loaded all at once. At most
+    ``max_in_flight`` tasks are waiting to be processed at any time, and the
+    key of the last dispatched event is saved as a checkpoint, from where an
+    interrupted rerun is resumed.
+
+    The dispatched events are saved along with the checkpoint, so that a
+    rerun can stop instead of waiting for them, and be resumed later (e.g.
+    by a task scheduled again with a countdown). Stalls are measured with the
+    time of the database, which is shared by the resumed reruns.
+    """
+
+    def __init__(self, name: str, query, no_index: bool = False,
+                 eager: bool = False, max_in_flight: int = None,
+                 batch_size: int = None, poll_interval: float = 1.0,
+                 stall_timeout: float = None):
+        """Initialize the rerun.
+
+        :param name: Name of the rerun, which identifies its checkpoint.
+        :param query: ``Event`` query of the events to rerun.
+        """
+        self.name = name
+        self.query = query
+        self.no_index = no_index
+        self.eager = eager
+        self.max_in_flight = max_in_flight or \
+            current_app.config['ASCLEPIAS_EVENT_RERUN_MAX_IN_FLIGHT']
+        self.batch_size = batch_size or \
+            current_app.config['ASCLEPIAS_EVENT_RERUN_BATCH_SIZE']
+        self.poll_interval = poll_interval
+        self.stall_timeout = stall_timeout or \
+            current_app.config['ASCLEPIAS_EVENT_RERUN_STALL_TIMEOUT']
+        self.progress = RerunProgress()
+        # Dispatched events that were not processed yet, with their update
+        # time when they were dispatched, and the database time of the last
+        # dispatched or processed event
+        self._in_flight: Dict[str, datetime]
+        self._last_change: datetime
+        self._in_flight, self._last_change = \
+            current_cache.get(self._in_flight_key) or ({}, None)
+
+    @property
+    def _checkpoint_key(self) -> str:
+        return f'asclepias_broker:events:rerun:{self.name}'
+
+    @property
+    def _in_flight_key(self) -> str:
+        return f'{self._checkpoint_key}:in_flight'
+
+    @property
+    def checkpoint(self) -> Tuple[datetime, str]:
+        """The ``(created, id)`` of the last dispatched event."""
+        return current_cache.get(self._checkpoint_key)
+
+    @checkpoint.setter
+    def checkpoint(self, value: Tuple[datetime, str]):
+        current_cache.set(self._checkpoint_key, value, timeout=0)
+
+    def _save_in_flight(self):
+        current_cache.set(self._in_flight_key,
+                          (self._in_flight, self._last_change), timeout=0)
+
+    def reset(self):
+        """Discard the checkpoint, so that the rerun starts over."""
+        current_cache.delete(self._checkpoint_key)
+        current_cache.delete(self._in_flight_key)
+        self._in_flight, self._last_change = {}, None
+
+    def iter_events(self) -> Iterator[Event]:
+        """Stream the events after the checkpoint."""
+        after = self.checkpoint
+        query = self.query.order_by(Event.created, Event.id)
+        while True:
+            page = query
+            if after:
+                created, event_id = after
+                page = page.filter(or_(
+                    Event.created > created,
+                    and_(Event.created == created, Event.id > event_id),
+                ))
+            events = page.limit(self.batch_size).all()
+            if not events:
+                return
+            yield from events
+            after = (events[-1].created, str(events[-1].id))
+
+    def _update_in_flight(self):
+        """Forget the dispatched events that were processed since."""
+        if not self._in_flight:
+            return
+        rows = db.session.query(Event.id, Event.status, Event.updated).filter(
+            Event.id.in_(list(self._in_flight))).all()
+        # Events deleted in the meantime are not waited for
+        found = {str(event_id) for event_id, _, _ in rows}
+        for event_id in set(self._in_flight) - found:
+            del self._in_flight[event_id]
+        completed = self.progress.completed
+        for event_id, status, updated in rows:
+            event_id = str(event_id)
+            # Events are updated when they are processed, so they are
+            # compared with their own update time instead of a clock
+            if status == EventStatus.Processing or \
+                    updated == self._in_flight[event_id]:
+                continue
+            del self._in_flight[event_id]
+            self.progress.completed += 1
+            if status == EventStatus.Error:
+                self.progress.failed += 1
+        if self.progress.completed != completed:
+            self._last_change = _db_now()
+        self._save_in_flight()
+        # The transaction is ended, so that the next poll sees new updates
+        db.session.commit()
+
+    def _stalled(self) -> bool:
+        """Check if no event was processed for ``stall_timeout`` seconds."""
+        elapsed = _db_now() - self._last_change
+        return elapsed.total_seconds() > self.stall_timeout
+
+    def _wait(self, max_in_flight: int, on_progress: Callable,
+              block: bool = True) -> bool:
+        """Wait until at most ``max_in_flight`` events are in flight.
+
+        :param block: Sleep until the events are processed. Otherwise the
+            progress is marked as ``waiting`` if there are too many events
+            in flight.
+        :returns: ``False`` if no event was processed for ``stall_timeout``
+            seconds, or if there are too many events in flight and
+            ``block`` is ``False``.
+        """
+        self._update_in_flight()
+        while len(self._in_flight) > max_in_flight:
+            if self._stalled():
+                return False
+            if not block:
+                self.progress.waiting = True
+                return False
+            time.sleep(self.poll_interval)
+            self._update_in_flight()
+            on_progress(self.progress)
+        return True
+
+    def run(self, on_progress: Callable[[RerunProgress], None] = None,
+            wait: bool = True, block: bool = True) -> RerunProgress:
+        """Rerun the events.
+
+        If the dispatched events stall, the rerun stops and keeps its
+        checkpoint, so that it can be resumed later.
+
+        :param on_progress: Called with the progress after each event.
+        :param wait: Wait for the last dispatched events to be processed.
+        :param block: Sleep while ``max_in_flight`` events are in flight.
+            Otherwise the rerun stops with its progress marked as
+            ``waiting``, and is resumed by running it again.
+        """
+        on_progress = on_progress or (lambda progress: None)
+        for event in self.iter_events():
+            if not self.eager:
+                if not self._wait(self.max_in_flight - 1, on_progress,
+                                  block=block):
+                    if not self.progress.waiting:
+                        current_app.logger.warning(
+                            f'Stopping stalled {self.name} rerun.')
+                    return self.progress
+                if not self._in_flight:
+                    self._last_change = _db_now()
+                self._in_flight[str(event.id)] = event.updated
+            key = (event.created, str(event.id))
+            if self.eager:
+                try:
+                    EventAPI.rerun_event(event, no_index=self.no_index,
+                                         eager=True)
+                except Exception:
+                    current_app.logger.exception(
+                        'Error while rerunning event.',
+                        extra={'event_id': key[1]})
+                self.progress.completed += 1
+                if Event.get(key[1]).status == EventStatus.Error:
+                    self.progress.failed += 1
+            else:
+                EventAPI.rerun_event(event, no_index=self.no_index)
+                self._save_in_flight()
+            self.checkpoint = key
+            self.progress.dispatched += 1
+            on_progress(self.progress)
+        if wait and not self.eager and \
+                not self._wait(0, on_progress, block=block):
+            if self.progress.waiting:
+                return self.progress
+            current_app.logger.warning(
+                f'Stopped waiting for the stalled {self.name} rerun.')
+        self.reset()
+        return self.progress
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 CERN.
+#
+# Asclepias Broker is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Events tasks."""
+
+from celery import shared_task
+from flask import current_app
+
+from .api import EventAPI
+
+
+@shared_task(ignore_result=True)
+def archive_events(days: int = None):
+    """Archive the payloads of old processed events."""
+    days = days or current_app.config['ASCLEPIAS_EVENT_ARCHIVE_AFTER_DAYS']
+    if days:
+        archived = EventAPI.archive_events(days)
+        current_app.logger.info(f'Archived {archived} event payloads.')
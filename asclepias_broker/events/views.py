@@ -15,7 +15,7 @@ from marshmallow.exceptions import \
 
 from asclepias_broker.events.api import EventAPI
 
-from .errors import PayloadValidationRESTError
+from .errors import EventStreamValidationError, PayloadValidationRESTError
 
 #
 # REST API Views
@@ -44,4 +44,34 @@ class EventResource(MethodView):
         }), 202
 
 
+class EventStreamResource(MethodView):
+    """Newline-delimited event stream resource."""
+
+    @require_api_auth()
+    def post(self):
+        """Submit a newline-delimited stream of Scholix links."""
+        no_index = bool(request.args.get('noindex', False))
+        event_ids = []
+        try:
+            for event in EventAPI.handle_event_stream(
+                    request.stream, user_id=current_user.id,
+                    no_index=no_index):
+                event_ids.append(str(event.id))
+        except EventStreamValidationError as e:
+            return jsonify({
+                'message': f'Validation error on line {e.line}: {e.message}',
+                'line': e.line,
+                'event_ids': event_ids,
+            }), 422
+        if not event_ids:
+            raise PayloadValidationRESTError(
+                'At least one link is required.', code=422)
+        return jsonify({
+            'message': 'events accepted',
+            'event_ids': event_ids
+        }), 202
+
+
 blueprint.add_url_rule('/events', view_func=EventResource.as_view('event'))
+blueprint.add_url_rule(
+    '/events/stream', view_func=EventStreamResource.as_view('event_stream'))
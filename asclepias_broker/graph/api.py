@@ -8,17 +8,125 @@
 """Graph functions."""
 
 import uuid
-from typing import Optional, Tuple, Union
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
 
+from flask import current_app
 from invenio_db import db
-from sqlalchemy.orm import aliased
+from sqlalchemy import and_, case, exists, func, or_, select
+from sqlalchemy.orm import aliased, make_transient_to_detached
 
 from ..core.models import Identifier, Relation, Relationship
+from ..events.models import PayloadHash
 from ..metadata.models import GroupMetadata, GroupRelationshipMetadata
+from ..utils import is_postgresql
+from .builder import ComponentBuilder, find_version_root
+from .cache import group_cache
+from .locks import acquire_locks, lock_identifier_groups, \
+    run_with_lock_retries
 from .models import Group, GroupM2M, GroupRelationship, GroupRelationshipM2M, \
     GroupType, Identifier2Group, Relationship2GroupRelationship
 
 
+def _duplicate_group_relationships(
+    queried_fk: str, grouping_fk: str, merge_groups_ids: list
+):
+    """Subquery of the duplicate group relationship pairs of merged groups.
+
+    Returns the ``(keep_id, drop_id)`` pairs of group relationships which
+    only differ by their ``queried_fk`` group (one of the merged groups).
+    Since a group relationship is unique, every group relationship is part
+    of at most one pair.
+    """
+    keep = aliased(GroupRelationship, name='keep_gr')
+    drop = aliased(GroupRelationship, name='drop_gr')
+    keep_queried_fk = getattr(keep, queried_fk)
+    drop_queried_fk = getattr(drop, queried_fk)
+    return (
+        db.session.query(keep.id.label('keep_id'), drop.id.label('drop_id'))
+        .join(drop, and_(
+            getattr(keep, grouping_fk) == getattr(drop, grouping_fk),
+            keep.relation == drop.relation))
+        .filter(
+            keep.id < drop.id,  # Don't repeat the same pairs
+            keep_queried_fk.in_(merge_groups_ids),
+            drop_queried_fk.in_(merge_groups_ids),
+            keep_queried_fk != drop_queried_fk)
+        .subquery('pairs')
+    )
+
+
+def _merge_duplicate_metadata(pairs):
+    """Append the metadata of the dropped relationships to the kept ones.
+
+    The metadata of the least recently updated relationship comes first.
+    """
+    keep_meta = GroupRelationshipMetadata
+    drop_meta = aliased(GroupRelationshipMetadata, name='drop_meta')
+    if is_postgresql():
+        keep_json = func.coalesce(keep_meta.json, func.jsonb_build_array())
+        drop_json = func.coalesce(drop_meta.json, func.jsonb_build_array())
+        (
+            keep_meta.query
+            .filter(keep_meta.group_relationship_id == pairs.c.keep_id,
+                    drop_meta.group_relationship_id == pairs.c.drop_id)
+            .update({keep_meta.json: case(
+                [(drop_meta.updated < keep_meta.updated,
+                  drop_json.op('||')(keep_json))],
+                else_=keep_json.op('||')(drop_json))},
+                synchronize_session='fetch')
+        )
+    else:
+        metadata_pairs = (
+            db.session.query(keep_meta, drop_meta)
+            .join(pairs, keep_meta.group_relationship_id == pairs.c.keep_id)
+            .join(drop_meta,
+                  drop_meta.group_relationship_id == pairs.c.drop_id)
+        )
+        for keep, drop in metadata_pairs:
+            json1, json2 = keep.json, drop.json
+            if drop.updated < keep.updated:
+                json1, json2 = json2, json1
+            keep.json = json1
+            keep.update(json2, validate=False, multi=True)
+        db.session.flush()
+
+
+def _repoint_duplicate_m2m(cls, fk: str, other_fk: str, pairs):
+    """Move M2M rows from the dropped to the kept group relationships.
+
+    Rows that would collide with an existing row of the kept group
+    relationship are deleted instead.
+    """
+    fk_col, other_fk_col = getattr(cls, fk), getattr(cls, other_fk)
+    kept = aliased(cls, name='kept_m2m')
+    (
+        cls.query
+        .filter(exists().where(and_(
+            pairs.c.drop_id == fk_col,
+            getattr(kept, fk) == pairs.c.keep_id,
+            getattr(kept, other_fk) == other_fk_col)))
+        .delete(synchronize_session='fetch')
+    )
+    if is_postgresql():
+        # UPDATE ... FROM pairs
+        (
+            cls.query
+            .filter(fk_col == pairs.c.drop_id)
+            .update({fk_col: pairs.c.keep_id}, synchronize_session='fetch')
+        )
+    else:
+        keep_id = (
+            select([pairs.c.keep_id])
+            .where(pairs.c.drop_id == fk_col)
+            .as_scalar()
+        )
+        (
+            cls.query
+            .filter(fk_col.in_(select([pairs.c.drop_id])))
+            .update({fk_col: keep_id}, synchronize_session='fetch')
+        )
+
+
 def merge_group_relationships(
     group_a: Group,
     group_b: Group,
@@ -46,12 +154,14 @@ def merge_group_relationships(
     - Y Cites {AB}
 
     before we can perform the actual marging of A and B. Otherwise we will
-    violate the unique constraint. We do that by removing the duplicate
-    relationships (only one of each duplicate pair), so that we can later
-    execute and UPDATE.
+    violate the unique constraint. We do that by keeping one relationship of
+    each duplicate pair, to which the metadata and M2M objects of the other
+    one are moved, so that we can later execute and UPDATE. All of this is
+    done with a few set-based statements, regardless of the number of pairs.
     """
     # Determine if this is an Identity-type group merge
     identity_groups = group_a.type == GroupType.Identity
+    db.session.flush()
 
     # Remove all GroupRelationship objects between groups A and B.
     # Correspnding GroupRelationshipM2M objects will cascade
@@ -71,87 +181,32 @@ def merge_group_relationships(
     merge_groups_ids = [group_a.id, group_b.id]
     for queried_fk, grouping_fk in [('source_id', 'target_id'),
                                     ('target_id', 'source_id'), ]:
-        left_gr = aliased(GroupRelationship, name='left_gr')
-        right_gr = aliased(GroupRelationship, name='right_gr')
-        left_queried_fk = getattr(left_gr, queried_fk)
-        right_queried_fk = getattr(right_gr, queried_fk)
-        left_grouping_fk = getattr(left_gr, grouping_fk)
-        right_grouping_fk = getattr(right_gr, grouping_fk)
-
-        # 'duplicate_relations' holds GroupRelations, which should be
-        # "squashed" after group merging. If we didn't do this, we would
-        # violate the UNIQUE constraint
-        # Generate 'duplicate_relations' by joining the table with itself
-        # by the "grouping_fk" (target_id/source_id)
-        duplicate_relations = (
-            db.session.query(left_gr, right_gr)
-            .filter(
-                left_gr.id < right_gr.id,  # Don't repeat the same pairs
-                left_queried_fk.in_(merge_groups_ids),
-                right_queried_fk.in_(merge_groups_ids),
-                right_queried_fk != left_queried_fk,
-                right_gr.relation == left_gr.relation)
-            .join(
-                right_gr,
-                left_grouping_fk == right_grouping_fk)
-        )
-        del_rel = set()
-        for rel_a, rel_b in duplicate_relations:
-            kwargs = {
-                queried_fk: merged_group.id,
-                grouping_fk: getattr(rel_a, grouping_fk),
-                'relation': rel_a.relation,
-                'id': uuid.uuid4(),
-                'type': rel_a.type
-            }
-            new_grp_rel = GroupRelationship(**kwargs)
-            db.session.add(new_grp_rel)
-            if identity_groups:
-                group_rel_meta = GroupRelationshipMetadata(
-                    group_relationship_id=new_grp_rel.id)
-                db.session.add(group_rel_meta)
-                json1, json2 = rel_a.data.json, rel_b.data.json
-                if rel_b.data.updated < rel_a.data.updated:
-                    json1, json2 = json2, json1
-                group_rel_meta.json = json1
-                group_rel_meta.update(json2, validate=False, multi=True)
-
-            # Delete the duplicate pairs of relationship M2Ms before updating
-            delete_duplicate_relationship_m2m(rel_a, rel_b)
-            rel_ids = [rel_a.id, rel_b.id]
-            (
-                GroupRelationshipM2M.query
-                .filter(GroupRelationshipM2M.relationship_id.in_(rel_ids))
-                .update({GroupRelationshipM2M.relationship_id: new_grp_rel.id},
-                        synchronize_session='fetch')
-            )
-            (
-                GroupRelationshipM2M.query
-                .filter(GroupRelationshipM2M.subrelationship_id.in_(rel_ids))
-                .update(
-                    {GroupRelationshipM2M.subrelationship_id: new_grp_rel.id},
-                    synchronize_session='fetch')
-            )
-            if identity_groups:
-                cls = Relationship2GroupRelationship
-                delete_duplicate_relationship_m2m(rel_a, rel_b, cls=cls)
-                (
-                    cls.query
-                    .filter(cls.group_relationship_id.in_(rel_ids))
-                    .update({cls.group_relationship_id: new_grp_rel.id},
-                            synchronize_session='fetch')
-                )
-            del_rel.add(rel_a.id)
-            del_rel.add(rel_b.id)
+        # 'pairs' holds the GroupRelations, which should be "squashed" after
+        # group merging. If we didn't do this, we would violate the UNIQUE
+        # constraint
+        pairs = _duplicate_group_relationships(
+            queried_fk, grouping_fk, merge_groups_ids)
+        if identity_groups:
+            _merge_duplicate_metadata(pairs)
+
+        # Move the relationship M2Ms of the dropped relationships
+        for fk, other_fk in [('relationship_id', 'subrelationship_id'),
+                             ('subrelationship_id', 'relationship_id')]:
+            _repoint_duplicate_m2m(GroupRelationshipM2M, fk, other_fk, pairs)
+        if identity_groups:
+            _repoint_duplicate_m2m(
+                Relationship2GroupRelationship, 'group_relationship_id',
+                'relationship_id', pairs)
+
         # Delete the duplicate relations
         (
             GroupRelationship.query
-            .filter(GroupRelationship.id.in_(del_rel))
+            .filter(GroupRelationship.id.in_(select([pairs.c.drop_id])))
             .delete(synchronize_session='fetch')
         )
 
         queried_fk_inst = getattr(GroupRelationship, queried_fk)
-        # Update the other non-duplicated relations
+        # Update the kept and the other non-duplicated relations
         (
             GroupRelationship.query
             .filter(queried_fk_inst.in_(merge_groups_ids))
@@ -160,6 +215,25 @@ def merge_group_relationships(
         )
 
 
+def _delete_duplicate_m2m(cls, queried_fk: str, grouping_fk: str,
+                          id_a, id_b):
+    """Delete the M2M rows of A that have a duplicate row for B.
+
+    Rows only differing by their ``queried_fk`` (A or B) would collide once
+    A and B are merged, so one of each pair is deleted in a single query.
+    """
+    other = aliased(cls, name='other_m2m')
+    (
+        cls.query
+        .filter(
+            getattr(cls, queried_fk) == id_a,
+            getattr(cls, grouping_fk).in_(
+                select([getattr(other, grouping_fk)])
+                .where(getattr(other, queried_fk) == id_b)))
+        .delete(synchronize_session='fetch')
+    )
+
+
 def delete_duplicate_relationship_m2m(
     group_a: Group,
     group_b: Group,
@@ -186,33 +260,8 @@ def delete_duplicate_relationship_m2m(
 
     for queried_fk, grouping_fk in [(queried_fk, grouping_fk),
                                     (grouping_fk, queried_fk), ]:
-        left_gr = aliased(cls, name='left_gr')
-        right_gr = aliased(cls, name='right_gr')
-        left_queried_fk = getattr(left_gr, queried_fk)
-        right_queried_fk = getattr(right_gr, queried_fk)
-        left_grouping_fk = getattr(left_gr, grouping_fk)
-        right_grouping_fk = getattr(right_gr, grouping_fk)
-        merge_groups_ids = [group_a.id, group_b.id]
-
-        duplicate_relations = (
-            db.session.query(left_gr, right_gr)
-            .filter(
-                # Because we join in the same table by grouping_fk, we will
-                # have pairs [(A,B), (B,A)] on the list. We can impose an
-                # inequality condition on one FK to reduce this to just one
-                # pair [(A,B)]
-                left_queried_fk < right_queried_fk,
-                left_queried_fk.in_(merge_groups_ids),
-                right_queried_fk.in_(merge_groups_ids),
-                right_queried_fk != left_queried_fk,
-                )
-            .join(
-                right_gr,
-                left_grouping_fk == right_grouping_fk)
-        )
-        # TODO: Delete in a query
-        for rel_a, rel_b in duplicate_relations:
-            db.session.delete(rel_a)
+        _delete_duplicate_m2m(
+            cls, queried_fk, grouping_fk, group_a.id, group_b.id)
 
 
 def delete_duplicate_group_m2m(group_a: Group, group_b: Group):
@@ -221,39 +270,10 @@ def delete_duplicate_group_m2m(group_a: Group, group_b: Group):
 
     Removes one of each pair of GroupM2M objects for groups A and B.
     """
-    cls = GroupM2M
-    queried_fk = 'group_id'
-    grouping_fk = 'subgroup_id'
-
-    for queried_fk, grouping_fk in [(queried_fk, grouping_fk),
-                                    (grouping_fk, queried_fk), ]:
-        left_gr = aliased(cls, name='left_gr')
-        right_gr = aliased(cls, name='right_gr')
-        left_queried_fk = getattr(left_gr, queried_fk)
-        right_queried_fk = getattr(right_gr, queried_fk)
-        left_grouping_fk = getattr(left_gr, grouping_fk)
-        right_grouping_fk = getattr(right_gr, grouping_fk)
-        merge_groups_ids = [group_a.id, group_b.id]
-
-        duplicate_relations = (
-            db.session.query(left_gr, right_gr)
-            .filter(
-                # Because we join in the same table by grouping_fk, we will
-                # have pairs [(A,B), (B,A)] on the list. We impose an
-                # inequality condition on one FK to reduce this to just one
-                # pair [(A,B)]
-                left_queried_fk < right_queried_fk,
-                left_queried_fk.in_(merge_groups_ids),
-                right_queried_fk.in_(merge_groups_ids),
-                right_queried_fk != left_queried_fk,
-                )
-            .join(
-                right_gr,
-                left_grouping_fk == right_grouping_fk)
-        )
-        # TODO: Delete in a query
-        for rel_a, rel_b in duplicate_relations:
-            db.session.delete(rel_a)
+    for queried_fk, grouping_fk in [('group_id', 'subgroup_id'),
+                                    ('subgroup_id', 'group_id'), ]:
+        _delete_duplicate_m2m(
+            GroupM2M, queried_fk, grouping_fk, group_a.id, group_b.id)
 
 
 def merge_identity_groups(
@@ -279,6 +299,7 @@ def merge_identity_groups(
     merged_version_group = merge_version_groups(
         version_group_a, version_group_b)
 
+    group_cache.invalidate_groups([group_a.id, group_b.id])
     merged_group = Group(type=GroupType.Identity, id=uuid.uuid4())
     db.session.add(merged_group)
     merged_group_meta = GroupMetadata(group_id=merged_group.id)
@@ -295,6 +316,10 @@ def merge_identity_groups(
      .filter(Identifier2Group.group_id.in_([group_a.id, group_b.id]))
      .update({Identifier2Group.group_id: merged_group.id},
              synchronize_session='fetch'))
+    (Group.query
+     .filter(Group.root_id.in_([group_a.id, group_b.id]))
+     .update({Group.root_id: merged_group.id},
+             synchronize_session='fetch'))
 
     # Delete the duplicate GroupM2M entries and update the remaining with
     # the new Group
@@ -303,6 +328,10 @@ def merge_identity_groups(
      .filter(GroupM2M.subgroup_id.in_([group_a.id, group_b.id]))
      .update({GroupM2M.subgroup_id: merged_group.id},
              synchronize_session='fetch'))
+    # The merged groups might have been in the middle of the versions
+    version_group = merged_version_group or version_group_a
+    version_group.root_id = _version_group_root(
+        version_group, version_group.root_id)
 
     Group.query.filter(Group.id.in_([group_a.id, group_b.id])).delete(
         synchronize_session='fetch')
@@ -321,6 +350,7 @@ def merge_version_groups(group_a: Group, group_b: Group) -> Optional[Group]:
         # Merging Identity groups is done separately
         raise ValueError("Cannot merge groups of type 'Identity'.")
 
+    group_cache.invalidate_groups([group_a.id, group_b.id])
     merged_group = Group(type=group_a.type, id=uuid.uuid4())
     db.session.add(merged_group)
 
@@ -337,14 +367,78 @@ def merge_version_groups(group_a: Group, group_b: Group) -> Optional[Group]:
      .filter(GroupM2M.subgroup_id.in_([group_a.id, group_b.id]))
      .update({GroupM2M.subgroup_id: merged_group.id},
              synchronize_session='fetch'))
+    merged_group.root_id = _version_group_root(
+        merged_group, group_a.root_id or group_b.root_id)
 
     Group.query.filter(Group.id.in_([group_a.id, group_b.id])).delete(
         synchronize_session='fetch')
     return merged_group
 
 
+def _version_group_root(
+    group: Group, default: Optional[uuid.UUID]
+) -> Optional[uuid.UUID]:
+    """Find the root Identity group of a Version group.
+
+    Uses the ``HasVersion`` relationships between the identifiers of the
+    group, like :class:`~asclepias_broker.graph.builder.GraphBuilder`, see
+    :func:`~asclepias_broker.graph.builder.find_version_root`.
+    """
+    src_id2g = aliased(Identifier2Group, name='src_id2g')
+    tar_id2g = aliased(Identifier2Group, name='tar_id2g')
+    subgroups = select([GroupM2M.subgroup_id]).where(
+        GroupM2M.group_id == group.id)
+    edges = (
+        db.session.query(src_id2g.group_id, tar_id2g.group_id)
+        .select_from(Relationship)
+        .join(src_id2g, src_id2g.identifier_id == Relationship.source_id)
+        .join(tar_id2g, tar_id2g.identifier_id == Relationship.target_id)
+        .filter(Relationship.relation == Relation.HasVersion,
+                src_id2g.group_id.in_(subgroups))
+        .order_by(Relationship.created, Relationship.id))
+    return find_version_root(edges, default)
+
+
+def _get_group(group_id: uuid.UUID, group_type: GroupType) -> Group:
+    """Get a group known to exist, without loading it.
+
+    Groups missing from the session are added to it as persistent, with
+    their other attributes loaded on first access.
+    """
+    group = db.session.identity_map.get(db.session.identity_key(
+        Group, group_id))
+    if group is None:
+        # Groups created in this transaction might not be flushed yet
+        group = next((g for g in db.session.new
+                      if isinstance(g, Group) and g.id == group_id), None)
+    if group is None:
+        group = Group(id=group_id, type=group_type)
+        make_transient_to_detached(group)
+        db.session.add(group)
+    return group
+
+
+def _get_cached_groups(
+    identifier_id: uuid.UUID
+) -> Optional[Tuple[Group, Group]]:
+    """Get the Identity and Version groups of an identifier from the cache.
+
+    Cached groups are trusted without querying them: merges invalidate the
+    entries of the merged groups, and the groups are locked (and checked)
+    before they are updated, see :func:`_get_or_create_locked_groups`.
+    """
+    group_ids = group_cache.get(identifier_id)
+    if group_ids:
+        id_group_id, ver_group_id = group_ids
+        return (_get_group(id_group_id, GroupType.Identity),
+                _get_group(ver_group_id, GroupType.Version))
+
+
 def get_or_create_groups(identifier: Identifier) -> Tuple[Group, Group]:
     """Given an Identifier, fetch or create its Identity and Version groups."""
+    cached = _get_cached_groups(identifier.id)
+    if cached:
+        return cached
     id2g = Identifier2Group.query.filter(
         Identifier2Group.identifier == identifier).one_or_none()
     if not id2g:
@@ -360,10 +454,12 @@ def get_or_create_groups(identifier: Identifier) -> Tuple[Group, Group]:
                    Group.type == GroupType.Version)
            .one_or_none())
     if not g2g:
-        group = Group(type=GroupType.Version, id=uuid.uuid4())
+        group = Group(type=GroupType.Version, id=uuid.uuid4(),
+                      root_id=id2g.group.id)
         db.session.add(group)
         g2g = GroupM2M(group=group, subgroup=id2g.group)
         db.session.add(g2g)
+    group_cache.set(identifier.id, (id2g.group.id, g2g.group.id))
     return id2g.group, g2g.group
 
 
@@ -376,11 +472,17 @@ def get_group_from_id(
     # TODO: Move this method to api.utils or to models?
     id_ = Identifier.get(identifier_value, id_type)
     if id_:
-        id_grp = id_.id2groups[0].group
+        cached = _get_cached_groups(id_.id)
+        if cached:
+            id_grp, ver_grp = cached
+        else:
+            id_grp = id_.id2groups[0].group
+            ver_grp = GroupM2M.query.filter_by(subgroup=id_grp).one().group
+            group_cache.set(id_.id, (id_grp.id, ver_grp.id))
         if group_type == GroupType.Identity:
             return id_grp
         else:
-            return GroupM2M.query.filter_by(subgroup=id_grp).one().group
+            return ver_grp
 
 
 def add_group_relationship(
@@ -388,7 +490,13 @@ def add_group_relationship(
     src_id_grp: Group, tar_id_grp: Group,
     src_ver_grp: Group, tar_ver_grp: Group
 ):
-    """Add a group relationship between corresponding groups."""
+    """Add a group relationship between corresponding groups.
+
+    Like the merges, which delete the group relationships between the merged
+    groups, no group relationship is added from a group to itself.
+    """
+    if src_id_grp == tar_id_grp:
+        return
     # Add GroupRelationship between Identity groups
     id_grp_rel = GroupRelationship(source=src_id_grp, target=tar_id_grp,
                                    relation=relationship.relation,
@@ -403,6 +511,8 @@ def add_group_relationship(
         relationship=relationship, group_relationship=id_grp_rel)
     db.session.add(rel2grp_rel)
 
+    if src_ver_grp == tar_ver_grp:
+        return
     # Add GroupRelationship between Version groups if it doesn't exist
     ver_grp_rel = (
         GroupRelationship.query
@@ -421,12 +531,111 @@ def add_group_relationship(
     db.session.add(g2g_rel)
 
 
+def add_group_relationships(
+    items: List[Tuple[Relationship, Group, Group, Group, Group]]
+):
+    """Add the group relationships of many relationships in bulk.
+
+    Batched variant of :func:`add_group_relationship`, for relationships
+    already resolved to their ``(relationship, src_id_grp, tar_id_grp,
+    src_ver_grp, tar_ver_grp)`` groups. Like :func:`update_groups`, existing
+    Identity group relationships are reused, and none are added from a group
+    to itself. The existing group relationships are fetched with a single
+    query, Version group relationships are deduplicated in memory, and each
+    table is written with one statement.
+
+    ``IsIdenticalTo`` and ``HasVersion`` relationships, which merge groups
+    instead, are not supported.
+    """
+    if not items:
+        return
+    group_ids = {g.id for item in items for g in item[1:]}
+    group_rels = {}
+    for id_, source_id, target_id, relation in (
+            db.session.query(
+                GroupRelationship.id, GroupRelationship.source_id,
+                GroupRelationship.target_id, GroupRelationship.relation)
+            .filter(GroupRelationship.source_id.in_(group_ids),
+                    GroupRelationship.target_id.in_(group_ids))):
+        group_rels[(source_id, target_id, relation)] = id_
+
+    grp_rel_rows, metadata_rows, rel2grp_rel_rows, m2m_rows = [], [], [], []
+
+    def _get_or_add(src_grp, tar_grp, relation, type_):
+        key = (src_grp.id, tar_grp.id, relation)
+        if key in group_rels:
+            return group_rels[key], False
+        id_ = group_rels[key] = uuid.uuid4()
+        grp_rel_rows.append(dict(
+            id=id_, type=type_, relation=relation, source_id=src_grp.id,
+            target_id=tar_grp.id))
+        return id_, True
+
+    for relationship, src_idg, tar_idg, src_vg, tar_vg in items:
+        if relationship.relation in (Relation.IsIdenticalTo,
+                                     Relation.HasVersion):
+            raise ValueError(
+                f'Cannot add group relationships for {relationship}.')
+        if src_idg == tar_idg:
+            continue
+        id_grp_rel, created = _get_or_add(
+            src_idg, tar_idg, relationship.relation, GroupType.Identity)
+        rel2grp_rel_rows.append(dict(
+            relationship_id=relationship.id,
+            group_relationship_id=id_grp_rel))
+        if created:
+            metadata_rows.append(
+                dict(group_relationship_id=id_grp_rel, json=[]))
+            if src_vg == tar_vg:
+                continue
+            ver_grp_rel, _ = _get_or_add(
+                src_vg, tar_vg, relationship.relation, GroupType.Version)
+            m2m_rows.append(dict(
+                relationship_id=ver_grp_rel, subrelationship_id=id_grp_rel))
+
+    for model, rows in ((GroupRelationship, grp_rel_rows),
+                        (GroupRelationshipMetadata, metadata_rows),
+                        (Relationship2GroupRelationship, rel2grp_rel_rows),
+                        (GroupRelationshipM2M, m2m_rows)):
+        if rows:
+            db.session.execute(model.__table__.insert(), rows)
+
+
+def _get_or_create_locked_groups(
+    relationship: Relationship
+) -> Tuple[Group, Group, Group, Group]:
+    """Get or create the groups of a relationship's identifiers, locked.
+
+    The identifiers are locked first, so that their groups are not created
+    concurrently, and then their groups, so that they are not merged
+    concurrently. Groups that were merged while waiting for their locks (or
+    before, by another worker, if they came from the cache) are resolved
+    again.
+    """
+    acquire_locks([relationship.source.id, relationship.target.id])
+    while True:
+        src_idg, src_vg = get_or_create_groups(relationship.source)
+        tar_idg, tar_vg = get_or_create_groups(relationship.target)
+        group_ids = {g.id for g in (src_idg, src_vg, tar_idg, tar_vg)}
+        acquire_locks(group_ids)
+        if Group.query.filter(Group.id.in_(group_ids)).count() == \
+                len(group_ids):
+            return src_idg, src_vg, tar_idg, tar_vg
+        group_cache.invalidate_groups(group_ids)
+        db.session.flush()
+        db.session.expire_all()
+
+
 def update_groups(
     relationship: Relationship, delete: bool = False
 ) -> Tuple[Tuple[Group, Group, Group], Tuple[Group, Group, Group]]:
-    """Update groups and related M2M objects for given relationship."""
-    src_idg, src_vg = get_or_create_groups(relationship.source)
-    tar_idg, tar_vg = get_or_create_groups(relationship.target)
+    """Update groups and related M2M objects for given relationship.
+
+    The identifiers and groups of the relationship stay locked until the end
+    of the transaction (see :mod:`asclepias_broker.graph.locks`).
+    """
+    src_idg, src_vg, tar_idg, tar_vg = \
+        _get_or_create_locked_groups(relationship)
     merged_group = None
     merged_version_group = None
 
@@ -457,3 +666,236 @@ def update_groups(
         (src_idg, tar_idg, merged_group),
         (src_vg, tar_vg, merged_version_group),
     )
+
+
+def update_groups_many(
+    relationships: Iterable[Relationship]
+) -> List[Tuple[Tuple[Group, Group, Group], Tuple[Group, Group, Group]]]:
+    """Update the groups of many relationships, in order.
+
+    Consecutive relationships that do not merge groups are batched with
+    :func:`add_group_relationships`, while merging relationships go through
+    :func:`update_groups` (after the pending batch, since merges change the
+    groups).
+
+    :returns: The :func:`update_groups` result of each relationship.
+    """
+    results = []
+    batch = []
+    for relationship in relationships:
+        if relationship.relation in (Relation.IsIdenticalTo,
+                                     Relation.HasVersion):
+            add_group_relationships(batch)
+            batch = []
+            results.append(update_groups(relationship))
+        else:
+            src_idg, src_vg, tar_idg, tar_vg = \
+                _get_or_create_locked_groups(relationship)
+            batch.append((relationship, src_idg, tar_idg, src_vg, tar_vg))
+            results.append(((src_idg, tar_idg, None), (src_vg, tar_vg, None)))
+    add_group_relationships(batch)
+    return results
+
+
+def _delete_group_relationships(group_rel_ids: List[uuid.UUID]):
+    """Delete group relationships with their metadata and M2M objects."""
+    for model, cond in (
+            (GroupRelationshipM2M,
+             GroupRelationshipM2M.relationship_id.in_(group_rel_ids) |
+             GroupRelationshipM2M.subrelationship_id.in_(group_rel_ids)),
+            (Relationship2GroupRelationship,
+             Relationship2GroupRelationship.group_relationship_id.in_(
+                 group_rel_ids)),
+            (GroupRelationshipMetadata,
+             GroupRelationshipMetadata.group_relationship_id.in_(
+                 group_rel_ids)),
+            (GroupRelationship, GroupRelationship.id.in_(group_rel_ids))):
+        model.query.filter(cond).delete(synchronize_session=False)
+
+
+def _delete_empty_group_relationships(group_rel_ids: List[uuid.UUID]):
+    """Delete the Identity group relationships left without relationships.
+
+    The Version group relationships left without Identity group
+    relationships are deleted as well.
+    """
+    empty = [
+        id_ for id_, in db.session.query(GroupRelationship.id).filter(
+            GroupRelationship.id.in_(group_rel_ids),
+            ~exists().where(
+                Relationship2GroupRelationship.group_relationship_id ==
+                GroupRelationship.id))]
+    if not empty:
+        return
+    ver_grp_rel_ids = [
+        id_ for id_, in db.session.query(
+            GroupRelationshipM2M.relationship_id).filter(
+                GroupRelationshipM2M.subrelationship_id.in_(empty))]
+    _delete_group_relationships(empty)
+    if ver_grp_rel_ids:
+        _delete_group_relationships([
+            id_ for id_, in db.session.query(GroupRelationship.id).filter(
+                GroupRelationship.id.in_(ver_grp_rel_ids),
+                ~exists().where(
+                    GroupRelationshipM2M.relationship_id ==
+                    GroupRelationship.id))])
+
+
+def _lock_version_group(identifier: Identifier) -> Group:
+    """Lock all the identifiers and groups of an identifier's Version group.
+
+    Retries if the Version group was merged while waiting for the locks.
+    """
+    while True:
+        _, ver_grp = get_or_create_groups(identifier)
+        db.session.flush()
+        lock_identifier_groups(
+            [identifier.id] +
+            [id_ for id_, in db.session.query(Identifier2Group.identifier_id)
+             .join(GroupM2M,
+                   GroupM2M.subgroup_id == Identifier2Group.group_id)
+             .filter(GroupM2M.group_id == ver_grp.id)])
+        if Group.query.filter(Group.id == ver_grp.id).count():
+            return ver_grp
+        db.session.expire_all()
+
+
+def delete_relationship(relationship: Relationship) -> Tuple[
+    Set[str], Set[str],
+    Set[str], Set[str],
+    Dict[str, str],
+]:
+    """Delete a relationship, and regroup the identifiers it affects.
+
+    Deleting an ``IsIdenticalTo`` or ``HasVersion`` relationship rebuilds
+    the Version group of its identifiers with
+    :class:`~asclepias_broker.graph.builder.ComponentBuilder`, splitting the
+    groups that are no longer connected. Deleting other relationships only
+    removes the group relationships left without relationships. The
+    payload hashes of the relationship are deleted, so that the relationship
+    can be submitted again.
+
+    :returns: The groups to index and delete, like
+        :func:`~asclepias_broker.graph.tasks.compact_indexing_groups`.
+    """
+    PayloadHash.delete_for_relationships([relationship.id])
+    if relationship.relation in (Relation.IsIdenticalTo,
+                                 Relation.HasVersion):
+        ver_grp = _lock_version_group(relationship.source)
+        db.session.delete(relationship)
+        return ComponentBuilder(ver_grp.id).build()
+
+    src_idg, src_vg, tar_idg, tar_vg = \
+        _get_or_create_locked_groups(relationship)
+    group_rel_ids = [
+        id_ for id_, in db.session.query(
+            Relationship2GroupRelationship.group_relationship_id).filter(
+                Relationship2GroupRelationship.relationship_id ==
+                relationship.id)]
+    (Relationship2GroupRelationship.query
+     .filter(Relationship2GroupRelationship.relationship_id ==
+             relationship.id)
+     .delete(synchronize_session='fetch'))
+    db.session.delete(relationship)
+    db.session.flush()
+    _delete_empty_group_relationships(group_rel_ids)
+    return (
+        {str(src_idg.id), str(tar_idg.id)}, set(),
+        {str(src_vg.id), str(tar_vg.id)}, set(),
+        {str(src_idg.id): str(src_vg.id), str(tar_idg.id): str(tar_vg.id)},
+    )
+
+
+def merge_identifiers(identifier: Identifier, duplicate: Identifier):
+    """Merge a duplicate identifier into another one.
+
+    The Identity groups of the identifiers are merged, as if they were
+    identical, and the relationships of the duplicate are moved to the
+    identifier, or deleted (with their payload hashes) if the identifier
+    already has them. The duplicate is deleted.
+    """
+    lock_identifier_groups([identifier.id, duplicate.id])
+    id_grp, _ = get_or_create_groups(identifier)
+    dup_grp, _ = get_or_create_groups(duplicate)
+    merge_identity_groups(id_grp, dup_grp)
+
+    existing = set(
+        db.session.query(Relationship.source_id, Relationship.target_id,
+                         Relationship.relation)
+        .filter(or_(Relationship.source_id == identifier.id,
+                    Relationship.target_id == identifier.id)))
+    deleted = []
+    for rel in Relationship.query.filter(or_(
+            Relationship.source_id == duplicate.id,
+            Relationship.target_id == duplicate.id)):
+        source_id, target_id = (
+            identifier.id if id_ == duplicate.id else id_
+            for id_ in (rel.source_id, rel.target_id))
+        key = (source_id, target_id, rel.relation)
+        if source_id == target_id or key in existing:
+            # The groups are merged, so the relationship of the identifier
+            # is in the same group relationships
+            deleted.append(rel.id)
+        else:
+            rel.source_id, rel.target_id = source_id, target_id
+            existing.add(key)
+    db.session.flush()
+    PayloadHash.delete_for_relationships(deleted)
+    for model, cond in (
+            (Relationship2GroupRelationship,
+             Relationship2GroupRelationship.relationship_id.in_(deleted)),
+            (Relationship, Relationship.id.in_(deleted)),
+            (Identifier2Group,
+             Identifier2Group.identifier_id == duplicate.id),
+            (Identifier, Identifier.id == duplicate.id)):
+        model.query.filter(cond).delete(synchronize_session='fetch')
+
+
+def _dedup_batch(batch: List[Identifier]) -> Dict[str, int]:
+    """Backfill the hashes of a batch of identifiers, and commit."""
+    counts = dict(backfilled=0, merged=0)
+    by_hash = {}
+    for identifier in batch:
+        by_hash.setdefault(Identifier.compute_hash(
+            identifier.value, identifier.scheme), []).append(identifier)
+    hashed = {
+        i.value_hash: i for i in
+        Identifier.query.filter(Identifier.value_hash.in_(by_hash))}
+    for value_hash, identifiers in by_hash.items():
+        canonical = hashed.get(value_hash) or identifiers.pop(0)
+        for duplicate in identifiers:
+            merge_identifiers(canonical, duplicate)
+            counts['merged'] += 1
+        if not canonical.value_hash:
+            canonical.value_hash = value_hash
+            counts['backfilled'] += 1
+    db.session.commit()
+    return counts
+
+
+def dedup_identifiers(batch_size: int = None) -> Dict[str, int]:
+    """Backfill the hashes of the identifiers, merging the duplicates.
+
+    Identifiers without a hash are processed in batches (in the order of
+    their IDs), and each batch is committed. Identifiers with the same hash
+    as an already hashed identifier, or as another identifier of the batch,
+    are merged into it with :func:`merge_identifiers`.
+
+    :returns: The number of backfilled and merged identifiers.
+    """
+    batch_size = batch_size or \
+        current_app.config['ASCLEPIAS_GRAPH_BUILD_BATCH_SIZE']
+    counts = dict(backfilled=0, merged=0)
+    last_id = None
+    while True:
+        query = Identifier.query.filter(Identifier.value_hash.is_(None))
+        if last_id:
+            query = query.filter(Identifier.id > last_id)
+        batch = query.order_by(Identifier.id).limit(batch_size).all()
+        if not batch:
+            return counts
+        last_id = batch[-1].id
+        batch_counts = run_with_lock_retries(_dedup_batch, batch)
+        for key, count in batch_counts.items():
+            counts[key] += count
+        db.session.expunge_all()
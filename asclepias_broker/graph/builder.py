@@ -0,0 +1,599 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 CERN.
+#
+# Asclepias Broker is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Offline builder of the groups graph."""
+
+import csv
+import enum
+import io
+import json
+import uuid
+from datetime import datetime
+from typing import Dict, Iterable, Set, Tuple
+
+from flask import current_app
+from invenio_db import db
+from sqlalchemy import or_, select
+
+from ..core.models import Relation, Relationship
+from ..events.models import Event, ObjectEvent, PayloadType
+from ..metadata.models import GroupMetadata, GroupRelationshipMetadata
+from ..utils import chunks, is_postgresql
+from .cache import group_cache
+from .models import Group, GroupM2M, GroupRelationship, GroupRelationshipM2M, \
+    GroupType, Identifier2Group, Relationship2GroupRelationship
+
+# In foreign key order, i.e. the tables are loaded in this order and cleared
+# in the reverse one.
+GRAPH_MODELS = (
+    Group,
+    Identifier2Group,
+    GroupM2M,
+    GroupMetadata,
+    GroupRelationship,
+    GroupRelationshipMetadata,
+    Relationship2GroupRelationship,
+    GroupRelationshipM2M,
+)
+
+
+class UnionFind:
+    """Disjoint sets, with union by size and path halving."""
+
+    def __init__(self):
+        """Initialize the sets."""
+        self.parent = {}
+        self.size = {}
+
+    def find(self, x):
+        """Find the root of the set of ``x``, adding it if it is new."""
+        parent = self.parent
+        if x not in parent:
+            parent[x] = x
+            self.size[x] = 1
+            return x
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        """Join the sets of ``a`` and ``b``."""
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return a
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+        return a
+
+
+def find_version_root(edges: Iterable[Tuple[uuid.UUID, uuid.UUID]],
+                      default: uuid.UUID) -> uuid.UUID:
+    """Find the root Identity group of a Version group.
+
+    The root is found by walking up the ``HasVersion`` parents from the
+    source of the first of the ``(source, target)`` Identity group edges, so
+    that it does not depend on the order in which the groups were merged.
+
+    :param edges: The ``HasVersion`` edges between the Identity groups of
+        the Version group, in the order of their relationships.
+    :param default: The root if there are no edges.
+    """
+    parents = {}
+    group_id = None
+    for source_id, target_id in edges:
+        if source_id == target_id:
+            continue
+        if group_id is None:
+            group_id = source_id
+        parents.setdefault(target_id, source_id)
+    if group_id is None:
+        return default
+    seen = set()
+    while group_id in parents and group_id not in seen:
+        seen.add(group_id)
+        group_id = parents[group_id]
+    return group_id
+
+
+class GraphBuilder:
+    """Build all groups and group relationships from the relationships.
+
+    Replaces the incremental processing of the relationships through
+    :func:`~asclepias_broker.graph.api.update_groups` for initial imports
+    and disaster recovery. Identity groups are the connected components of
+    ``IsIdenticalTo``, and Version groups the components of ``HasVersion``
+    between Identity groups, both computed in memory with a union-find.
+    Group relationships between groups that end up merged are skipped, like
+    the merges of the incremental path delete them (which never adds group
+    relationships from a group to itself either).
+
+    The existing groups are replaced, and the search indices have to be
+    rebuilt afterwards.
+    """
+
+    def __init__(self, batch_size: int = None, metadata: bool = True):
+        """Initialize the builder.
+
+        :param batch_size: Number of rows streamed or loaded at once.
+        :param metadata: Replay the group metadata from the event payloads.
+        """
+        self.batch_size = batch_size or \
+            current_app.config['ASCLEPIAS_GRAPH_BUILD_BATCH_SIZE']
+        self.metadata = metadata
+        self.now = datetime.utcnow()
+        self.identity = UnionFind()
+        self.version = UnionFind()
+        # (relationship ID, source ID, target ID, relation)
+        self.links = []
+        self.version_links = []
+        self.identity_groups: Dict[uuid.UUID, uuid.UUID] = {}
+        self.version_groups: Dict[uuid.UUID, uuid.UUID] = {}
+        # (source group ID, target group ID, relation) -> relationship ID
+        self.group_relationships: Dict[tuple, uuid.UUID] = {}
+        self.identity_group_rels = []
+        self.rel2group_rels = []
+        # (version relationship ID, identity relationship ID)
+        self.group_rel_m2m = set()
+        self.group_metadata: Dict[uuid.UUID, GroupMetadata] = {}
+        self.relationship_metadata: \
+            Dict[uuid.UUID, GroupRelationshipMetadata] = {}
+
+    def _load_relationships(self):
+        """Stream the relationships and join the merged identifiers."""
+        rows = (db.session.query(
+            Relationship.id, Relationship.source_id, Relationship.target_id,
+            Relationship.relation).yield_per(self.batch_size))
+        for row in rows:
+            self._add_relationship(*row)
+        self._join_versions()
+
+    def _add_relationship(self, rel_id, source_id, target_id, relation):
+        if relation == Relation.IsIdenticalTo:
+            self.identity.union(source_id, target_id)
+        elif relation == Relation.HasVersion:
+            self.identity.find(source_id)
+            self.identity.find(target_id)
+            self.version_links.append(
+                (rel_id, source_id, target_id, relation))
+        else:
+            self.identity.find(source_id)
+            self.identity.find(target_id)
+            self.links.append((rel_id, source_id, target_id, relation))
+
+    def _join_versions(self):
+        """Join the Identity groups linked by ``HasVersion``."""
+        for _, source_id, target_id, _ in self.version_links:
+            self.version.union(self.identity.find(source_id),
+                               self.identity.find(target_id))
+
+    def identity_group(self, identifier_id: uuid.UUID) -> uuid.UUID:
+        """Get the Identity group ID of an identifier."""
+        root = self.identity.find(identifier_id)
+        if root not in self.identity_groups:
+            self.identity_groups[root] = uuid.uuid4()
+        return self.identity_groups[root]
+
+    def version_group(self, identifier_id: uuid.UUID) -> uuid.UUID:
+        """Get the Version group ID of an identifier."""
+        root = self.version.find(self.identity.find(identifier_id))
+        if root not in self.version_groups:
+            self.version_groups[root] = uuid.uuid4()
+        return self.version_groups[root]
+
+    def _row(self, **values) -> dict:
+        return dict(values, created=self.now, updated=self.now)
+
+    def _version_roots(self) -> Dict[uuid.UUID, uuid.UUID]:
+        """Find the root Identity group of each Version group.
+
+        See :func:`find_version_root`, Version groups without ``HasVersion``
+        relationships have a single Identity group.
+        """
+        edges = {}
+        for _, source_id, target_id, _ in self.version_links:
+            edges.setdefault(self.version_group(source_id), []).append(
+                (self.identity_group(source_id),
+                 self.identity_group(target_id)))
+        roots = {}
+        for root, group_id in self.identity_groups.items():
+            ver_group_id = self.version_group(root)
+            if ver_group_id not in roots:
+                roots[ver_group_id] = find_version_root(
+                    edges.get(ver_group_id, ()), group_id)
+        return roots
+
+    def _iter_groups(self) -> Iterable[dict]:
+        for identifier_id in self.identity.parent:
+            self.identity_group(identifier_id)
+            self.version_group(identifier_id)
+        for group_id in self.identity_groups.values():
+            yield self._row(id=group_id, type=GroupType.Identity,
+                            root_id=None)
+        roots = self._version_roots()
+        for group_id in self.version_groups.values():
+            yield self._row(id=group_id, type=GroupType.Version,
+                            root_id=roots[group_id])
+
+    def _iter_identifier2groups(self) -> Iterable[dict]:
+        for identifier_id in self.identity.parent:
+            yield self._row(identifier_id=identifier_id,
+                            group_id=self.identity_group(identifier_id))
+
+    def _iter_group_m2m(self) -> Iterable[dict]:
+        for root, group_id in self.identity_groups.items():
+            yield self._row(group_id=self.version_group(root),
+                            subgroup_id=group_id)
+
+    def _iter_group_metadata(self) -> Iterable[dict]:
+        for group_id in self.identity_groups.values():
+            meta = self.group_metadata.get(group_id)
+            yield self._row(group_id=group_id,
+                            json=meta.json if meta else {})
+
+    def _iter_group_relationships(self) -> Iterable[dict]:
+        """Generate the group relationships of the links.
+
+        Collects the relationships M2M rows on the way.
+        """
+        for rel_id, source_id, target_id, relation in self.links:
+            src_idg = self.identity_group(source_id)
+            tar_idg = self.identity_group(target_id)
+            if src_idg == tar_idg:
+                continue
+            key = (src_idg, tar_idg, relation)
+            id_grp_rel = self.group_relationships.get(key)
+            if not id_grp_rel:
+                id_grp_rel = self.group_relationships[key] = uuid.uuid4()
+                self.identity_group_rels.append(id_grp_rel)
+                yield self._row(id=id_grp_rel, type=GroupType.Identity,
+                                relation=relation, source_id=src_idg,
+                                target_id=tar_idg)
+            self.rel2group_rels.append(self._row(
+                relationship_id=rel_id, group_relationship_id=id_grp_rel))
+
+            src_vg = self.version_group(source_id)
+            tar_vg = self.version_group(target_id)
+            if src_vg == tar_vg:
+                continue
+            key = (src_vg, tar_vg, relation)
+            ver_grp_rel = self.group_relationships.get(key)
+            if not ver_grp_rel:
+                ver_grp_rel = self.group_relationships[key] = uuid.uuid4()
+                yield self._row(id=ver_grp_rel, type=GroupType.Version,
+                                relation=relation, source_id=src_vg,
+                                target_id=tar_vg)
+            self.group_rel_m2m.add((ver_grp_rel, id_grp_rel))
+
+    def _iter_group_relationship_metadata(self) -> Iterable[dict]:
+        for grp_rel_id in self.identity_group_rels:
+            meta = self.relationship_metadata.get(grp_rel_id)
+            yield self._row(group_relationship_id=grp_rel_id,
+                            json=meta.json if meta else [])
+
+    def _iter_group_relationship_m2m(self) -> Iterable[dict]:
+        for ver_grp_rel, id_grp_rel in self.group_rel_m2m:
+            yield self._row(relationship_id=ver_grp_rel,
+                            subrelationship_id=id_grp_rel)
+
+    def _relationship_payloads_query(self):
+        return (
+            db.session.query(ObjectEvent.event_id, ObjectEvent.object_uuid,
+                             ObjectEvent.payload_index)
+            .join(Event)
+            .filter(ObjectEvent.payload_type == PayloadType.Relationship)
+            .order_by(Event.created, ObjectEvent.event_id,
+                      ObjectEvent.payload_index))
+
+    def _iter_relationship_payloads(self):
+        """Stream the relationships with the payloads they come from."""
+        rows = self._relationship_payloads_query().yield_per(self.batch_size)
+        event_id, payloads = None, None
+        for row_event_id, rel_id, payload_index in rows:
+            if row_event_id != event_id:
+                event_id = row_event_id
+                payloads = Event.query.get(event_id).get_payload()
+            yield rel_id, payloads[payload_index]
+
+    def _replay_metadata(self):
+        """Apply the event payloads to the metadata of the groups.
+
+        Mirrors :func:`~asclepias_broker.metadata.api.\
+update_metadata_from_event` on transient metadata objects.
+        """
+        endpoints = {rel_id: (source_id, target_id, relation)
+                     for rel_id, source_id, target_id, relation
+                     in self.links + self.version_links}
+
+        for rel_id, payload in self._iter_relationship_payloads():
+            if rel_id not in endpoints:  # IsIdenticalTo
+                continue
+            source_id, target_id, relation = endpoints[rel_id]
+            src_idg = self.identity_group(source_id)
+            tar_idg = self.identity_group(target_id)
+            for group_id, data in ((src_idg, payload['Source']),
+                                   (tar_idg, payload['Target'])):
+                meta = self.group_metadata.setdefault(
+                    group_id, GroupMetadata(json={}))
+                meta.update(data)
+            grp_rel_id = self.group_relationships.get(
+                (src_idg, tar_idg, relation))
+            if grp_rel_id:
+                meta = self.relationship_metadata.setdefault(
+                    grp_rel_id, GroupRelationshipMetadata(json=[]))
+                meta.update({k: v for k, v in payload.items()
+                             if k in ('LinkPublicationDate', 'LinkProvider')})
+
+    def _clear(self):
+        """Delete the existing groups and group relationships."""
+        if is_postgresql():
+            tables = ', '.join(
+                f'"{m.__tablename__}"' for m in reversed(GRAPH_MODELS))
+            db.session.execute(f'TRUNCATE {tables}')
+        else:
+            for model in reversed(GRAPH_MODELS):
+                db.session.execute(model.__table__.delete())
+
+    @staticmethod
+    def _copy_value(value):
+        if value is None:
+            # Written as an unquoted empty string, i.e. NULL
+            return None
+        if isinstance(value, enum.Enum):
+            return value.name
+        if isinstance(value, (dict, list)):
+            return json.dumps(value)
+        return str(value)
+
+    def _load(self, model, rows: Iterable[dict]) -> int:
+        """Bulk-load rows, with ``COPY`` on PostgreSQL.
+
+        :returns: The number of loaded rows.
+        """
+        table = model.__table__
+        count = 0
+        for batch in chunks(rows, self.batch_size):
+            count += len(batch)
+            if not is_postgresql():
+                db.session.execute(table.insert(), list(batch))
+                continue
+            columns = list(batch[0])
+            column_list = ', '.join(f'"{c}"' for c in columns)
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for row in batch:
+                writer.writerow([self._copy_value(row[c]) for c in columns])
+            buffer.seek(0)
+            cursor = db.session.connection().connection.cursor()
+            try:
+                cursor.copy_expert(
+                    f'COPY "{table.name}" ({column_list}) '
+                    'FROM STDIN WITH (FORMAT csv)', buffer)
+            finally:
+                cursor.close()
+        return count
+
+    def build(self) -> Dict[str, int]:
+        """Build and load the graph, in a single transaction.
+
+        :returns: Number of loaded rows per table.
+        """
+        self._load_relationships()
+        group_relationships = list(self._iter_group_relationships())
+        groups = list(self._iter_groups())
+        if self.metadata:
+            self._replay_metadata()
+
+        self._clear()
+        counts = self._write(groups, group_relationships)
+        db.session.commit()
+        group_cache.clear()
+        return counts
+
+    def _write(self, groups: list,
+               group_relationships: list) -> Dict[str, int]:
+        """Load the built rows, returning the number of rows per table."""
+        counts = {}
+        loaders = [
+            (Group, groups),
+            (Identifier2Group, self._iter_identifier2groups()),
+            (GroupM2M, self._iter_group_m2m()),
+            (GroupMetadata, self._iter_group_metadata()),
+            (GroupRelationship, group_relationships),
+            (GroupRelationshipMetadata,
+             self._iter_group_relationship_metadata()),
+            (Relationship2GroupRelationship, self.rel2group_rels),
+            (GroupRelationshipM2M, self._iter_group_relationship_m2m()),
+        ]
+        for model, rows in loaders:
+            counts[model.__tablename__] = self._load(model, rows)
+        return counts
+
+
+def build_graph(batch_size: int = None,
+                metadata: bool = True) -> Dict[str, int]:
+    """Rebuild all groups from the relationships with the offline builder."""
+    return GraphBuilder(batch_size=batch_size, metadata=metadata).build()
+
+
+class ComponentBuilder(GraphBuilder):
+    """Rebuild the groups of a single Version group.
+
+    Used after deleting ``IsIdenticalTo`` or ``HasVersion`` relationships,
+    which might split the Version group and its Identity groups. Only the
+    identifiers of the Version group and their relationships are loaded,
+    while the other identifiers keep their groups. All the parts of a split
+    Version group get new groups, and its old groups are deleted.
+    """
+
+    def __init__(self, version_group_id: uuid.UUID, batch_size: int = None,
+                 metadata: bool = True):
+        """Initialize the builder.
+
+        :param version_group_id: ID of the Version group to rebuild.
+        """
+        super().__init__(batch_size=batch_size, metadata=metadata)
+        self.version_group_id = version_group_id
+        # Identifier ID -> current Identity group ID
+        self.old_groups: Dict[uuid.UUID, uuid.UUID] = {}
+        # Identifier ID -> (Identity group ID, Version group ID), of the
+        # identifiers outside the Version group
+        self.outside_groups: Dict[uuid.UUID, tuple] = {}
+
+    def _members_query(self):
+        return (
+            db.session.query(Identifier2Group.identifier_id,
+                             Identifier2Group.group_id)
+            .join(GroupM2M, GroupM2M.subgroup_id == Identifier2Group.group_id)
+            .filter(GroupM2M.group_id == self.version_group_id))
+
+    def _relationships_query(self, *columns):
+        member_ids = self._members_query().with_entities(
+            Identifier2Group.identifier_id)
+        return db.session.query(*columns).filter(or_(
+            Relationship.source_id.in_(member_ids),
+            Relationship.target_id.in_(member_ids)))
+
+    def _load_relationships(self):
+        """Stream the relationships from and to the Version group."""
+        for identifier_id, group_id in \
+                self._members_query().yield_per(self.batch_size):
+            self.old_groups[identifier_id] = group_id
+            self.identity.find(identifier_id)
+        rows = self._relationships_query(
+            Relationship.id, Relationship.source_id, Relationship.target_id,
+            Relationship.relation).yield_per(self.batch_size)
+        outside = set()
+        for row in rows:
+            self._add_relationship(*row)
+            outside.update(
+                i for i in row[1:3] if i not in self.old_groups)
+        self._join_versions()
+        for batch in chunks(outside, self.batch_size):
+            rows = (
+                db.session.query(Identifier2Group.identifier_id,
+                                 Identifier2Group.group_id, GroupM2M.group_id)
+                .join(GroupM2M,
+                      GroupM2M.subgroup_id == Identifier2Group.group_id)
+                .filter(Identifier2Group.identifier_id.in_(batch)))
+            for identifier_id, id_group_id, ver_group_id in rows:
+                self.outside_groups[identifier_id] = \
+                    (id_group_id, ver_group_id)
+
+    def _add_relationship(self, rel_id, source_id, target_id, relation):
+        if source_id in self.old_groups and target_id in self.old_groups:
+            super()._add_relationship(rel_id, source_id, target_id, relation)
+        elif relation not in (Relation.IsIdenticalTo, Relation.HasVersion):
+            self.links.append((rel_id, source_id, target_id, relation))
+
+    def identity_group(self, identifier_id: uuid.UUID) -> uuid.UUID:
+        """Get the Identity group ID of an identifier."""
+        if identifier_id in self.outside_groups:
+            return self.outside_groups[identifier_id][0]
+        return super().identity_group(identifier_id)
+
+    def version_group(self, identifier_id: uuid.UUID) -> uuid.UUID:
+        """Get the Version group ID of an identifier."""
+        if identifier_id in self.outside_groups:
+            return self.outside_groups[identifier_id][1]
+        return super().version_group(identifier_id)
+
+    def _split_groups(self) -> bool:
+        """Check if any group was split, else keep the IDs of the groups.
+
+        The parts of a split group all get new groups, so that the old
+        groups are deleted and never reused by the caches of the workers.
+
+        :returns: ``True`` if any group was split.
+        """
+        parts = {}
+        for identifier_id in self.old_groups:
+            root = self.identity.find(identifier_id)
+            parts.setdefault(self.old_groups[root], set()).add(root)
+        roots = {self.version.find(root)
+                 for roots in parts.values() for root in roots}
+        if len(roots) > 1 or sum(map(len, parts.values())) > len(parts):
+            return True
+        for group_id, (root, ) in parts.items():
+            self.identity_groups[root] = group_id
+        self.version_groups[roots.pop()] = self.version_group_id
+        return False
+
+    def _relationship_payloads_query(self):
+        rel_ids = self._relationships_query(Relationship.id)
+        return super()._relationship_payloads_query().filter(
+            ObjectEvent.object_uuid.in_(rel_ids))
+
+    def _clear(self):
+        """Delete the groups and group relationships of the component."""
+        id_group_ids = list(set(self.old_groups.values()))
+        group_ids = id_group_ids + [self.version_group_id]
+        grp_rel_cond = or_(GroupRelationship.source_id.in_(group_ids),
+                           GroupRelationship.target_id.in_(group_ids))
+        grp_rel_ids = select([GroupRelationship.id]).where(grp_rel_cond)
+        deletes = [
+            (GroupRelationshipM2M, or_(
+                GroupRelationshipM2M.relationship_id.in_(grp_rel_ids),
+                GroupRelationshipM2M.subrelationship_id.in_(grp_rel_ids))),
+            (Relationship2GroupRelationship,
+             Relationship2GroupRelationship.group_relationship_id.in_(
+                 grp_rel_ids)),
+            (GroupRelationshipMetadata,
+             GroupRelationshipMetadata.group_relationship_id.in_(
+                 grp_rel_ids)),
+            (GroupRelationship, grp_rel_cond),
+            (GroupMetadata, GroupMetadata.group_id.in_(id_group_ids)),
+            (GroupM2M, GroupM2M.group_id == self.version_group_id),
+            (Identifier2Group, Identifier2Group.group_id.in_(id_group_ids)),
+            (Group, Group.id.in_(group_ids)),
+        ]
+        for model, cond in deletes:
+            db.session.execute(model.__table__.delete().where(cond))
+
+    def build(self) -> Tuple[Set[str], Set[str], Set[str], Set[str],
+                             Dict[str, str]]:
+        """Rebuild the Version group, without committing.
+
+        :returns: The groups to index and delete, like
+            :func:`~asclepias_broker.graph.tasks.compact_indexing_groups`.
+        """
+        db.session.flush()
+        self._load_relationships()
+        if not self.old_groups:
+            return set(), set(), set(), set(), {}
+        split = self._split_groups()
+        old_group_ids = set(self.old_groups.values())
+        if split:
+            group_relationships = list(self._iter_group_relationships())
+            groups = list(self._iter_groups())
+            if self.metadata:
+                self._replay_metadata()
+            self._clear()
+            self._write(groups, group_relationships)
+        else:
+            # Only the root of the Version group might have changed
+            root_id = self._version_roots()[self.version_group_id]
+            (Group.query.filter(Group.id == self.version_group_id)
+             .update({Group.root_id: root_id}, synchronize_session=False))
+        db.session.expire_all()
+        group_cache.invalidate_groups(
+            old_group_ids | {self.version_group_id})
+
+        if not split:
+            return set(), set(), {str(self.version_group_id)}, set(), {}
+        ig_to_vg_map = {
+            str(group_id): str(self.version_group(root))
+            for root, group_id in self.identity_groups.items()}
+        return (
+            set(ig_to_vg_map),
+            {str(g) for g in old_group_ids},
+            set(ig_to_vg_map.values()),
+            {str(self.version_group_id)},
+            ig_to_vg_map,
+        )
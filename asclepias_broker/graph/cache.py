@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 CERN.
+#
+# Asclepias Broker is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Per-worker cache of the groups of identifiers."""
+
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+from uuid import UUID
+
+from flask import current_app
+from invenio_db import db
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+GroupIDs = Tuple[UUID, UUID]
+
+
+class GroupCache:
+    """LRU cache of identifier ID to (Identity group ID, Version group ID).
+
+    Entries resolved inside a transaction are kept pending in the session
+    until the transaction is committed, and dropped if any (nested)
+    transaction is rolled back, so that groups that were never committed are
+    not cached. Invalidating groups removes both the pending and the
+    committed entries.
+
+    Cached groups might have been merged by another worker in the meantime.
+    Hits are trusted, and the committed entries used by a transaction are
+    remembered, so that they can be dropped with :meth:`discard_used` if the
+    transaction fails on a group that no longer exists.
+    """
+
+    _pending_key = 'asclepias_broker_group_cache'
+    _used_key = 'asclepias_broker_group_cache_used'
+
+    def __init__(self, maxsize: int = None):
+        """Initialize the cache.
+
+        :param maxsize: Number of entries, by default the
+            ``ASCLEPIAS_GRAPH_GROUP_CACHE_SIZE`` config variable.
+        """
+        self._maxsize = maxsize
+        self._entries: Dict[UUID, GroupIDs] = OrderedDict()
+        # Group ID -> IDs of the identifiers with an entry for the group
+        self._by_group: Dict[UUID, set] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def maxsize(self) -> int:
+        """Maximum number of entries, 0 if the cache is disabled."""
+        if self._maxsize is None:
+            return current_app.config['ASCLEPIAS_GRAPH_GROUP_CACHE_SIZE']
+        return self._maxsize
+
+    def _pending(self, session=None) -> Dict[UUID, GroupIDs]:
+        info = (session or db.session).info
+        return info.setdefault(self._pending_key, {})
+
+    def get(self, identifier_id: UUID) -> Optional[GroupIDs]:
+        """Get the cached group IDs of an identifier."""
+        if not self.maxsize or identifier_id is None:
+            return None
+        groups = self._pending().get(identifier_id) or \
+            self._entries.get(identifier_id)
+        if groups:
+            if identifier_id in self._entries:
+                self._entries.move_to_end(identifier_id)
+                db.session.info.setdefault(
+                    self._used_key, set()).add(identifier_id)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return groups
+
+    def set(self, identifier_id: UUID, groups: GroupIDs):
+        """Cache the group IDs of an identifier, once committed."""
+        if self.maxsize and identifier_id is not None:
+            self._pending()[identifier_id] = groups
+
+    def _add(self, identifier_id: UUID, groups: GroupIDs):
+        self._discard(identifier_id)
+        self._entries[identifier_id] = groups
+        for group_id in groups:
+            self._by_group.setdefault(group_id, set()).add(identifier_id)
+        while len(self._entries) > self.maxsize:
+            self._discard(next(iter(self._entries)))
+
+    def _discard(self, identifier_id: UUID):
+        groups = self._entries.pop(identifier_id, None)
+        for group_id in groups or ():
+            identifiers = self._by_group.get(group_id)
+            if identifiers is not None:
+                identifiers.discard(identifier_id)
+                if not identifiers:
+                    del self._by_group[group_id]
+
+    def invalidate_groups(self, group_ids: Iterable[UUID]):
+        """Remove the entries of groups, e.g. when they are merged."""
+        group_ids = set(group_ids)
+        for group_id in group_ids:
+            for identifier_id in list(self._by_group.get(group_id, ())):
+                self._discard(identifier_id)
+                self.invalidations += 1
+        pending = self._pending()
+        for identifier_id, groups in list(pending.items()):
+            if group_ids.intersection(groups):
+                del pending[identifier_id]
+                self.invalidations += 1
+
+    def discard_used(self, session=None):
+        """Remove the committed entries used since the last commit.
+
+        Called when a transaction failed on a stale entry, e.g. with a
+        foreign key violation on a group merged by another worker.
+        """
+        used = (session or db.session).info.pop(self._used_key, ())
+        for identifier_id in used:
+            if identifier_id in self._entries:
+                self._discard(identifier_id)
+                self.invalidations += 1
+
+    def clear(self):
+        """Remove all the entries."""
+        self._entries.clear()
+        self._by_group.clear()
+        self._pending().clear()
+
+    def stats(self) -> dict:
+        """Hit/miss statistics of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+    def on_commit(self, session):
+        """Move the entries of the committed transaction to the cache."""
+        transaction = session.transaction
+        if transaction is not None and transaction.parent is not None:
+            # A savepoint, whose changes can still be rolled back
+            return
+        session.info.pop(self._used_key, None)
+        pending = session.info.pop(self._pending_key, None)
+        if pending and self.maxsize:
+            for identifier_id, groups in pending.items():
+                self._add(identifier_id, groups)
+
+    def on_rollback(self, session, previous_transaction):
+        """Drop the entries of the rolled back transaction."""
+        session.info.pop(self._pending_key, None)
+
+
+#: Cache of the current worker
+group_cache = GroupCache()
+
+# Listening on the class also covers sessions created after the import
+event.listen(Session, 'after_commit', group_cache.on_commit)
+event.listen(Session, 'after_soft_rollback', group_cache.on_rollback)
@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 CERN.
+#
+# Asclepias Broker is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Consistency checks of the groups graph.
+
+Each check is a query of the rows violating an invariant of the groups,
+which the database evaluates with anti-joins or aggregations. Violations are
+streamed (with server-side cursors on PostgreSQL) and repaired in batches,
+so that checking runs in bounded memory regardless of the size of the
+tables.
+
+The repairs do not update the search index, so the relationships have to be
+reindexed after repairing (e.g. with ``asclepias-broker search reindex``).
+"""
+
+import json
+import uuid
+from typing import Callable, Dict, Iterable, Iterator, List, TextIO
+
+from flask import current_app
+from invenio_db import db
+from sqlalchemy import and_, exists, func, or_
+from sqlalchemy.orm import aliased
+
+from ..core.models import Identifier, Relation, Relationship
+from ..metadata.models import GroupMetadata, GroupRelationshipMetadata
+from .api import _delete_empty_group_relationships, \
+    _delete_group_relationships, get_or_create_groups, merge_identity_groups, \
+    update_groups
+from .cache import group_cache
+from .models import Group, GroupM2M, GroupRelationship, GroupRelationshipM2M, \
+    GroupType, Identifier2Group, Relationship2GroupRelationship
+
+
+class Check:
+    """An invariant of the groups, checked by a query of its violations.
+
+    The first column of the query is the key of the violations, by which
+    they are ordered and paginated.
+    """
+
+    def __init__(self, name: str, key, query: Callable,
+                 repair: Callable[[List], None] = None):
+        """Initialize the check.
+
+        :param key: Column of the key of the violations.
+        :param query: Function returning the query of the violations.
+        :param repair: Function repairing a batch of violations.
+        """
+        self.name = name
+        self.key = key
+        self.query = query
+        self.repair = repair
+
+    @property
+    def description(self) -> str:
+        """Description of the violations."""
+        return self.query.__doc__
+
+    def __repr__(self):
+        """String representation of the check."""
+        return f'<Check {self.name}>'
+
+
+def _identifiers_without_identity_group():
+    """Identifiers without an Identity group."""
+    return db.session.query(Identifier.id.label('identifier_id')).filter(
+        ~exists().where(Identifier2Group.identifier_id == Identifier.id))
+
+
+def _identity_groups_without_version_group():
+    """Identity groups without a Version group."""
+    return db.session.query(Group.id.label('group_id')).filter(
+        Group.type == GroupType.Identity,
+        ~exists().where(GroupM2M.subgroup_id == Group.id))
+
+
+def _identifiers_in_many_identity_groups():
+    """Identifiers in more than one Identity group."""
+    return (
+        db.session.query(Identifier2Group.identifier_id,
+                         func.count().label('groups'))
+        .group_by(Identifier2Group.identifier_id)
+        .having(func.count() > 1))
+
+
+def _empty_identity_groups():
+    """Identity groups without identifiers."""
+    return db.session.query(Group.id.label('group_id')).filter(
+        Group.type == GroupType.Identity,
+        ~exists().where(Identifier2Group.group_id == Group.id))
+
+
+def _empty_version_groups():
+    """Version groups without Identity groups."""
+    return db.session.query(Group.id.label('group_id')).filter(
+        Group.type == GroupType.Version,
+        ~exists().where(GroupM2M.group_id == Group.id))
+
+
+def _identity_groups_without_metadata():
+    """Identity groups without metadata."""
+    return db.session.query(Group.id.label('group_id')).filter(
+        Group.type == GroupType.Identity,
+        ~exists().where(GroupMetadata.group_id == Group.id))
+
+
+def _orphaned_group_metadata():
+    """Metadata of missing Identity groups."""
+    return db.session.query(GroupMetadata.group_id).filter(
+        ~exists().where(and_(Group.id == GroupMetadata.group_id,
+                             Group.type == GroupType.Identity)))
+
+
+def _dangling_group_relationships():
+    """Group relationships from or to missing groups."""
+    source, target = aliased(Group), aliased(Group)
+    return db.session.query(
+        GroupRelationship.id.label('group_relationship_id')).filter(or_(
+            ~exists().where(source.id == GroupRelationship.source_id),
+            ~exists().where(target.id == GroupRelationship.target_id)))
+
+
+def _identity_group_relationships_without_relationships():
+    """Identity group relationships without relationships."""
+    return db.session.query(
+        GroupRelationship.id.label('group_relationship_id')).filter(
+            GroupRelationship.type == GroupType.Identity,
+            ~exists().where(
+                Relationship2GroupRelationship.group_relationship_id ==
+                GroupRelationship.id))
+
+
+def _version_group_relationships_without_subrelationships():
+    """Version group relationships without Identity group relationships."""
+    return db.session.query(
+        GroupRelationship.id.label('group_relationship_id')).filter(
+            GroupRelationship.type == GroupType.Version,
+            ~exists().where(
+                GroupRelationshipM2M.relationship_id == GroupRelationship.id))
+
+
+def _identity_group_relationships_without_metadata():
+    """Identity group relationships without metadata."""
+    return db.session.query(
+        GroupRelationship.id.label('group_relationship_id')).filter(
+            GroupRelationship.type == GroupType.Identity,
+            ~exists().where(
+                GroupRelationshipMetadata.group_relationship_id ==
+                GroupRelationship.id))
+
+
+def _orphaned_group_relationship_metadata():
+    """Metadata of missing Identity group relationships."""
+    return db.session.query(
+        GroupRelationshipMetadata.group_relationship_id).filter(
+            ~exists().where(and_(
+                GroupRelationship.id ==
+                GroupRelationshipMetadata.group_relationship_id,
+                GroupRelationship.type == GroupType.Identity)))
+
+
+def _relationships_without_group_relationship():
+    """Relationships between different Identity groups, not grouped."""
+    src_id2g, tar_id2g = aliased(Identifier2Group), aliased(Identifier2Group)
+    return (
+        db.session.query(Relationship.id.label('relationship_id'))
+        .join(src_id2g, src_id2g.identifier_id == Relationship.source_id)
+        .join(tar_id2g, tar_id2g.identifier_id == Relationship.target_id)
+        .filter(
+            Relationship.relation.notin_(
+                [Relation.IsIdenticalTo, Relation.HasVersion]),
+            src_id2g.group_id != tar_id2g.group_id,
+            ~exists().where(
+                Relationship2GroupRelationship.relationship_id ==
+                Relationship.id))
+        .distinct())
+
+
+def _create_identity_groups(rows):
+    for row in rows:
+        get_or_create_groups(Identifier.query.get(row.identifier_id))
+
+
+def _create_version_groups(rows):
+    for row in rows:
+        ver_grp = Group(type=GroupType.Version, id=uuid.uuid4(),
+                        root_id=row.group_id)
+        db.session.add(ver_grp)
+        db.session.add(GroupM2M(group=ver_grp, subgroup_id=row.group_id))
+
+
+def _merge_identity_groups(rows):
+    for row in rows:
+        groups = [id2g.group for id2g in Identifier2Group.query.filter_by(
+            identifier_id=row.identifier_id)]
+        merged_group = groups[0]
+        for group in groups[1:]:
+            merged_group = \
+                merge_identity_groups(merged_group, group)[0] or merged_group
+
+
+def _delete_groups(rows):
+    group_ids = [row.group_id for row in rows]
+    _delete_group_relationships([
+        id_ for id_, in db.session.query(GroupRelationship.id).filter(or_(
+            GroupRelationship.source_id.in_(group_ids),
+            GroupRelationship.target_id.in_(group_ids)))])
+    (Group.query.filter(Group.root_id.in_(group_ids))
+     .update({Group.root_id: None}, synchronize_session=False))
+    for model, cond in (
+            (GroupM2M, GroupM2M.group_id.in_(group_ids) |
+             GroupM2M.subgroup_id.in_(group_ids)),
+            (GroupMetadata, GroupMetadata.group_id.in_(group_ids)),
+            (Group, Group.id.in_(group_ids))):
+        model.query.filter(cond).delete(synchronize_session=False)
+    group_cache.invalidate_groups(group_ids)
+
+
+def _create_group_metadata(rows):
+    db.session.execute(GroupMetadata.__table__.insert(), [
+        dict(group_id=row.group_id, json={}) for row in rows])
+
+
+def _delete_group_metadata(rows):
+    GroupMetadata.query.filter(GroupMetadata.group_id.in_(
+        [row.group_id for row in rows])).delete(synchronize_session=False)
+
+
+def _delete_dangling_group_relationships(rows):
+    _delete_group_relationships([row.group_relationship_id for row in rows])
+
+
+def _delete_empty_identity_group_relationships(rows):
+    _delete_empty_group_relationships(
+        [row.group_relationship_id for row in rows])
+
+
+def _create_group_relationship_metadata(rows):
+    db.session.execute(GroupRelationshipMetadata.__table__.insert(), [
+        dict(group_relationship_id=row.group_relationship_id, json=[])
+        for row in rows])
+
+
+def _delete_group_relationship_metadata(rows):
+    GroupRelationshipMetadata.query.filter(
+        GroupRelationshipMetadata.group_relationship_id.in_(
+            [row.group_relationship_id for row in rows])
+    ).delete(synchronize_session=False)
+
+
+def _update_relationship_groups(rows):
+    for row in rows:
+        update_groups(Relationship.query.get(row.relationship_id))
+
+
+#: Checks, in the order they are run and repaired
+CHECKS = [
+    Check('identifier_without_identity_group', Identifier.id,
+          _identifiers_without_identity_group, _create_identity_groups),
+    Check('empty_identity_group', Group.id, _empty_identity_groups,
+          _delete_groups),
+    Check('identity_group_without_version_group', Group.id,
+          _identity_groups_without_version_group, _create_version_groups),
+    Check('identifier_in_many_identity_groups',
+          Identifier2Group.identifier_id,
+          _identifiers_in_many_identity_groups, _merge_identity_groups),
+    Check('empty_version_group', Group.id, _empty_version_groups,
+          _delete_groups),
+    Check('identity_group_without_metadata', Group.id,
+          _identity_groups_without_metadata, _create_group_metadata),
+    Check('orphaned_group_metadata', GroupMetadata.group_id,
+          _orphaned_group_metadata, _delete_group_metadata),
+    Check('dangling_group_relationship', GroupRelationship.id,
+          _dangling_group_relationships,
+          _delete_dangling_group_relationships),
+    Check('identity_group_relationship_without_relationships',
+          GroupRelationship.id,
+          _identity_group_relationships_without_relationships,
+          _delete_empty_identity_group_relationships),
+    Check('version_group_relationship_without_subrelationships',
+          GroupRelationship.id,
+          _version_group_relationships_without_subrelationships,
+          _delete_dangling_group_relationships),
+    Check('identity_group_relationship_without_metadata',
+          GroupRelationship.id,
+          _identity_group_relationships_without_metadata,
+          _create_group_relationship_metadata),
+    Check('orphaned_group_relationship_metadata',
+          GroupRelationshipMetadata.group_relationship_id,
+          _orphaned_group_relationship_metadata,
+          _delete_group_relationship_metadata),
+    Check('relationship_without_group_relationship', Relationship.id,
+          _relationships_without_group_relationship,
+          _update_relationship_groups),
+]
+
+
+class GraphChecker:
+    """Run consistency checks, reporting violations as JSON lines.
+
+    Each violation is written as ``{"check": ..., "violation": {...}}``, and
+    each check ends with ``{"check": ..., "violations": ..., "repaired":
+    ..., "remaining": ...}``, where the remaining violations are checked
+    again after repairing.
+    """
+
+    def __init__(self, checks: Iterable[str] = None, batch_size: int = None):
+        """Initialize the checker.
+
+        :param checks: Names of the checks to run, by default all of them.
+        :param batch_size: Number of violations streamed or repaired at once.
+        """
+        self.checks = [c for c in CHECKS if not checks or c.name in checks]
+        self.batch_size = batch_size or \
+            current_app.config['ASCLEPIAS_GRAPH_CHECK_BATCH_SIZE']
+
+    def iter_violations(self, check: Check) -> Iterator[dict]:
+        """Stream the violations of a check."""
+        rows = check.query().order_by(check.key).yield_per(self.batch_size)
+        for row in rows:
+            yield row._asdict()
+
+    def count_violations(self, check: Check) -> int:
+        """Count the violations of a check."""
+        return check.query().order_by(None).count()
+
+    def repair(self, check: Check) -> int:
+        """Repair the violations of a check, committing each batch.
+
+        Batches are paginated by key, so that violations that cannot be
+        repaired are not retried.
+
+        :returns: The number of violations the repair was run on.
+        """
+        repaired = 0
+        last_key = None
+        while True:
+            query = check.query()
+            if last_key is not None:
+                query = query.filter(check.key > last_key)
+            rows = query.order_by(check.key).limit(self.batch_size).all()
+            if not rows:
+                return repaired
+            check.repair(rows)
+            db.session.commit()
+            repaired += len(rows)
+            last_key = rows[-1][0]
+
+    def run(self, output: TextIO, repair: bool = False) -> Dict[str, dict]:
+        """Run the checks, writing the report to ``output``.
+
+        :param repair: Repair the violations after reporting them.
+        :returns: The number of violations, repaired and remaining violations
+            per check.
+        """
+        summary = {}
+        for check in self.checks:
+            violations = 0
+            for violation in self.iter_violations(check):
+                violations += 1
+                output.write(json.dumps(
+                    {'check': check.name, 'violation': violation},
+                    default=str) + '\n')
+            # The transaction is ended, closing the server-side cursor
+            db.session.commit()
+            remaining = violations
+            if repair and violations and check.repair:
+                self.repair(check)
+                remaining = self.count_violations(check)
+                db.session.commit()
+            summary[check.name] = dict(
+                violations=violations,
+                repaired=max(violations - remaining, 0),
+                remaining=remaining)
+            output.write(json.dumps(
+                dict(check=check.name, **summary[check.name])) + '\n')
+        return summary
+
+
+def check_graph(output: TextIO, checks: Iterable[str] = None,
+                repair: bool = False,
+                batch_size: int = None) -> Dict[str, dict]:
+    """Check the consistency of the groups graph."""
+    return GraphChecker(checks=checks, batch_size=batch_size).run(
+        output, repair=repair)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 CERN.
+#
+# Asclepias Broker is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Graph CLI."""
+
+from __future__ import absolute_import, print_function
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from ..core.models import Identifier, Relation, Relationship
+from .api import dedup_identifiers
+from .builder import build_graph
+from .check import CHECKS, check_graph
+from .export import export_graph
+from .indexes import EXPLAINED_QUERIES, create_columns, create_indexes, \
+    explain_queries
+from .models import GroupType
+from .tasks import remove_relationship
+
+
+@click.group()
+def graph():
+    """Graph CLI commands."""
+
+
+@graph.command('build')
+@click.option('--batch-size', type=int, default=None,
+              help='Number of rows streamed or loaded at once.')
+@click.option('--metadata/--no-metadata', default=True,
+              help='Replay the group metadata from the event payloads.')
+@click.confirmation_option(
+    prompt='Are you sure you want to rebuild all groups?')
+@with_appcontext
+def build(batch_size=None, metadata=True):
+    """Rebuild all groups from the relationships."""
+    counts = build_graph(batch_size=batch_size, metadata=metadata)
+    for table, count in counts.items():
+        click.echo(f'{table}: {count}')
+    click.secho('Groups have been rebuilt, the search indices need to be '
+                'reindexed.', fg='green')
+
+
+@graph.command('delete-relationship')
+@click.argument('source')
+@click.argument('relation', type=click.Choice([r.name for r in Relation]))
+@click.argument('target')
+@click.option('--source-scheme', default='doi')
+@click.option('--target-scheme', default='doi')
+@click.option('--no-index', default=False, is_flag=True)
+@with_appcontext
+def delete_relationship(source, relation, target, source_scheme='doi',
+                        target_scheme='doi', no_index=False):
+    """Delete a relationship, splitting the groups it merged."""
+    src = Identifier.get(source, source_scheme)
+    tar = Identifier.get(target, target_scheme)
+    relationship = src and tar and \
+        Relationship.get(src, tar, Relation[relation])
+    if not relationship:
+        raise click.ClickException('Relationship not found.')
+    indexing_enabled = not no_index and \
+        current_app.config['ASCLEPIAS_SEARCH_INDEXING_ENABLED']
+    idx_ig, del_ig, idx_vg, del_vg, _ = remove_relationship(
+        relationship, indexing_enabled=indexing_enabled)
+    click.echo(f'Groups updated: {len(idx_ig) + len(idx_vg)}, '
+               f'deleted: {len(del_ig) + len(del_vg)}')
+
+
+@graph.command('check')
+@click.option('--repair', default=False, is_flag=True,
+              help='Repair the violations after reporting them.')
+@click.option('--output', '-o', type=click.File('w'), default='-',
+              help='File of the JSON lines report (default stdout).')
+@click.option('--check', 'checks', multiple=True,
+              type=click.Choice([c.name for c in CHECKS]),
+              help='Check to run (default all).')
+@click.option('--batch-size', type=int, default=None,
+              help='Number of violations streamed or repaired at once.')
+@with_appcontext
+def check(repair=False, output=None, checks=None, batch_size=None):
+    """Check the consistency of the groups.
+
+    Exits with status 1 if violations remain after the repairs. Repairs do
+    not update the search index, which has to be rebuilt afterwards with
+    ``search reindex``.
+    """
+    summary = check_graph(output, checks=checks, repair=repair,
+                          batch_size=batch_size)
+    if repair and any(s['repaired'] for s in summary.values()):
+        click.echo('Reindex the relationships with "search reindex".',
+                   err=True)
+    if sum(s['remaining'] for s in summary.values()):
+        raise SystemExit(1)
+
+
+@graph.command('export')
+@click.argument('output_dir', type=click.Path(file_okay=False))
+@click.option('--group-type', 'group_types', multiple=True,
+              type=click.Choice([t.name for t in GroupType]),
+              help='Type of the groups to export (default all).')
+@click.option('--batch-size', type=int, default=None,
+              help='Number of rows streamed at once.')
+@with_appcontext
+def export(output_dir, group_types=None, batch_size=None):
+    """Export the group graphs as CSR arrays of .npy files."""
+    try:
+        manifest = export_graph(
+            output_dir, [GroupType[t] for t in group_types],
+            batch_size=batch_size)
+    except RuntimeError as exc:
+        raise click.ClickException(str(exc))
+    for name, counts in manifest['graphs'].items():
+        click.echo(f'{name}: {counts["nodes"]} nodes, '
+                   f'{counts["edges"]} edges')
+
+
+def _echo_created_columns(result):
+    for name in result['tables']:
+        click.echo(f'Created table {name}')
+    for name in result['columns']:
+        click.echo(f'Created column {name}')
+
+
+@graph.command('create-indexes')
+@click.option('--drop-superseded', default=False, is_flag=True,
+              help='Drop the indexes replaced by valid composite indexes.')
+@with_appcontext
+def create_indexes_command(drop_superseded=False):
+    """Create the missing indexes of the grouping tables.
+
+    Writes to a table are blocked while its indexes are built. Missing
+    tables and columns are created first.
+    """
+    result = create_indexes(drop_superseded=drop_superseded)
+    _echo_created_columns(result)
+    for name in result['created']:
+        click.echo(f'Created {name}')
+    for name in result['dropped']:
+        click.echo(f'Dropped {name}')
+
+
+@graph.command('explain')
+@click.argument('queries', nargs=-1,
+                type=click.Choice(sorted(EXPLAINED_QUERIES)))
+@click.option('--analyze', default=False, is_flag=True,
+              help='Run the queries to report their actual costs.')
+@with_appcontext
+def explain(queries=None, analyze=False):
+    """Print the query plans of the hot grouping and indexing queries."""
+    for name, plan in explain_queries(queries, analyze=analyze).items():
+        click.secho(name, bold=True)
+        for line in plan:
+            click.echo(f'  {line}')
+
+
+@graph.command('dedup-identifiers')
+@click.option('--batch-size', type=int, default=None,
+              help='Number of identifiers backfilled at once.')
+@with_appcontext
+def dedup_identifiers_command(batch_size=None):
+    """Backfill the identifier hashes, merging the duplicate identifiers.
+
+    The hash column and its unique index are created first, if missing.
+    """
+    result = create_columns()
+    _echo_created_columns(result)
+    for name in result['indexes']:
+        click.echo(f'Created {name}')
+    counts = dedup_identifiers(batch_size=batch_size)
+    click.echo(f'{counts["backfilled"]} identifiers backfilled, '
+               f'{counts["merged"]} duplicates merged')
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 CERN.
+#
+# Asclepias Broker is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Export of the groups graph as compressed sparse row (CSR) arrays.
+
+For each group type, the following memory-mappable ``.npy`` files are
+written (e.g. for Identity groups):
+
+* ``identity_nodes.npy``: the group IDs (``S36``), the index of a group in
+  this array being its node index.
+* ``identity_indptr.npy``: the ``int64`` offsets of the outgoing edges of
+  each node in the ``indices`` and ``relations`` arrays.
+* ``identity_indices.npy``: the ``int32`` target node of each edge.
+* ``identity_relations.npy``: the ``int8``
+  :class:`~asclepias_broker.core.models.Relation` value of each edge.
+
+A ``manifest.json`` file describes the exported graphs. Requires the
+``numpy`` package.
+"""
+
+import json
+import os
+from datetime import datetime
+from typing import Dict, Iterable
+
+from flask import current_app
+from invenio_db import db
+from sqlalchemy import func
+from sqlalchemy.orm import aliased
+
+from ..core.models import Relation
+from ..utils import chunks, is_postgresql
+from .models import Group, GroupRelationship, GroupType
+
+try:
+    import numpy
+    from numpy.lib.format import open_memmap
+except ImportError:
+    numpy = None
+
+
+class GraphExporter:
+    """Stream the group relationships into CSR arrays.
+
+    The node indices are computed by the database, and the edges are
+    streamed ordered by source node into memory-mapped arrays, so that only
+    a batch of rows is held in memory at a time.
+    """
+
+    def __init__(self, output_dir: str, batch_size: int = None):
+        """Initialize the exporter.
+
+        :param output_dir: Directory of the exported files.
+        :param batch_size: Number of rows streamed at once.
+        """
+        if numpy is None:
+            raise RuntimeError(
+                "The 'numpy' package is required to export the graph.")
+        self.output_dir = output_dir
+        self.batch_size = batch_size or \
+            current_app.config['ASCLEPIAS_GRAPH_BUILD_BATCH_SIZE']
+
+    def _open(self, name: str, dtype, length: int):
+        return open_memmap(os.path.join(self.output_dir, f'{name}.npy'),
+                           mode='w+', dtype=dtype, shape=(length, ))
+
+    def _stream(self, query) -> Iterable[list]:
+        return chunks(query.yield_per(self.batch_size), self.batch_size)
+
+    def export_group_type(self, group_type: GroupType) -> Dict[str, int]:
+        """Export the graph of the groups of a type.
+
+        :returns: The number of nodes and edges.
+        """
+        name = group_type.name.lower()
+        groups = (db.session.query(Group.id)
+                  .filter(Group.type == group_type).order_by(Group.id))
+        nodes = (
+            db.session.query(
+                Group.id.label('id'),
+                (func.row_number().over(order_by=Group.id) - 1).label('idx'))
+            .filter(Group.type == group_type).subquery())
+        source, target = aliased(nodes), aliased(nodes)
+        edges = (
+            db.session.query(source.c.idx, target.c.idx,
+                             GroupRelationship.relation)
+            .join(source, source.c.id == GroupRelationship.source_id)
+            .join(target, target.c.id == GroupRelationship.target_id)
+            .filter(GroupRelationship.type == group_type))
+        n_nodes = groups.order_by(None).count()
+        n_edges = edges.count()
+
+        node_ids = self._open(f'{name}_nodes', 'S36', n_nodes)
+        offset = 0
+        for batch in self._stream(groups):
+            node_ids[offset:offset + len(batch)] = \
+                [str(group_id) for group_id, in batch]
+            offset += len(batch)
+
+        indptr = self._open(f'{name}_indptr', numpy.int64, n_nodes + 1)
+        indptr[:] = 0
+        indices = self._open(f'{name}_indices', numpy.int32, n_edges)
+        relations = self._open(f'{name}_relations', numpy.int8, n_edges)
+        offset = 0
+        for batch in self._stream(
+                edges.order_by(source.c.idx, target.c.idx)):
+            end = offset + len(batch)
+            if end > n_edges:
+                raise RuntimeError('The graph changed during the export.')
+            src = numpy.fromiter((s for s, _, _ in batch), numpy.int64)
+            indices[offset:end] = [t for _, t, _ in batch]
+            relations[offset:end] = [r.value for _, _, r in batch]
+            # The edges are sorted by source, so the counts are contiguous
+            sources, counts = numpy.unique(src, return_counts=True)
+            indptr[sources + 1] += counts
+            offset = end
+        if offset != n_edges:
+            raise RuntimeError('The graph changed during the export.')
+        numpy.cumsum(indptr, out=indptr)
+        for array in (node_ids, indptr, indices, relations):
+            array.flush()
+        return dict(nodes=n_nodes, edges=n_edges)
+
+    def export(self, group_types: Iterable[GroupType] = None) -> dict:
+        """Export the graphs, from a consistent snapshot on PostgreSQL.
+
+        :returns: The manifest of the export.
+        """
+        group_types = group_types or list(GroupType)
+        os.makedirs(self.output_dir, exist_ok=True)
+        db.session.commit()
+        if is_postgresql():
+            db.session.connection(
+                execution_options={'isolation_level': 'REPEATABLE READ'})
+        manifest = {
+            'created': datetime.utcnow().isoformat(),
+            'relations': {r.name: r.value for r in Relation},
+            'graphs': {
+                t.name.lower(): self.export_group_type(t)
+                for t in group_types},
+        }
+        db.session.commit()
+        with open(os.path.join(self.output_dir, 'manifest.json'), 'w') as fp:
+            json.dump(manifest, fp, indent=2)
+        return manifest
+
+
+def export_graph(output_dir: str, group_types: Iterable[GroupType] = None,
+                 batch_size: int = None) -> dict:
+    """Export the groups graph as CSR arrays."""
+    return GraphExporter(output_dir, batch_size=batch_size).export(
+        group_types)
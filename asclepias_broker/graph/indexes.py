@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 CERN.
+#
+# Asclepias Broker is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Indexes of the grouping tables, and the query plans of their hot queries.
+
+The composite (and partial) indexes of the models follow the access paths of
+the grouping and indexing queries. Databases created before they were added
+are upgraded with :func:`create_indexes`, and the plans of the queries they
+serve can be checked with :func:`explain_queries`. The tables and columns
+added to the models since are created with :func:`create_columns`.
+"""
+
+import uuid
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+from invenio_db import db
+from sqlalchemy import inspect, or_, text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from ..core.models import Identifier, Relation, Relationship
+from ..events.models import Event, EventPayloadArchive, PayloadHash
+from ..search.models import DirtyGroup
+from .models import Group, GroupM2M, GroupRelationship, GroupRelationshipM2M, \
+    GroupType, Identifier2Group, Relationship2GroupRelationship
+
+#: Models whose missing tables and columns are created by
+#: :func:`create_columns`
+UPGRADED_MODELS = [
+    Identifier,
+    Event,
+    PayloadHash,
+    EventPayloadArchive,
+    Group,
+    DirtyGroup,
+]
+
+#: Models whose indexes are created by :func:`create_indexes`
+INDEXED_MODELS = [
+    Relationship,
+    Group,
+    GroupRelationship,
+    Identifier2Group,
+    GroupM2M,
+    GroupRelationshipM2M,
+    Relationship2GroupRelationship,
+]
+
+#: Single-column indexes, by the composite index (or unique constraint)
+#: starting with the same column that replaces them
+SUPERSEDED_INDEXES = {
+    'relationship': {
+        'ix_relationship_source': 'uq_relationship_source_target_relation',
+        'ix_relationship_target': 'ix_relationship_target_relation',
+    },
+    'grouprelationship': {
+        'ix_grouprelationship_source':
+            'uq_grouprelationship_source_target_relation',
+        'ix_grouprelationship_target':
+            'ix_grouprelationship_target_relation_type',
+    },
+}
+
+
+def _add_column(column) -> Optional[str]:
+    """Add a column to its table, with its foreign keys and unique index.
+
+    :returns: The name of the unique index of the column, if any.
+    """
+    preparer = db.engine.dialect.identifier_preparer
+    table = preparer.format_table(column.table)
+    ddl = str(CreateColumn(column).compile(dialect=db.engine.dialect))
+    for fk in column.foreign_keys:
+        ddl += (f' REFERENCES {preparer.format_table(fk.column.table)}'
+                f' ({preparer.quote(fk.column.name)})')
+        if fk.ondelete:
+            ddl += f' ON DELETE {fk.ondelete}'
+        if fk.onupdate:
+            ddl += f' ON UPDATE {fk.onupdate}'
+    db.engine.execute(text(f'ALTER TABLE {table} ADD COLUMN {ddl}'))
+    if column.unique:
+        # Named like the unique constraint of a newly created table
+        name = f'uq_{column.table.name}_{column.name}'
+        db.engine.execute(text(
+            f'CREATE UNIQUE INDEX {preparer.quote(name)} ON {table} '
+            f'({preparer.quote(column.name)})'))
+        return name
+
+
+def create_columns() -> Dict[str, List[str]]:
+    """Create the missing tables and columns of the :data:`UPGRADED_MODELS`.
+
+    Added columns are nullable, and are backfilled separately (e.g. the
+    identifier hashes by :func:`~asclepias_broker.graph.api.\
+dedup_identifiers`) or on demand (e.g. the roots of the Version groups).
+
+    The indexes of the added columns are created along with them.
+
+    :returns: The names of the created tables, columns and indexes.
+    """
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    tables, columns, indexes = [], [], []
+    for model in UPGRADED_MODELS:
+        table = model.__table__
+        if table.name not in existing_tables:
+            table.create(bind=db.engine)
+            tables.append(table.name)
+            continue
+        existing = {c['name'] for c in inspector.get_columns(table.name)}
+        added = {c.name for c in table.columns if c.name not in existing}
+        for name in sorted(added, key=list(table.c.keys()).index):
+            unique_index = _add_column(table.c[name])
+            columns.append(f'{table.name}.{name}')
+            if unique_index:
+                indexes.append(unique_index)
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            if added & {c.name for c in index.columns}:
+                index.create(bind=db.engine)
+                indexes.append(index.name)
+    return dict(tables=tables, columns=columns, indexes=indexes)
+
+
+def _valid_indexes(inspector, table: str) -> Set[str]:
+    """Get the names of the usable indexes and unique constraints.
+
+    On PostgreSQL, indexes left invalid by a failed or ongoing build are
+    not usable.
+    """
+    names = {i['name'] for i in inspector.get_indexes(table)} | \
+        {c['name'] for c in inspector.get_unique_constraints(table)}
+    if db.engine.dialect.name == 'postgresql':
+        invalid = db.engine.execute(text(
+            'SELECT c.relname FROM pg_index i '
+            'JOIN pg_class c ON c.oid = i.indexrelid '
+            'JOIN pg_class t ON t.oid = i.indrelid '
+            'WHERE t.relname = :table AND NOT i.indisvalid'), table=table)
+        names -= {name for name, in invalid}
+    return names
+
+
+def create_indexes(drop_superseded: bool = False) -> Dict[str, List[str]]:
+    """Create the missing indexes of the grouping tables.
+
+    Indexes are not created concurrently, so writes to a table are blocked
+    while its indexes are built. Missing columns are created first with
+    :func:`create_columns`.
+
+    :param drop_superseded: Also drop the indexes of
+        :data:`SUPERSEDED_INDEXES`, once the index replacing them exists and
+        is valid.
+    :returns: The names of the created tables, columns and indexes, and of
+        the dropped indexes.
+    """
+    result = create_columns()
+    inspector = inspect(db.engine)
+    created, dropped = result.pop('indexes'), []
+    for model in INDEXED_MODELS:
+        table = model.__table__
+        existing = {i['name'] for i in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            if index.name not in existing:
+                index.create(bind=db.engine)
+                created.append(index.name)
+        if drop_superseded:
+            valid = _valid_indexes(inspect(db.engine), table.name)
+            superseded = SUPERSEDED_INDEXES.get(table.name, {})
+            for name, replacement in superseded.items():
+                if name in existing and replacement in valid:
+                    db.engine.execute(text(f'DROP INDEX {name}'))
+                    dropped.append(name)
+    return dict(result, created=created, dropped=dropped)
+
+
+class Explain(Executable, ClauseElement):
+    """An ``EXPLAIN`` statement of a query."""
+
+    def __init__(self, statement, analyze: bool = False):
+        """Initialize the statement."""
+        self.statement = statement
+        self.analyze = analyze
+
+
+@compiles(Explain)
+def _compile_explain(element, compiler, **kw):
+    return 'EXPLAIN QUERY PLAN ' + compiler.process(element.statement, **kw)
+
+
+@compiles(Explain, 'postgresql')
+def _compile_explain_postgresql(element, compiler, **kw):
+    prefix = 'EXPLAIN (ANALYZE, BUFFERS) ' if element.analyze else 'EXPLAIN '
+    return prefix + compiler.process(element.statement, **kw)
+
+
+# The plans do not depend on the looked up values
+_ID = uuid.UUID(int=0)
+
+#: Hot queries of the grouping and indexing, by name
+EXPLAINED_QUERIES: Dict[str, Callable] = {
+    'relationship': lambda: Relationship.query.filter_by(
+        source_id=_ID, target_id=_ID, relation=Relation.Cites),
+    'citations': lambda: Relationship.query.filter(
+        Relationship.relation == Relation.Cites,
+        Relationship.target_id.in_([_ID])),
+    'identity_group': lambda: db.session.query(
+        Identifier2Group.group_id).filter(
+            Identifier2Group.identifier_id == _ID),
+    'group_members': lambda: db.session.query(
+        Identifier2Group.identifier_id).filter(
+            Identifier2Group.group_id == _ID),
+    'version_group': lambda: db.session.query(GroupM2M.group_id).filter(
+        GroupM2M.subgroup_id == _ID),
+    'version_roots': lambda: Group.query.filter(Group.root_id == _ID),
+    'group_relationship': lambda: GroupRelationship.query.filter_by(
+        source_id=_ID, target_id=_ID, relation=Relation.Cites),
+    'outgoing_group_relationships': lambda: GroupRelationship.query.filter_by(
+        source_id=_ID, type=GroupType.Identity),
+    'incoming_group_relationships': lambda: GroupRelationship.query.filter_by(
+        target_id=_ID, relation=Relation.HasVersion,
+        type=GroupType.Identity),
+    'version_group_relationships': lambda: GroupRelationship.query.filter(
+        GroupRelationship.type == GroupType.Version,
+        or_(GroupRelationship.source_id == _ID,
+            GroupRelationship.target_id == _ID)),
+    'group_relationship_relationships': lambda: db.session.query(
+        Relationship2GroupRelationship.relationship_id).filter(
+            Relationship2GroupRelationship.group_relationship_id == _ID),
+    'superrelationships': lambda: db.session.query(
+        GroupRelationshipM2M.relationship_id).filter(
+            GroupRelationshipM2M.subrelationship_id == _ID),
+}
+
+
+def explain(query, analyze: bool = False) -> List[str]:
+    """Get the query plan of a query, as lines of text.
+
+    :param analyze: Run the query to report its actual costs (PostgreSQL
+        only).
+    """
+    rows = db.session.execute(Explain(query.statement, analyze=analyze))
+    # The plan is in the last column on both PostgreSQL and SQLite
+    return [str(row[-1]) for row in rows]
+
+
+def explain_queries(names: Iterable[str] = None,
+                    analyze: bool = False) -> Dict[str, List[str]]:
+    """Get the query plans of the :data:`EXPLAINED_QUERIES`."""
+    return {name: explain(EXPLAINED_QUERIES[name](), analyze=analyze)
+            for name in (names or EXPLAINED_QUERIES)}
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 CERN.
+#
+# Asclepias Broker is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Advisory locks serializing the grouping of the same identifiers.
+
+Workers take PostgreSQL transaction-level advisory locks on the identifiers
+and groups they update, and the locks are released when the transaction
+ends. On other databases locking is a no-op.
+
+The locks of a transaction are taken in several steps (e.g. the identifiers
+before their groups), so ordering the keys of each step is not enough to
+avoid deadlocks. Only the first locks of a transaction, taken in ascending
+key order while holding no other lock, are waited for. Later locks are only
+taken if they are free, and :class:`LockNotAvailable` is raised otherwise.
+The transaction is then rolled back and run again by
+:func:`run_with_lock_retries`, which first waits for the refused locks.
+
+The identifiers of an event are locked by their normalized value (see
+:meth:`~asclepias_broker.core.models.Identifier.compute_hash`) before they
+are looked up, so that workers creating the same new identifier wait for
+each other, and then by ID along with their groups.
+"""
+
+import hashlib
+import time
+from typing import Callable, Iterable, List, Tuple, Union
+from uuid import UUID
+
+from flask import current_app
+from invenio_db import db
+from sqlalchemy import bindparam, event, text
+from sqlalchemy.dialects.postgresql import ARRAY, BIGINT
+from sqlalchemy.orm import Session
+
+from ..core.models import Identifier
+from ..utils import is_postgresql
+from .models import GroupM2M, Identifier2Group
+
+_HELD_KEY = 'asclepias_broker_advisory_locks'
+_WAIT_KEY = 'asclepias_broker_lock_wait'
+
+_LOCK_STATEMENT = text(
+    'SELECT count(pg_advisory_xact_lock(k)) FROM unnest(:keys) AS k'
+).bindparams(bindparam('keys', type_=ARRAY(BIGINT)))
+
+_TRY_LOCK_STATEMENT = text(
+    'SELECT k FROM unnest(:keys) AS k WHERE NOT pg_try_advisory_xact_lock(k)'
+).bindparams(bindparam('keys', type_=ARRAY(BIGINT)))
+
+
+class LockNotAvailable(Exception):
+    """Locks are held by another transaction while holding other locks."""
+
+    def __init__(self, keys: List[int]):
+        """Initialize the exception.
+
+        :param keys: The refused lock keys.
+        """
+        super().__init__(f'{len(keys)} locks are held by another transaction')
+        self.keys = keys
+
+
+def lock_key(value: Union[UUID, str]) -> int:
+    """Get the (signed 64-bit) advisory lock key of an identifier or group.
+
+    Identifiers are also keyed by the hash of their normalized value.
+    """
+    digest = hashlib.blake2b(str(value).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def acquire_locks(ids: Iterable[Union[UUID, str]]) -> bool:
+    """Lock identifiers or groups until the end of the transaction.
+
+    See :func:`lock_keys`.
+    """
+    return lock_keys(lock_key(i) for i in ids if i is not None)
+
+
+def lock_keys(keys: Iterable[int]) -> bool:
+    """Take advisory locks until the end of the transaction.
+
+    Locks already held by the transaction are skipped. If the transaction
+    holds no lock yet, the locks are waited for in ascending key order.
+    Otherwise they are only taken if they are free, so that workers never
+    wait while holding locks, and cannot deadlock.
+
+    :raises LockNotAvailable: If the transaction already holds locks, and
+        some of the locks are held by another transaction.
+    :returns: ``True`` if new locks were taken, in which case the locked
+        rows might have changed while waiting.
+    """
+    if not is_postgresql():
+        return False
+    held = db.session.info.setdefault(_HELD_KEY, set())
+    keys = sorted(set(keys) - held)
+    if not keys:
+        return False
+    if held:
+        refused = [k for k, in db.session.execute(
+            _TRY_LOCK_STATEMENT, {'keys': keys})]
+        if refused:
+            raise LockNotAvailable(refused)
+    else:
+        start = time.monotonic()
+        db.session.execute(_LOCK_STATEMENT, {'keys': keys})
+        db.session.info[_WAIT_KEY] = \
+            get_lock_wait() + time.monotonic() - start
+    held.update(keys)
+    return True
+
+
+def run_with_lock_retries(func: Callable, *args, **kwargs):
+    """Run a function, from the start again when its locks are refused.
+
+    The function runs (and commits) its own transaction. When it raises
+    :class:`LockNotAvailable`, the transaction is rolled back, and the next
+    attempt first waits for the refused locks, which are then held for the
+    whole attempt. The number of attempts is set by the
+    ``ASCLEPIAS_GRAPH_LOCK_ATTEMPTS`` config variable.
+    """
+    attempts = current_app.config['ASCLEPIAS_GRAPH_LOCK_ATTEMPTS']
+    refused = []
+    for attempt in range(1, attempts + 1):
+        try:
+            lock_keys(refused)
+            return func(*args, **kwargs)
+        except LockNotAvailable as exc:
+            db.session.rollback()
+            if attempt == attempts:
+                raise
+            refused = exc.keys
+
+
+def lock_identifier_values(keys: Iterable[Tuple[str, str]]) -> bool:
+    """Lock ``(value, scheme)`` pairs, by the hash of their normalized value.
+
+    Taken before looking up (or creating) the identifiers, so that a new
+    identifier is created once, even by concurrent workers.
+    """
+    return acquire_locks(
+        Identifier.compute_hash(value, scheme) for value, scheme in keys)
+
+
+def lock_identifier_groups(identifier_ids: Iterable[UUID]):
+    """Lock identifiers, and then their current groups.
+
+    Locking all the identifiers and groups of an event upfront means that
+    its later locks are mostly already held.
+    """
+    identifier_ids = set(identifier_ids)
+    if not acquire_locks(identifier_ids):
+        return
+    rows = (
+        db.session.query(Identifier2Group.group_id, GroupM2M.group_id)
+        .outerjoin(GroupM2M,
+                   GroupM2M.subgroup_id == Identifier2Group.group_id)
+        .filter(Identifier2Group.identifier_id.in_(identifier_ids)))
+    acquire_locks({group_id for row in rows for group_id in row})
+
+
+def get_lock_wait() -> float:
+    """Seconds spent acquiring locks since the last reset."""
+    return db.session.info.get(_WAIT_KEY, 0.0)
+
+
+def reset_lock_wait() -> float:
+    """Reset the lock wait time, returning the previous value."""
+    return db.session.info.pop(_WAIT_KEY, 0.0)
+
+
+def _forget_locks(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(_HELD_KEY, None)
+
+
+def _forget_rolled_back_locks(session, previous_transaction):
+    # Rolling back a savepoint also releases the locks taken after it
+    session.info.pop(_HELD_KEY, None)
+
+
+event.listen(Session, 'after_transaction_end', _forget_locks)
+event.listen(Session, 'after_soft_rollback', _forget_rolled_back_locks)
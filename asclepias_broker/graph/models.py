@@ -10,6 +10,7 @@ import enum
 import uuid
 
 from invenio_db import db
+from sqlalchemy import text
 from sqlalchemy.schema import Index, PrimaryKeyConstraint, UniqueConstraint
 from sqlalchemy_utils.models import Timestamp
 from sqlalchemy_utils.types import UUIDType
@@ -28,9 +29,23 @@ class Group(db.Model, Timestamp):
     """Group model."""
 
     __tablename__ = 'group'
+    __table_args__ = (
+        Index('ix_group_root', 'root_id',
+              postgresql_where=text('root_id IS NOT NULL'),
+              sqlite_where=text('root_id IS NOT NULL')),
+    )
 
     id = db.Column(UUIDType, default=uuid.uuid4, primary_key=True)
     type = db.Column(db.Enum(GroupType), nullable=False)
+    #: Root Identity group of a Version group, i.e. the top of its
+    #: ``HasVersion`` chain, whose metadata represents all the versions
+    root_id = db.Column(
+        UUIDType,
+        db.ForeignKey('group.id', ondelete='SET NULL', onupdate='CASCADE'),
+        nullable=True)
+
+    root = db.relationship(
+        'Group', remote_side=[id], foreign_keys=[root_id], viewonly=True)
 
     identifiers = db.relationship(
         Identifier,
@@ -56,9 +71,12 @@ class GroupRelationship(db.Model, Timestamp):
     __table_args__ = (
         UniqueConstraint('source_id', 'target_id', 'relation',
                          name='uq_grouprelationship_source_target_relation'),
-        # TODO: Change to "index=True"
-        Index('ix_grouprelationship_source', 'source_id'),
-        Index('ix_grouprelationship_target', 'target_id'),
+        Index('ix_grouprelationship_source_type', 'source_id', 'type'),
+        Index('ix_grouprelationship_target_relation_type',
+              'target_id', 'relation', 'type'),
+        Index('ix_grouprelationship_version_target', 'target_id', 'relation',
+              postgresql_where=text("type = 'Version'"),
+              sqlite_where=text("type = 'Version'")),
         Index('ix_grouprelationship_relation', 'relation'),
     )
 
@@ -106,6 +124,8 @@ class Identifier2Group(db.Model, Timestamp):
     __table_args__ = (
         PrimaryKeyConstraint('identifier_id', 'group_id',
                              name='pk_identifier2group'),
+        Index('ix_identifier2group_group_identifier',
+              'group_id', 'identifier_id'),
     )
     identifier_id = db.Column(
         UUIDType,
@@ -132,6 +152,8 @@ class Relationship2GroupRelationship(db.Model, Timestamp):
     __table_args__ = (
         PrimaryKeyConstraint('relationship_id', 'group_relationship_id',
                              name='pk_relationship2grouprelationship'),
+        Index('ix_relationship2grouprelationship_group_relationship',
+              'group_relationship_id', 'relationship_id'),
     )
     relationship_id = db.Column(
         UUIDType,
@@ -164,6 +186,7 @@ class GroupM2M(db.Model, Timestamp):
     __table_args__ = (
         PrimaryKeyConstraint('group_id', 'subgroup_id', name='pk_groupm2m'),
         UniqueConstraint('subgroup_id', name='uq_groupm2m_subgroup_id'),
+        Index('ix_groupm2m_subgroup_group', 'subgroup_id', 'group_id'),
     )
     group_id = db.Column(
         UUIDType,
@@ -192,6 +215,8 @@ class GroupRelationshipM2M(db.Model, Timestamp):
     __table_args__ = (
         PrimaryKeyConstraint('relationship_id', 'subrelationship_id',
                              name='pk_grouprelationshipm2m'),
+        Index('ix_grouprelationshipm2m_subrelationship',
+              'subrelationship_id'),
     )
     relationship_id = db.Column(
         UUIDType,
@@ -7,61 +7,166 @@
 
 """Asynchronous tasks."""
 
-from typing import Dict, List, Set, Tuple
+import uuid
+from typing import Dict, Iterable, List, Set, Tuple
 
 from celery import shared_task
 from flask import current_app
 from invenio_db import db
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import ObjectDeletedError, StaleDataError
 
-from ..core.models import Relationship
-from ..events.models import Event, EventStatus, ObjectEvent, PayloadType
+from ..core.models import Identifier, Relation, Relationship
+from ..events.models import Event, EventStatus, ObjectEvent, PayloadHash, \
+    PayloadType
 from ..events.signals import event_processed
 from ..metadata.api import update_metadata_from_event
 from ..schemas.loaders import RelationshipSchema
 from ..search.indexer import update_indices
-from .api import update_groups
+from ..search.models import DirtyGroup
+from ..utils import bulk_insert_ignore
+from .api import delete_relationship, update_groups_many
+from .cache import group_cache
+from .locks import get_lock_wait, lock_identifier_groups, \
+    lock_identifier_values, reset_lock_wait, run_with_lock_retries
 from ..monitoring.models import ErrorMonitoring
 
 
-def get_or_create(model, **kwargs):
-    """Get or a create a database model."""
-    instance = model.query.filter_by(**kwargs).one_or_none()
-    if instance:
-        return instance
-    else:
-        instance = model(**kwargs)
-        db.session.add(instance)
-        return instance
-
-
 def create_relation_object_events(
     event: Event,
     relationship: Relationship,
     payload_idx: int
-):
-    """Create the object event models."""
-    # Create the Relation entry
-    rel_obj = get_or_create(
-        ObjectEvent,
-        event_id=event.id,
-        object_uuid=relationship.id,
-        payload_type=PayloadType.Relationship,
-        payload_index=payload_idx)
-
-    # Create entries for source and target
-    src_obj = get_or_create(
-        ObjectEvent,
-        event_id=event.id,
-        object_uuid=relationship.source.id,
-        payload_type=PayloadType.Identifier,
-        payload_index=payload_idx)
-    tar_obj = get_or_create(
-        ObjectEvent,
-        event_id=event.id,
-        object_uuid=relationship.target.id,
-        payload_type=PayloadType.Identifier,
-        payload_index=payload_idx)
-    return rel_obj, src_obj, tar_obj
+) -> List[dict]:
+    """Build the object event rows of a relationship.
+
+    The rows are meant to be inserted in bulk for the whole event via
+    :func:`~asclepias_broker.utils.bulk_insert_ignore`.
+    """
+    def _row(object_uuid, payload_type):
+        return dict(event_id=event.id, object_uuid=object_uuid,
+                    payload_type=payload_type, payload_index=payload_idx)
+
+    return [
+        # The Relation entry
+        _row(relationship.id, PayloadType.Relationship),
+        # Entries for source and target
+        _row(relationship.source.id, PayloadType.Identifier),
+        _row(relationship.target.id, PayloadType.Identifier),
+    ]
+
+
+def get_or_create_relationships(
+    payloads: Iterable[Tuple[int, dict]], parsed: List[list] = None,
+    resolved: Dict[int, Relationship] = None,
+) -> List[Tuple[int, dict, Relationship]]:
+    """Resolve the relationships of an event's payloads in bulk.
+
+    Instead of looking up every identifier and relationship separately, all
+    of the ``(value, scheme)`` pairs and ``(source, target, relation)``
+    triples of the payloads are fetched with a couple of set-based queries.
+    Missing identifiers and relationships are created with pre-assigned IDs,
+    so that they are inserted together on the next flush.
+
+    :param payloads: The Scholix payloads of the event, with their index.
+    :param parsed: The links parsed from the payloads on ingestion (see
+        ``EventAPI.parse_link``). Payloads are only loaded again when missing.
+    :param resolved: Filled with the ``Relationship`` of every payload, new
+        or already known, by payload index.
+    :returns: The payload index, payload and ``Relationship`` of each payload
+        that introduces a new relationship, in the order of the payloads.
+    """
+    loaded = []
+    for payload_idx, payload in payloads:
+        if parsed:
+            src_value, src_scheme, relation, trg_value, trg_scheme = \
+                parsed[payload_idx]
+            src_key = (src_value, src_scheme)
+            trg_key = (trg_value, trg_scheme)
+            relation = Relation[relation]
+        else:
+            # Errors should never happen as the payload is validated
+            # with RelationshipSchema on the event ingestion
+            rel = RelationshipSchema().load(payload)
+            src_key = (rel.source.value, rel.source.scheme)
+            trg_key = (rel.target.value, rel.target.scheme)
+            relation = rel.relation
+        loaded.append((payload_idx, payload, src_key, relation, trg_key))
+
+    # Identifiers are keyed by hash, so that values differing only in case
+    # resolve to the same identifier. They are locked first, so that
+    # concurrent events wait for each other's new identifiers.
+    id_keys = {k for _, _, src, _, trg in loaded for k in (src, trg)}
+    lock_identifier_values(id_keys)
+    identifiers = Identifier.get_many(id_keys)
+
+    relationships = {}
+    known_ids = [i.id for i in identifiers.values()]
+    if known_ids:
+        for rel in Relationship.query.filter(
+                Relationship.source_id.in_(known_ids),
+                Relationship.target_id.in_(known_ids)):
+            relationships[(rel.source_id, rel.target_id, rel.relation)] = rel
+
+    def _get_or_create_identifier(key):
+        value, scheme = key
+        value_hash = Identifier.compute_hash(value, scheme)
+        identifier = identifiers.get(value_hash)
+        if not identifier:
+            identifier = Identifier(value=value, scheme=scheme,
+                                    value_hash=value_hash, id=uuid.uuid4())
+            db.session.add(identifier)
+            identifiers[value_hash] = identifier
+        return identifier
+
+    new_relationships = []
+    for payload_idx, payload, src_key, relation, trg_key in loaded:
+        source = _get_or_create_identifier(src_key)
+        target = _get_or_create_identifier(trg_key)
+        rel_key = (source.id, target.id, relation)
+        # Skip already known relationships (including repeated payloads of
+        # the same event)
+        # NOTE: This skips any extra metadata!
+        if rel_key in relationships:
+            if resolved is not None:
+                resolved[payload_idx] = relationships[rel_key]
+            continue
+        relationship = Relationship(
+            source=source, target=target, relation=relation, id=uuid.uuid4())
+        db.session.add(relationship)
+        relationships[rel_key] = relationship
+        new_relationships.append((payload_idx, payload, relationship))
+        if resolved is not None:
+            resolved[payload_idx] = relationship
+    return new_relationships
+
+
+def filter_processed_payloads(
+    event: Event
+) -> Tuple[List[Tuple[int, dict]], List[dict]]:
+    """Drop the payloads of an event whose content was already processed.
+
+    Payloads are compared by their canonical content hash, so resubmitted
+    links are skipped before any schema loading or graph work happens. The
+    hashes stored by the event itself are ignored, so that a rerun processes
+    all of its payloads again.
+
+    :returns: The remaining payloads with their index, and the
+        ``PayloadHash`` rows to store once they are processed.
+    """
+    event_payload = event.get_payload()
+    hashes = [PayloadHash.compute(p) for p in event_payload]
+    seen = PayloadHash.get_processed(hashes, exclude_event_id=event.id)
+    payloads, hash_rows = [], []
+    for payload_idx, (payload, payload_hash) in enumerate(
+            zip(event_payload, hashes)):
+        if payload_hash in seen:
+            continue
+        seen.add(payload_hash)
+        payloads.append((payload_idx, payload))
+        hash_rows.append(dict(hash=payload_hash, event_id=event.id,
+                              payload_index=payload_idx))
+    event.skipped_payloads = len(event_payload) - len(payloads)
+    return payloads, hash_rows
 
 
 def compact_indexing_groups(
@@ -99,6 +204,25 @@ def compact_indexing_groups(
             ver_groups_to_delete, ig_to_vg_map)
 
 
+def remove_relationship(relationship: Relationship,
+                        indexing_enabled: bool = True):
+    """Delete a relationship, and reindex the groups it affected."""
+    debounced = current_app.config['ASCLEPIAS_SEARCH_INDEXING_DEBOUNCED']
+
+    def _delete():
+        with db.session.begin_nested():
+            groups_ids = delete_relationship(relationship)
+            if indexing_enabled and debounced:
+                DirtyGroup.mark(set().union(*groups_ids[:4]))
+        db.session.commit()
+        return groups_ids
+
+    groups_ids = run_with_lock_retries(_delete)
+    if indexing_enabled and not debounced:
+        update_indices(*groups_ids)
+    return groups_ids
+
+
 def _set_event_status(event_uuid, status):
     """Set the status of the Event."""
     event = Event.get(event_uuid)
@@ -106,40 +230,66 @@ def _set_event_status(event_uuid, status):
     db.session.commit()
 
 
+def _process_payloads(event_uuid: str, mark_dirty: bool = False) -> Tuple[
+        Event, List[List[str]]]:
+    """Group the relationships of an event's payloads, and commit.
+
+    :param mark_dirty: Mark the updated groups for the debounced indexing.
+    :returns: The event, and the group IDs of its new relationships.
+    """
+    event = Event.get(event_uuid)
+    groups_ids = []
+    object_events = []
+    with db.session.begin_nested():
+        # We need ORM relationship with IDs, since Event has
+        # 'weak' (non-FK) relations to the objects, hence we need
+        # to know the ID upfront
+        payloads, hash_rows = filter_processed_payloads(event)
+        resolved = {}
+        new_relationships = get_or_create_relationships(
+            payloads, parsed=event.parsed, resolved=resolved)
+        for row in hash_rows:
+            row['relationship_id'] = resolved[row['payload_index']].id
+        lock_identifier_groups(
+            i.id for _, _, r in new_relationships
+            for i in (r.source, r.target))
+        updated_groups = update_groups_many(
+            r for _, _, r in new_relationships)
+        for (payload_idx, payload, relationship), (
+                id_groups, ver_groups) in zip(
+                    new_relationships, updated_groups):
+            object_events.extend(create_relation_object_events(
+                event, relationship, payload_idx))
+            update_metadata_from_event(relationship, payload)
+            groups_ids.append(
+                [str(g.id) if g else g for g in id_groups + ver_groups])
+        event.lock_wait = get_lock_wait()
+        bulk_insert_ignore(ObjectEvent, object_events)
+        bulk_insert_ignore(PayloadHash, hash_rows)
+        if mark_dirty:
+            DirtyGroup.mark(g for ids in groups_ids for g in ids if g)
+    db.session.commit()
+    return event, groups_ids
+
+
 @shared_task(bind=True, ignore_result=True, max_retries=1, default_retry_delay=10 * 60)
 def process_event(self, event_uuid: str, indexing_enabled: bool = True):
-    """Process the event."""
-    # TODO: Should we detect and skip duplicated events?
+    """Process the event.
+
+    The event is processed from the start again if its grouping locks are
+    held by other workers (see
+    :func:`~asclepias_broker.graph.locks.run_with_lock_retries`).
+    """
     _set_event_status(event_uuid, EventStatus.Processing)
+    reset_lock_wait()
     try:
-        event = Event.get(event_uuid)
-        groups_ids = []
-        with db.session.begin_nested():
-            for payload_idx, payload in enumerate(event.payload):
-                # TODO: marshmallow validation of all payloads
-                # should be done on first event ingestion (check)
-                relationship = RelationshipSchema(check_existing=True).load(payload)
-                # Errors should never happen as the payload is validated
-                # with RelationshipSchema on the event ingestion
-
-                # Skip already known relationships
-                # NOTE: This skips any extra metadata!
-                if relationship.id:
-                    continue
-                db.session.add(relationship)
-                # We need ORM relationship with IDs, since Event has
-                # 'weak' (non-FK) relations to the objects, hence we need
-                # to know the ID upfront
-                relationship = relationship.fetch_or_create_id()
-                create_relation_object_events(event, relationship, payload_idx)
-                id_groups, ver_groups = update_groups(relationship)
-
-                update_metadata_from_event(relationship, payload)
-                groups_ids.append(
-                    [str(g.id) if g else g for g in id_groups + ver_groups])
-        db.session.commit()
+        debounced = \
+            current_app.config['ASCLEPIAS_SEARCH_INDEXING_DEBOUNCED']
+        event, groups_ids = run_with_lock_retries(
+            _process_payloads, event_uuid,
+            mark_dirty=indexing_enabled and debounced)
 
-        if indexing_enabled:
+        if indexing_enabled and not debounced:
             compacted = compact_indexing_groups(groups_ids)
             update_indices(*compacted)
 
@@ -147,8 +297,12 @@ def process_event(self, event_uuid: str, indexing_enabled: bool = True):
         event_processed.send(current_app._get_current_object(), event=event)
     except Exception as exc:
         db.session.rollback()
+        if isinstance(exc, (IntegrityError, ObjectDeletedError,
+                            StaleDataError)):
+            # Cached groups might have been merged by another worker
+            group_cache.discard_used()
         _set_event_status(event_uuid, EventStatus.Error)
-        payload = Event.get(id=event_uuid).payload
+        payload = Event.get(id=event_uuid).get_payload()
         error_obj = ErrorMonitoring.getFromEvent(event_uuid)
         if not error_obj:
             error_obj = ErrorMonitoring(event_id = event_uuid, origin=self.__class__.__name__, error=repr(exc), n_retries=self.request.retries, payload=payload)
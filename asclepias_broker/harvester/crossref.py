@@ -18,6 +18,7 @@ from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
 from ..events.api import EventAPI
+from ..events.models import EventOrigin
 from ..utils import chunks
 from .proxies import current_harvester
 
@@ -155,6 +156,8 @@ class CrossrefHarvester:
 
         results = self.search_events(scholix=scholix)
         for events in chunks(results, 100):
-            EventAPI.handle_event(list(events), no_index=no_index, eager=eager)
+            EventAPI.handle_event(
+                list(events), no_index=no_index, eager=eager,
+                origin=EventOrigin.Harvester)
 
         current_harvester.history.set(self.id, value=current_datetime)
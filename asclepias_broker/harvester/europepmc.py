@@ -15,6 +15,7 @@ from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
 from ..events.api import EventAPI
+from ..events.models import EventOrigin
 from ..metadata.api import update_metadata
 from ..utils import chunks
 from .proxies import current_harvester
@@ -257,6 +258,8 @@ class EuropePMCHarvester:
             self.query = '({0}) AND {1}'.format(self.query, daterange or '')
 
         for events in chunks(self.search_links(), 100):
-            EventAPI.handle_event(list(events), no_index=no_index, eager=eager)
+            EventAPI.handle_event(
+                list(events), no_index=no_index, eager=eager,
+                origin=EventOrigin.Harvester)
 
         current_harvester.history.set(self.id, value=current_datetime)
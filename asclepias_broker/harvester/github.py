@@ -11,6 +11,7 @@ from datetime import datetime
 from typing import List
 
 from ..events.api import EventAPI
+from ..events.models import EventOrigin
 
 import re
 import time
@@ -129,7 +130,9 @@ class GitHubHarvester(MetadataHarvester):
 
             for event_chunk in chunks(payloads, 100):
                 try:
-                    EventAPI.handle_event(list(event_chunk), no_index=True, eager=True)
+                    EventAPI.handle_event(
+                        list(event_chunk), no_index=True, eager=True,
+                        origin=EventOrigin.Harvester)
                 except ValueError:
                     current_app.logger.exception(
                         'Error while processing github harvesting event.')
@@ -17,7 +17,7 @@ def harvest_metadata_after_event_process(app, event: Event = None):
                          if obj_event.payload_type == PayloadType.Identifier)
     for id_event in identifier_events:
         # Check provider to avoid self-triggering harvesting
-        scholix_payload = event.payload[id_event.payload_index]
+        scholix_payload = id_event.payload
         providers = [provider.get('Name') for provider in
                      scholix_payload.get('LinkProvider', [{}])]
         identifier = id_event.object
@@ -168,6 +168,7 @@ def update_versioning(parent_identifier: str, children: List[Any],
                       link_publication_date: str = None):
     """."""
     from ..events.api import EventAPI
+    from ..events.models import EventOrigin
 
     providers = providers or ['unknown']
     providers = [{'Name': provider} for provider in providers]
@@ -212,7 +213,9 @@ def update_versioning(parent_identifier: str, children: List[Any],
 
     for event_chunk in chunks(event, 100):
         try:
-            EventAPI.handle_event(list(event_chunk), no_index=True, eager=True)
+            EventAPI.handle_event(
+                list(event_chunk), no_index=True, eager=True,
+                origin=EventOrigin.Harvester)
         except ValueError:
             current_app.logger.exception(
                 'Error while processing versioning event.')
@@ -57,6 +57,7 @@ def update_metadata(id_value: str, scheme: str, data: dict,
                     link_publication_date: str = None):
     """."""
     from ..events.api import EventAPI
+    from ..events.models import EventOrigin
     scheme = scheme.lower()
     id_value = idutils.normalize_pid(id_value, scheme)
 
@@ -98,7 +99,8 @@ def update_metadata(id_value: str, scheme: str, data: dict,
         for event_chunk in chunks(events, 100):
             try:
                 EventAPI.handle_event(
-                    list(event_chunk), no_index=True, eager=True)
+                    list(event_chunk), no_index=True, eager=True,
+                    origin=EventOrigin.Harvester)
             except ValueError as exc:
                 error_obj = ErrorMonitoring(origin="update_metadata", error=repr(exc), n_retries = 99, payload=event_chunk)
                 db.session.add(error_obj)
@@ -14,6 +14,7 @@ from typing import List
 import click
 from flask.cli import with_appcontext
 
+from ..events.models import Event
 from .tasks import sendMonitoringReport
 
 @click.group()
@@ -31,4 +32,13 @@ def report(eager: bool = False):
     if eager:
         task.apply(throw=True)
     else:
-        task.apply_async()
\ No newline at end of file
+        task.apply_async()
+
+
+@monitor.command('backlog')
+@with_appcontext
+def backlog():
+    """Show the number of events waiting to be processed per lane."""
+    lanes = Event.getBacklog()
+    for lane, count in sorted(lanes.items(), key=lambda l: str(l[0])):
+        click.echo(f'{lane or "unknown"}: {count}')
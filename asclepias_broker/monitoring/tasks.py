@@ -12,13 +12,14 @@ import datetime
 from sqlalchemy.orm.util import join
 from celery import  shared_task
 from sqlalchemy import and_
+from flask import current_app
 from invenio_db import db
 import slack
 import os
 
 from ..monitoring.models import ErrorMonitoring, HarvestMonitoring, HarvestStatus
 from ..events.models import Event, EventStatus
-from ..events.api import EventAPI
+from ..events.rerun import EventRerun
 from ..harvester.cli import rerun_event
 
 @shared_task(ignore_result=True)
@@ -31,9 +32,15 @@ def rerun_harvest_errors():
 @shared_task(ignore_result=True)
 def rerun_event_errors():
     two_days_ago = datetime.datetime.now() - datetime.timedelta(days = 2)
-    resp = Event.query.filter(Event.status == EventStatus.Error, Event.created > str(two_days_ago)).all()
-    for event in resp:
-        EventAPI.rerun_event(event, no_index=True, eager=False)
+    query = Event.query.filter(Event.status == EventStatus.Error, Event.created > str(two_days_ago))
+    # The task does not sleep while the reruns are in flight, since they can
+    # be queued behind it, but is scheduled again to resume from the
+    # checkpoint. It does not wait for the last reruns either
+    rerun = EventRerun('monitoring-errors', query, no_index=True)
+    progress = rerun.run(wait=False, block=False)
+    current_app.logger.info(f'Reran failed events: {progress}')
+    if progress.waiting:
+        rerun_event_errors.apply_async(countdown=rerun.poll_interval)
 
 @shared_task(ignore_result=True)
 def sendMonitoringReport():
@@ -167,6 +174,22 @@ def sendEventReport(client, channel:str):
             "type": "plain_text",
             "text": str(0)
         })
+    fields.append({
+        "type": "plain_text",
+        "text": "Skipped duplicate payloads"
+    })
+    fields.append({
+        "type": "plain_text",
+        "text": str(Event.getSkippedFromLastWeek())
+    })
+    fields.append({
+        "type": "plain_text",
+        "text": "Grouping lock wait (s)"
+    })
+    fields.append({
+        "type": "plain_text",
+        "text": f'{Event.getLockWaitFromLastWeek():.1f}'
+    })
     blocks = [{"type": "section",
         "text": {
             "text": "*Number of events done during the last 7 days*",
@@ -6,11 +6,13 @@
 # under the terms of the MIT License; see LICENSE file for more details.
 """Relationships search API."""
 
-from itertools import groupby
+from collections import defaultdict
 
 from invenio_db import db
+from sqlalchemy import and_, or_, union
+from sqlalchemy.orm import aliased, joinedload
 
-from ..core.models import Identifier, Relation
+from ..core.models import Identifier, Relation, Relationship
 from ..graph.api import get_group_from_id
 from ..graph.models import Group, GroupRelationship, GroupType, \
     Identifier2Group
@@ -23,63 +25,218 @@ class RelationshipAPI:
     @classmethod
     def print_citations(self, pid_value):
         """Print citations of an identifier."""
-        id_A = Identifier.query.filter_by(scheme='DOI', value=pid_value).one()
+        id_A = Identifier.get(pid_value, 'doi')
         full_c = self.get_citations(
             id_A, with_parents=True, with_siblings=True, expand_target=True)
         from pprint import pprint
         pprint(full_c)
 
+    @staticmethod
+    def _get_identities(identifiers) -> list:
+        """Get the identities of identifiers from their Identity groups.
+
+        Identifiers that are not grouped yet are their own identities.
+        """
+        ids = [i.id for i in identifiers]
+        if not ids:
+            return []
+        member = aliased(Identifier2Group)
+        group_ids = db.session.query(Identifier2Group.group_id).filter(
+            Identifier2Group.identifier_id.in_(ids))
+        identities = (
+            Identifier.query
+            .join(member, member.identifier_id == Identifier.id)
+            .filter(member.group_id.in_(group_ids)))
+        return list(set(identities) | set(identifiers))
+
+    @staticmethod
+    def _get_relationships(relation: Relation):
+        return (
+            Relationship.query
+            .options(joinedload(Relationship.source),
+                     joinedload(Relationship.target))
+            .filter(Relationship.relation == relation))
+
     @classmethod
-    def get_citations(self, identifier, with_parents=False,
-                      with_siblings=False, expand_target=False):
-        """Get citations of an identfier from the database."""
+    def _get_frontier(self, identifier, with_parents=False,
+                      with_siblings=False):
+        """Get the identifiers of a target and the relationships joining them.
+
+        :returns: The set of the target identifiers, which directly receive
+            the citations of the target, and the version relationships
+            between them.
+        """
         # At the beginning, frontier is just identities
-        frontier = identifier.get_identities()
+        frontier = self._get_identities([identifier])
         frontier_rel = set()
         # Expand with parents
         if with_parents or with_siblings:
             parents_rel = set(
-                sum([iden.get_parents(Relation.HasVersion, as_relation=True)
-                     for iden in frontier], []))
-            iden_parents = [item.source for item in parents_rel]
-            iden_parents = set(
-                sum([p.get_identities() for p in iden_parents], []))
+                self._get_relationships(Relation.HasVersion).filter(
+                    Relationship.target_id.in_([i.id for i in frontier])))
+            iden_parents = self._get_identities(
+                {item.source for item in parents_rel})
             if with_parents:
                 frontier_rel |= parents_rel
                 frontier += iden_parents
         # Expand with siblings
         if with_siblings:
             children_rel = set(
-                sum([p.get_children(Relation.HasVersion, as_relation=True)
-                     for p in iden_parents], []))
+                self._get_relationships(Relation.HasVersion).filter(
+                    Relationship.source_id.in_(
+                        [i.id for i in iden_parents])))
             frontier_rel |= children_rel
-            par_children = [item.target for item in children_rel]
-            par_children = set(
-                sum([c.get_identities() for c in par_children], []))
-            frontier += par_children
-        frontier = set(frontier)
+            frontier += self._get_identities(
+                {item.target for item in children_rel})
+        return set(frontier), frontier_rel
+
+    @classmethod
+    def get_target(self, identifier, with_parents=False,
+                   with_siblings=False):
+        """Get the identifiers of a target and the relationships joining them.
+
+        :returns: A ``(identifiers, relationships)`` tuple, in the format of
+            the expanded target of :meth:`get_citations`.
+        """
+        frontier, frontier_rel = self._get_frontier(
+            identifier, with_parents=with_parents,
+            with_siblings=with_siblings)
+        frontier_ids = [i.id for i in frontier]
+        frontier_rel = list(frontier_rel) + list(
+            self._get_relationships(Relation.IsIdenticalTo).filter(or_(
+                Relationship.source_id.in_(frontier_ids),
+                Relationship.target_id.in_(frontier_ids))))
+        return list(frontier), frontier_rel
+
+    @staticmethod
+    def _cites(frontier_ids):
+        return and_(Relationship.relation == Relation.Cites,
+                    Relationship.target_id.in_(frontier_ids))
+
+    @classmethod
+    def _aggregate_citations(self, frontier_ids, group_ids=None) -> list:
+        """Get the citations of identifiers, aggregated by citing identity.
+
+        :param group_ids: Only get the citations from the identifiers of
+            these Identity groups, or from these citing identifiers if they
+            are not grouped yet.
+        :returns: A list of ``(group ID, identities, citations)`` tuples. The
+            group ID is ``None`` for the citing identifiers that are not
+            grouped yet.
+        """
+        cites_frontier = self._cites(frontier_ids)
+        citing, member = aliased(Identifier2Group), aliased(Identifier2Group)
+        citations = (
+            self._get_relationships(Relation.Cites)
+            .outerjoin(citing,
+                       citing.identifier_id == Relationship.source_id)
+            .add_columns(citing.group_id)
+            .filter(cites_frontier))
+        citing_groups = (
+            db.session.query(citing.group_id)
+            .join(Relationship, Relationship.source_id == citing.identifier_id)
+            .filter(cites_frontier))
+        if group_ids is not None:
+            citations = citations.filter(or_(
+                citing.group_id.in_(group_ids),
+                and_(citing.group_id.is_(None),
+                     Relationship.source_id.in_(group_ids))))
+            citing_groups = group_ids
+        # Expand the citing identifiers to their identities, all at once
+        rows = (
+            db.session.query(member.group_id, Identifier)
+            .join(member, member.identifier_id == Identifier.id)
+            .filter(member.group_id.in_(citing_groups)))
+        identities = defaultdict(set)
+        for group_id, identity in rows:
+            identities[group_id].add(identity)
+        # Group the citations if their sources are identical
+        aggregated = {}
+        for citation, group_id in citations:
+            key = group_id or citation.source_id
+            if key not in aggregated:
+                sources = identities.get(group_id) or {citation.source}
+                aggregated[key] = (group_id, sorted(
+                    sources, key=lambda i: (i.value, i.scheme)), [])
+            aggregated[key][2].append(citation)
+        return list(aggregated.values())
+
+    @classmethod
+    def get_citations(self, identifier, with_parents=False,
+                      with_siblings=False, expand_target=False):
+        """Get citations of an identfier from the database.
+
+        Identities are read from the Identity groups, so that a fixed number
+        of queries is issued, regardless of the number of citations.
+        """
+        frontier, _ = self._get_frontier(
+            identifier, with_parents=with_parents,
+            with_siblings=with_siblings)
         # frontier contains all identifiers which directly cite the resource
-        citations = set(
-            sum([iden.get_parents(Relation.Cites, as_relation=True)
-                 for iden in frontier], []))
-        # Expand it to identical identifiers and group them if they repeat
-        expanded_sources = [c.source.get_identities() for c in citations]
-        zipped = sorted(zip(expanded_sources, citations),
-                        key=lambda x: [xi.value for xi in x[0]])
-        aggregated_citations = [
-            (k, list(vi for _, vi in v))
-            for k, v in groupby(zipped, key=lambda x: x[0])]
-        frontier_rel = list(frontier_rel) + list(set(
-            sum([item._get_identities(as_relation=True)
-                 for item in frontier], [])))
+        aggregated_citations = sorted(
+            ((ids, citations) for _, ids, citations in
+             self._aggregate_citations([i.id for i in frontier])),
+            key=lambda x: [i.value for i in x[0]])
         if expand_target:
-            aggregated_citations += [(list(frontier), frontier_rel)]
+            aggregated_citations += [self.get_target(
+                identifier, with_parents=with_parents,
+                with_siblings=with_siblings)]
         return aggregated_citations
 
+    @classmethod
+    def get_citations_page(self, target, size: int, after=None) -> tuple:
+        """Get a page of the citations of a target.
+
+        The citations are paginated by citing Identity group, in the order of
+        the group IDs, so that a page is fetched with a keyset query no matter
+        how deep it is. Citing identifiers that are not grouped yet are their
+        own group, keyed by their identifier ID.
+
+        :param target: The target, as returned by :meth:`get_target`.
+        :param size: Number of citing Identity groups per page.
+        :param after: The cursor of the page, i.e. the last Identity group
+            (or ungrouped identifier) ID of the previous page.
+        :returns: A ``(citations, cursor)`` tuple, where the cursor of the
+            next page is ``None`` for the last page.
+        """
+        frontier_ids = [i.id for i in target[0]]
+        cites_frontier = self._cites(frontier_ids)
+        grouped = (
+            db.session.query(Identifier2Group.group_id.label('key'))
+            .join(Relationship,
+                  Relationship.source_id == Identifier2Group.identifier_id)
+            .filter(cites_frontier))
+        ungrouped = (
+            db.session.query(Relationship.source_id.label('key'))
+            .outerjoin(
+                Identifier2Group,
+                Identifier2Group.identifier_id == Relationship.source_id)
+            .filter(cites_frontier, Identifier2Group.group_id.is_(None)))
+        keys = union(grouped.statement, ungrouped.statement).alias('keys')
+        group_ids = db.session.query(keys.c.key)
+        if after:
+            group_ids = group_ids.filter(keys.c.key > after)
+        group_ids = [
+            key for key, in group_ids.order_by(keys.c.key).limit(size)]
+        if not group_ids:
+            return [], None
+        citations = sorted(
+            self._aggregate_citations(frontier_ids, group_ids),
+            key=lambda x: x[0] or x[2][0].source_id)
+        cursor = group_ids[-1] if len(group_ids) == size else None
+        return [(ids, rels) for _, ids, rels in citations], cursor
+
     @classmethod
     def get_citations2(self, identifier, relation: str,
-                       grouping_type=GroupType.Identity):
-        """Get citations of an identfier from the database."""
+                       grouping_type=GroupType.Identity, size: int = None,
+                       after=None):
+        """Get citations of an identfier from the database.
+
+        :param size: Only get the citations of this many groups, in the order
+            of the group IDs.
+        :param after: Only get the citations of the groups after this group
+            ID, i.e. the last group ID of the previous page.
+        """
         grp = get_group_from_id(identifier.value, identifier.scheme,
                                 group_type=grouping_type)
 
@@ -98,8 +255,20 @@ class RelationshipAPI:
             .join(Identifier2Group, target_fk == Identifier2Group.group_id)
             .join(Identifier, Identifier2Group.identifier_id == Identifier.id)
             .order_by(Group.id)
-            .all()
         )
+        if after:
+            res = res.filter(target_fk > after)
+        if size:
+            # Pick the page of groups first, keyset paginated on their IDs
+            group_ids = (
+                db.session.query(target_fk)
+                .filter(object_fk == grp.id,
+                        GroupRelationship.relation == relation)
+                .order_by(target_fk))
+            if after:
+                group_ids = group_ids.filter(target_fk > after)
+            res = res.filter(target_fk.in_(
+                [group_id for group_id, in group_ids.limit(size)]))
         from itertools import groupby
         result = [(k, list(v)) for k, v in groupby(res, key=lambda x: x[1])]
         return result
@@ -48,22 +48,24 @@ def build_id_info(id_: Identifier) -> dict:
 def build_group_metadata(group: Group) -> dict:
     """Build the metadata for a group object."""
     if group.type == GroupType.Version:
-        # Identifiers of the first identity group from all versions
-        id_group = group.groups[0]
+        # Identifiers of the root identity group from all versions
+        id_group = group.root or group.groups[0]
 
-        # Remember visited parents in case of circular relations
+        # Groups created before the roots were stored have no root, so we
+        # walk up the parents (remembering them in case of circular
+        # relations)
         seen_ids = set()
-        while True:
+        while not group.root_id:
             if id_group.id in seen_ids:
                 # Circular dependency. If parent seen, just pick current group
                 break
-            q = GroupRelationship.query.filter_by(
-                target_id=id_group.id, relation=Relation.HasVersion)
-            if not q.first():
+            parent = GroupRelationship.query.filter_by(
+                target_id=id_group.id, relation=Relation.HasVersion).first()
+            if not parent:
                 # If no longer possible to find parents, we are done
                 break
             seen_ids.add(id_group.id)
-            id_group = q.first().source
+            id_group = parent.source
         ids = id_group.identifiers
         doc = deepcopy((id_group.data and id_group.data.json) or {})
         all_ids = sum([g.identifiers for g in group.groups], [])
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 CERN.
+#
+# Asclepias Broker is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Search database models."""
+
+from datetime import datetime
+from typing import Iterable
+
+from invenio_db import db
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy_utils.models import Timestamp
+from sqlalchemy_utils.types import UUIDType
+
+from ..utils import bulk_insert_ignore
+
+
+class DirtyGroup(db.Model, Timestamp):
+    """Group whose relationships have to be reindexed.
+
+    Used by the debounced indexing mode, where the groups touched by events
+    are collected and indexed periodically, instead of after every event.
+    """
+
+    __tablename__ = 'dirtygroup'
+
+    group_id = db.Column(UUIDType, primary_key=True)
+
+    @classmethod
+    def mark(cls, group_ids: Iterable[str]):
+        """Mark groups as dirty, bumping the update time of marked ones.
+
+        The update time tells the indexing if a group was marked again after
+        it was read, in which case it is kept dirty.
+        """
+        group_ids = set(group_ids)
+        if not group_ids:
+            return
+        now = datetime.utcnow()
+        rows = [{'group_id': g, 'created': now, 'updated': now}
+                for g in group_ids]
+        if db.session.get_bind().dialect.name == 'postgresql':
+            stmt = pg_insert(cls.__table__)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[cls.group_id],
+                set_={'updated': stmt.excluded.updated})
+            db.session.execute(stmt, rows)
+        else:
+            bulk_insert_ignore(cls, rows)
+            (cls.query.filter(cls.group_id.in_(group_ids))
+             .update({cls.updated: now}, synchronize_session=False))
+
+    def __repr__(self):
+        """String representation of the dirty group."""
+        return f"<{self.group_id}: {self.created}>"
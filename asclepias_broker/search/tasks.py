@@ -10,10 +10,13 @@
 from typing import List
 
 from celery import chain, group, shared_task
+from flask import current_app
+from invenio_db import db
 
-from ..graph.models import GroupRelationship
+from ..graph.models import Group, GroupM2M, GroupRelationship, GroupType
 from ..utils import chunks
-from .indexer import build_doc, index_documents
+from .indexer import build_doc, index_documents, update_indices
+from .models import DirtyGroup
 from .utils import create_index, rollover_indices
 
 
@@ -49,3 +52,52 @@ def reindex_all_relationships(rollover: bool = True, split: bool = True,
     if rollover:
         task = chain(task, rollover_task.si(keep_old_indices))
     task.apply_async()
+
+
+@shared_task(ignore_result=True)
+def index_dirty_groups(batch_size: int = None):
+    """Index the relationships of the groups marked as dirty.
+
+    The dirty groups are drained in batches, each of which is compacted into
+    a single ``update_indices`` call. Groups that no longer exist (e.g. they
+    were merged), or Identity groups without a Version group, have their
+    relationships deleted from the index. Groups marked again while their
+    batch was indexed are kept dirty.
+    """
+    batch_size = batch_size or \
+        current_app.config['ASCLEPIAS_SEARCH_DIRTY_GROUPS_BATCH_SIZE']
+    while True:
+        # Locked rows are skipped, so that concurrent runs drain different
+        # batches, while groups marked again in the meantime are kept
+        dirty = (
+            DirtyGroup.query.order_by(DirtyGroup.created)
+            .with_for_update(skip_locked=True).limit(batch_size).all())
+        if not dirty:
+            break
+        read_updated = {}
+        for d in dirty:
+            read_updated.setdefault(d.updated, []).append(d.group_id)
+        group_ids = {str(d.group_id) for d in dirty}
+        groups = Group.query.filter(Group.id.in_(group_ids))
+        group_types = {str(g.id): g.type for g in groups}
+        id_groups = {
+            g for g, t in group_types.items() if t == GroupType.Identity}
+        ver_groups = {
+            g for g, t in group_types.items() if t == GroupType.Version}
+        ig_to_vg_map = {}
+        if id_groups:
+            ig_to_vg_map = {
+                str(m.subgroup_id): str(m.group_id)
+                for m in GroupM2M.query.filter(
+                    GroupM2M.subgroup_id.in_(id_groups))}
+        orphan_groups = id_groups - set(ig_to_vg_map)
+        update_indices(
+            id_groups - orphan_groups,
+            (group_ids - set(group_types)) | orphan_groups,
+            ver_groups, set(), ig_to_vg_map)
+        for updated, batch_ids in read_updated.items():
+            (DirtyGroup.query
+             .filter(DirtyGroup.group_id.in_(batch_ids),
+                     DirtyGroup.updated <= updated)
+             .delete(synchronize_session=False))
+        db.session.commit()
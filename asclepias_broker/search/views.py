@@ -6,8 +6,11 @@
 # under the terms of the MIT License; see LICENSE file for more details.
 """Search views."""
 import json
+import uuid
 
-from flask import Blueprint, abort, request
+from flask import Blueprint, Response, abort, current_app, request, \
+    stream_with_context
+from invenio_db import db
 from invenio_oauth2server import require_api_auth
 
 from asclepias_broker.search.api import RelationshipAPI
@@ -17,24 +20,101 @@ from ..core.models import Identifier
 blueprint = Blueprint('asclepias_search', __name__)
 
 
+def _get_page_args():
+    """Get the ``size``, ``after`` and ``stream`` query parameters.
+
+    ``size`` and ``after`` paginate the results, ``after`` being the
+    ``next`` cursor of the previous page. ``stream`` is either ``json`` or
+    ``ndjson``, to stream the results (from ``after``, in pages of ``size``)
+    in a chunked response.
+    """
+    max_size = current_app.config['ASCLEPIAS_SEARCH_PAGE_SIZE']
+    size = request.values.get('size', type=int)
+    if 'size' in request.values and not (size and 0 < size <= max_size):
+        abort(400)
+    after = request.values.get('after')
+    if after:
+        try:
+            after = uuid.UUID(after)
+        except ValueError:
+            abort(400)
+    stream = request.values.get('stream')
+    if stream not in (None, 'json', 'ndjson'):
+        abort(400)
+    return size, after, stream
+
+
+def _iter_pages(get_page, size, after):
+    """Iterate over the pages returned by ``get_page(size, after)``."""
+    while True:
+        page, after = get_page(size, after)
+        yield page
+        # Objects of the streamed pages are not needed anymore
+        db.session.expunge_all()
+        if not after:
+            return
+
+
+def _stream_response(target, pages, stream):
+    """Stream serialized pages as a chunked JSON or NDJSON response.
+
+    In NDJSON, the first line is the target, and every following line is a
+    citation.
+    """
+    def _generate():
+        if stream == 'ndjson':
+            yield json.dumps({'target': target}) + '\n'
+            for page in pages:
+                yield ''.join(json.dumps(c) + '\n' for c in page)
+        else:
+            yield '{"target": %s, "citations": [' % json.dumps(target)
+            separator = ''
+            for page in pages:
+                for citation in page:
+                    yield separator + json.dumps(citation)
+                    separator = ', '
+            yield ']}'
+    mimetype = 'application/x-ndjson' if stream == 'ndjson' \
+        else 'application/json'
+    return Response(stream_with_context(_generate()), mimetype=mimetype)
+
+
 @blueprint.route('/citations/<path:pid_value>')
 @require_api_auth()
 def citations(pid_value):
     """Renders all citations for an identifier."""
-    identifier = Identifier.query.filter_by(
-        scheme='doi', value=pid_value).first()
+    identifier = Identifier.get(pid_value, 'doi')
     if not identifier:
         return abort(404)
-    else:
+    size, after, stream = _get_page_args()
+    if not (size or after or stream):
         citations = RelationshipAPI.get_citations(
             identifier, with_parents=True, with_siblings=True,
             expand_target=True)
-        target = citations[0]
-        citations = citations[1:]
+        # The expanded target comes last
+        target = citations[-1]
+        citations = citations[:-1]
 
         return json.dumps({'target': _target_to_json(target),
                            'citations': _citations_to_json(citations)})
 
+    target = RelationshipAPI.get_target(
+        identifier, with_parents=True, with_siblings=True)
+    size = size or current_app.config['ASCLEPIAS_SEARCH_PAGE_SIZE']
+
+    def _get_page(size, after):
+        citations, cursor = RelationshipAPI.get_citations_page(
+            target, size, after=after)
+        return _citations_to_json(citations), cursor
+
+    if stream:
+        return _stream_response(_target_to_json(target),
+                                _iter_pages(_get_page, size, after), stream)
+    citations, cursor = _get_page(size, after)
+    return json.dumps({'target': _target_to_json(target),
+                       'citations': citations,
+                       'next': cursor and str(cursor)})
+
 
 def _citations_to_json(citations):
     citations_json = []
@@ -75,20 +155,29 @@ def relationships():
     relation = request.values['relation']
     grouping = request.values.get('grouping')  # optional parameter
 
-    identifier = Identifier.query.filter_by(scheme=scheme, value=id_).first()
+    identifier = Identifier.get(id_, scheme)
     if not identifier:
         return abort(404)
-    else:
-        if grouping:
-            citations = RelationshipAPI\
-                .get_citations2(identifier, relation, grouping)
-        else:
-            citations = RelationshipAPI.get_citations2(identifier, relation)
+    size, after, stream = _get_page_args()
+    kwargs = {'grouping_type': grouping} if grouping else {}
 
+    def _get_page(size, after):
+        citations = RelationshipAPI.get_citations2(
+            identifier, relation, size=size, after=after, **kwargs)
         citations_ids = []
         for gid, citlist in citations:
             for grouprel, group, id in citlist:
                 citations_ids.append(id.value)
-
-        return json.dumps({'target': identifier.value,
-                           'citations': citations_ids})
+        cursor = citations[-1][0].id \
+            if size and len(citations) == size else None
+        return citations_ids, cursor
+
+    if stream:
+        size = size or current_app.config['ASCLEPIAS_SEARCH_PAGE_SIZE']
+        return _stream_response(identifier.value,
+                                _iter_pages(_get_page, size, after), stream)
+    citations_ids, cursor = _get_page(size, after)
+    response = {'target': identifier.value, 'citations': citations_ids}
+    if size or after:
+        response['next'] = cursor and str(cursor)
+    return json.dumps(response)
@@ -17,6 +17,9 @@ from typing import Iterable, Iterator, List, Tuple
 
 from flask import current_app
 from invenio_cache import current_cache
+from invenio_db import db
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from werkzeug.utils import import_string
 
 
@@ -80,6 +83,48 @@ def cached_func(prefix: str, key_func, timeout=60 * 60):
         return decorated
     return decorator
 
+
+def is_postgresql() -> bool:
+    """Check if the database of the session is PostgreSQL."""
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+
+def bulk_insert_ignore(model, rows: List[dict]):
+    """Insert rows in a single statement, skipping the already existing ones.
+
+    Uses ``INSERT ... ON CONFLICT DO NOTHING`` on PostgreSQL and
+    ``INSERT OR IGNORE`` on SQLite. On other databases the rows whose primary
+    key already exists are filtered out with a query before inserting.
+
+    :param model: The SQLAlchemy model to insert the rows for.
+    :param rows: List of column-value dictionaries.
+    """
+    if not rows:
+        return
+    table = model.__table__
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        stmt = pg_insert(table).on_conflict_do_nothing()
+    elif dialect == 'sqlite':
+        stmt = table.insert().prefix_with('OR IGNORE')
+    else:
+        pk_cols = [c.name for c in table.primary_key.columns]
+        first_pk = table.c[pk_cols[0]]
+        existing = set(db.session.execute(
+            select([table.c[c] for c in pk_cols])
+            .where(first_pk.in_({row[pk_cols[0]] for row in rows}))))
+        unique_rows = {}
+        for row in rows:
+            key = tuple(row[c] for c in pk_cols)
+            if key not in existing:
+                unique_rows.setdefault(key, row)
+        rows = list(unique_rows.values())
+        if not rows:
+            return
+        stmt = table.insert()
+    db.session.execute(stmt, rows)
+
+
 class GitHubAPIException(Exception):
     """Github exception."""
 
@@ -46,6 +46,7 @@ setup(
             'search = asclepias_broker.search.cli:search',
             'harvester = asclepias_broker.harvester.cli:harvester',
             'monitor = asclepias_broker.monitoring.cli:monitor',
+            'graph = asclepias_broker.graph.cli:graph',
         ],
         'invenio_config.module': [
             'asclepias_broker = asclepias_broker.config',
@@ -70,6 +71,7 @@ setup(
              'asclepias_broker.search.views:blueprint'),
         ],
         'invenio_celery.tasks': [
+            'asclepias_broker_events_tasks = asclepias_broker.events.tasks',
             'asclepias_broker_graph_tasks = asclepias_broker.graph.tasks',
             'asclepias_broker_search_tasks = asclepias_broker.search.tasks',
             'asclepias_harvester_tasks = asclepias_broker.harvester.tasks',
@@ -80,6 +82,7 @@ setup(
             'asclepias_broker_events = asclepias_broker.events.models',
             'asclepias_broker_graph = asclepias_broker.graph.models',
             'asclepias_broker_metadata = asclepias_broker.metadata.models',
+            'asclepias_broker_search = asclepias_broker.search.models',
         ],
         'invenio_pidstore.fetchers': [
             'relid = asclepias_broker.pidstore:relid_fetcher',
@@ -11,9 +11,30 @@ from __future__ import absolute_import, print_function
 
 import pytest
 from invenio_app.factory import create_api
+from invenio_oauth2server.models import Token
 
 
 @pytest.fixture(scope='module')
 def create_app():
     """."""
     return create_api
+
+
+@pytest.fixture
+def access_token(app, db):
+    datastore = app.extensions['security'].datastore
+    user = datastore.create_user(email='test@mail', password='', active=True)
+    db.session.commit()
+    token = Token.create_personal(
+        't', user.id, scopes=[], is_internal=True).access_token
+    db.session.commit()
+    return token
+
+
+@pytest.fixture
+def auth_headers(access_token):
+    return {
+        'Content-Type': 'application/json',
+        'Accept': 'application/json',
+        'Authorization': f'Bearer {access_token}',
+    }
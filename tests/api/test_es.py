@@ -7,11 +7,17 @@
 
 """Test ElasticSearch indexing."""
 
-from helpers import assert_es_equals_db, generate_payload, \
-    reindex_all_relationships
+from helpers import assert_es_equals_db, create_objects_from_relations, \
+    generate_payload, reindex_all_relationships
 from invenio_search import current_search
 
+from asclepias_broker.core.models import Relation
 from asclepias_broker.events.api import EventAPI
+from asclepias_broker.graph.api import get_group_from_id
+from asclepias_broker.graph.models import GroupM2M
+from asclepias_broker.search import tasks as search_tasks
+from asclepias_broker.search.models import DirtyGroup
+from asclepias_broker.search.tasks import index_dirty_groups
 
 
 def _group_data(id_):
@@ -59,3 +65,52 @@ def test_simple_groups(db, es_clear):
         _rel_with_metadata('X', 'IsIdenticalTo', 'Y'),
     ]
     _run_events_and_compare(events)
+
+
+def test_debounced_indexing(app, db, es_clear, monkeypatch):
+    """Test indexing the dirty groups of debounced events."""
+    monkeypatch.setitem(app.config, 'ASCLEPIAS_SEARCH_INDEXING_ENABLED', True)
+    monkeypatch.setitem(
+        app.config, 'ASCLEPIAS_SEARCH_INDEXING_DEBOUNCED', True)
+    current_search.flush_and_refresh('relationships')
+    events = [
+        _rel_with_metadata('A', 'Cites', 'X'),
+        _rel_with_metadata('B', 'Cites', 'X'),
+        _rel_with_metadata('A', 'IsIdenticalTo', 'B'),
+    ]
+    for ev in events:
+        EventAPI.handle_event(generate_payload(ev))
+    assert DirtyGroup.query.count() > 0
+
+    index_dirty_groups.si(batch_size=2).apply(throw=True)
+    assert DirtyGroup.query.count() == 0
+    assert_es_equals_db()
+
+
+def test_index_dirty_groups_marked_again(db, monkeypatch):
+    """Test that groups marked again while being indexed are kept dirty."""
+    create_objects_from_relations([('A', Relation.Cites, 'B')])
+    group_a = str(get_group_from_id('A').id)
+    group_b = str(get_group_from_id('B').id)
+    # An Identity group without a Version group
+    GroupM2M.query.filter_by(subgroup_id=group_b).delete()
+    DirtyGroup.mark([group_a, group_b])
+    db.session.commit()
+
+    calls = []
+
+    def _update_indices(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            DirtyGroup.mark([group_a])
+    monkeypatch.setattr(search_tasks, 'update_indices', _update_indices)
+
+    index_dirty_groups.si().apply(throw=True)
+    assert len(calls) == 2
+    idx_ig, del_ig, _, _, _ = calls[0]
+    assert idx_ig == {group_a}
+    assert del_ig == {group_b}
+    idx_ig, del_ig, _, _, _ = calls[1]
+    assert idx_ig == {group_a}
+    assert not del_ig
+    assert DirtyGroup.query.count() == 0
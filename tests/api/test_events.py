@@ -9,34 +9,14 @@
 import json
 from copy import deepcopy
 
-import pytest
 from flask import url_for
-from helpers import assert_es_equals_db, reindex_all_relationships
-from invenio_oauth2server.models import Token
+from helpers import assert_es_equals_db, generate_payload, \
+    reindex_all_relationships
 
+from asclepias_broker.events.models import Event
 from asclepias_broker.jsonschemas import EVENT_SCHEMA
 
 
-@pytest.fixture
-def access_token(app, db):
-    datastore = app.extensions['security'].datastore
-    user = datastore.create_user(email='test@mail', password='', active=True)
-    db.session.commit()
-    token = Token.create_personal(
-        't', user.id, scopes=[], is_internal=True).access_token
-    db.session.commit()
-    return token
-
-
-@pytest.fixture
-def auth_headers(access_token):
-    return {
-        'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {access_token}',
-    }
-
-
 def test_endpoint_auth(client):
     """Load the example events from asclepias_broker/examples."""
     event_url = url_for('asclepias_events.event', _external=True)
@@ -123,3 +103,32 @@ def test_invalid_payload(client, db, es, auth_headers):
     # assert resp.status_code == 422
     # assert resp.json['message'].startswith(
     #     "Validation error") and 'Invalid scheme' in resp.json['message']
+
+
+def test_event_stream(app, client, db, es, auth_headers):
+    """Test newline-delimited event ingestion."""
+    stream_url = url_for('asclepias_events.event_stream', _external=True)
+    headers = dict(auth_headers, **{'Content-Type': 'application/x-ndjson'})
+    links = generate_payload([
+        ['A', 'Cites', 'B'],
+        ['C', 'Cites', 'B'],
+        ['D', 'Cites', 'B'],
+    ])
+    data = '\n'.join(json.dumps(link) for link in links) + '\n'
+
+    app.config['ASCLEPIAS_EVENT_STREAM_CHUNK_SIZE'] = 2
+    resp = client.post(stream_url, data=data, headers=headers)
+    assert resp.status_code == 202
+    event_ids = resp.json['event_ids']
+    assert len(event_ids) == 2
+    assert [len(Event.get(e).payload) for e in event_ids] == [2, 1]
+
+    # Invalid lines are reported, along with the already accepted events
+    data = '\n'.join([json.dumps(links[0]), '{"invalid": "true"}'])
+    resp = client.post(stream_url, data=data, headers=headers)
+    assert resp.status_code == 422
+    assert resp.json['line'] == 2
+    assert resp.json['event_ids'] == []
+
+    resp = client.post(stream_url, data='', headers=headers)
+    assert resp.status_code == 422
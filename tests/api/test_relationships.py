@@ -7,10 +7,15 @@
 
 """Test search endpoint."""
 
+import json
+
 from flask import url_for
-from helpers import generate_payload, reindex_all_relationships
+from helpers import create_objects_from_relations, generate_payload, \
+    reindex_all_relationships
 
+from asclepias_broker.core.models import Identifier, Relation, Relationship
 from asclepias_broker.events.api import EventAPI
+from asclepias_broker.search.api import RelationshipAPI
 
 
 def test_invalid_search_parameters(client):
@@ -98,3 +103,114 @@ def test_simple_citations(client, db, es_clear):
         resp = client.get(search_url, query_string=params)
         assert resp.status_code == 200
         assert resp.json['hits']['total'] == 0
+
+
+def _json(resp):
+    return json.loads(resp.get_data(as_text=True))
+
+
+def _citing_pids(citations):
+    return {pid for c in citations for pid in c['PIDs']}
+
+
+def test_citations_pages(client, db, auth_headers):
+    """Test the pages of the DB citations."""
+    create_objects_from_relations([
+        (src, Relation.Cites, 'X') for src in ('A', 'B', 'C')])
+    # A citing identifier that is not grouped yet
+    db.session.add(Relationship(
+        source=Identifier(value='D', scheme='doi'),
+        target=Identifier.get('X', 'doi'), relation=Relation.Cites))
+    db.session.commit()
+    url = url_for('asclepias_search.citations', pid_value='X')
+
+    resp = client.get(url, headers=auth_headers)
+    assert resp.status_code == 200
+    assert _citing_pids(_json(resp)['citations']) == set('ABCD')
+
+    # The pages are chained by their "next" cursor
+    pids, after, pages = set(), None, 0
+    while True:
+        params = {'size': 3, **({'after': after} if after else {})}
+        resp = client.get(url, headers=auth_headers, query_string=params)
+        assert resp.status_code == 200
+        assert _json(resp)['target']['equivalentPIDs'] == ['X']
+        pids |= _citing_pids(_json(resp)['citations'])
+        pages += 1
+        after = _json(resp)['next']
+        if not after:
+            break
+    assert pages == 2
+    assert pids == set('ABCD')
+
+    resp = client.get(url, headers=auth_headers,
+                      query_string={'size': 1, 'stream': 'json'})
+    assert resp.status_code == 200
+    assert resp.mimetype == 'application/json'
+    data = json.loads(resp.get_data(as_text=True))
+    assert data['target']['equivalentPIDs'] == ['X']
+    assert _citing_pids(data['citations']) == set('ABCD')
+
+    resp = client.get(url, headers=auth_headers,
+                      query_string={'size': 3, 'stream': 'ndjson'})
+    assert resp.status_code == 200
+    assert resp.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in
+             resp.get_data(as_text=True).splitlines()]
+    assert lines[0] == {'target': data['target']}
+    assert len(lines) == 5
+    assert _citing_pids(lines[1:]) == set('ABCD')
+
+
+def test_page_args(app, client, db, auth_headers):
+    """Test the validation of the page parameters."""
+    create_objects_from_relations([('A', Relation.Cites, 'X')])
+    url = url_for('asclepias_search.citations', pid_value='X')
+    max_size = app.config['ASCLEPIAS_SEARCH_PAGE_SIZE']
+    for params in ({'size': 0}, {'size': max_size + 1}, {'size': 'a'},
+                   {'after': 'not-a-uuid'}, {'stream': 'xml'}):
+        resp = client.get(url, headers=auth_headers, query_string=params)
+        assert resp.status_code == 400
+    resp = client.get(url, headers=auth_headers,
+                      query_string={'size': max_size})
+    assert resp.status_code == 200
+
+
+def test_db_relationships_pages(client, db, auth_headers):
+    """Test the pages of the DB relationships."""
+    create_objects_from_relations([
+        (src, Relation.Cites, 'X') for src in ('A', 'B', 'C')])
+    url = url_for('asclepias_search.relationships')
+    params = {'id': 'X', 'scheme': 'doi', 'relation': 'IsCitedBy'}
+
+    resp = client.get(url, headers=auth_headers, query_string=params)
+    assert resp.status_code == 200
+    assert set(_json(resp)['citations']) == set('ABC')
+    assert 'next' not in _json(resp)
+
+    resp = client.get(url, headers=auth_headers,
+                      query_string={**params, 'size': 2})
+    first = _json(resp)['citations']
+    assert len(first) == 2
+    resp = client.get(url, headers=auth_headers, query_string={
+        **params, 'size': 2, 'after': _json(resp)['next']})
+    assert len(_json(resp)['citations']) == 1
+    assert _json(resp)['next'] is None
+    assert set(first + _json(resp)['citations']) == set('ABC')
+
+    resp = client.get(url, headers=auth_headers,
+                      query_string={**params, 'size': 2, 'stream': 'ndjson'})
+    lines = resp.get_data(as_text=True).splitlines()
+    assert json.loads(lines[0]) == {'target': 'X'}
+    assert {json.loads(line) for line in lines[1:]} == set('ABC')
+
+    # Pages of groups, from the group after the cursor
+    identifier = Identifier.get('X', 'doi')
+    page = RelationshipAPI.get_citations2(identifier, 'IsCitedBy', size=2)
+    assert len(page) == 2
+    rest = RelationshipAPI.get_citations2(
+        identifier, 'IsCitedBy', size=2, after=page[-1][0].id)
+    assert len(rest) == 1
+    assert [g.id for g, _ in page] < [g.id for g, _ in rest]
+    assert {i.value for _, rows in page + rest for _, _, i in rows} == \
+        set('ABC')
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 CERN.
+#
+# Asclepias Broker is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Benchmarks configuration and fixtures.
+
+Tests marked with ``benchmark`` are only run when ``ASCLEPIAS_BENCHMARKS`` is
+set, and their results are printed after the tests, e.g. with
+``ASCLEPIAS_BENCHMARKS=1 pytest tests/benchmarks``.
+"""
+
+import os
+
+import pytest
+
+_results = []
+
+
+def pytest_configure(config):
+    """Register the ``benchmark`` marker."""
+    config.addinivalue_line(
+        'markers', 'benchmark: only run when ASCLEPIAS_BENCHMARKS is set')
+
+
+def pytest_collection_modifyitems(config, items):
+    """Skip the benchmarks unless ``ASCLEPIAS_BENCHMARKS`` is set."""
+    if os.environ.get('ASCLEPIAS_BENCHMARKS'):
+        return
+    skip = pytest.mark.skip(
+        reason='Benchmarks are only run when ASCLEPIAS_BENCHMARKS is set.')
+    for item in items:
+        if item.get_closest_marker('benchmark'):
+            item.add_marker(skip)
+
+
+def pytest_terminal_summary(terminalreporter):
+    """Print the reported benchmark results."""
+    if _results:
+        terminalreporter.section('benchmarks')
+        for line in _results:
+            terminalreporter.write_line(line)
+
+
+@pytest.fixture
+def report(request):
+    """Report a benchmark result of the test."""
+    def _report(message):
+        _results.append(f'{request.node.name}: {message}')
+    return _report
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 CERN.
+#
+# Asclepias Broker is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Benchmark the citations query.
+
+Run with ``ASCLEPIAS_BENCHMARKS=1 pytest tests/benchmarks``.
+"""
+
+import time
+import uuid
+
+import pytest
+from invenio_db import db
+from sqlalchemy import event
+
+from asclepias_broker.core.models import Identifier, Relation, Relationship
+from asclepias_broker.graph.builder import build_graph
+from asclepias_broker.search.api import RelationshipAPI
+
+pytestmark = pytest.mark.benchmark
+
+
+def _create_citations(n_citations):
+    """Create ``n_citations`` citing papers, each with an identical one."""
+    target_id = uuid.uuid4()
+    identifiers = [dict(id=target_id, value='A', scheme='doi')]
+    relationships = []
+    for i in range(n_citations):
+        src_id, alias_id = uuid.uuid4(), uuid.uuid4()
+        identifiers += [dict(id=src_id, value=f'X{i}', scheme='doi'),
+                        dict(id=alias_id, value=f'Y{i}', scheme='doi')]
+        relationships += [
+            dict(id=uuid.uuid4(), source_id=src_id, target_id=target_id,
+                 relation=Relation.Cites),
+            dict(id=uuid.uuid4(), source_id=src_id, target_id=alias_id,
+                 relation=Relation.IsIdenticalTo),
+        ]
+    db.session.execute(Identifier.__table__.insert(), identifiers)
+    db.session.execute(Relationship.__table__.insert(), relationships)
+    db.session.commit()
+    build_graph(metadata=False)
+
+
+@pytest.mark.parametrize('n_citations', [1000, 10000, 100000])
+def test_get_citations(db, report, n_citations):
+    """Get the citations of an identifier cited by many papers."""
+    _create_citations(n_citations)
+    queries = []
+
+    def _count(*args):
+        queries.append(args)
+
+    event.listen(db.engine, 'before_cursor_execute', _count)
+    start = time.perf_counter()
+    citations = RelationshipAPI.get_citations(
+        Identifier.get('A', 'doi'), with_parents=True, with_siblings=True,
+        expand_target=True)
+    duration = time.perf_counter() - start
+    event.remove(db.engine, 'before_cursor_execute', _count)
+    report(f'{n_citations} citations in {duration:.2f}s '
+           f'({len(queries)} queries)')
+
+    assert len(citations) == n_citations + 1
+    assert all(len(ids) == 2 for ids, _ in citations[:-1])
+    # The number of queries does not depend on the number of citations
+    assert len(queries) <= 10
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 CERN.
+#
+# Asclepias Broker is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Benchmark group merging.
+
+Run with ``ASCLEPIAS_BENCHMARKS=1 pytest tests/benchmarks``.
+"""
+
+import time
+
+import pytest
+from invenio_db import db
+
+from asclepias_broker.core.models import Identifier, Relation, Relationship
+from asclepias_broker.graph.api import add_group_relationship, \
+    get_or_create_groups, merge_identity_groups
+from asclepias_broker.graph.models import GroupRelationship
+
+pytestmark = pytest.mark.benchmark
+
+
+def _create_citations(sources, n_targets):
+    """Create ``sources`` citing the same ``n_targets`` identifiers."""
+    groups = {}
+    for value in sources + [f'X{i}' for i in range(n_targets)]:
+        identifier = Identifier(value=value, scheme='doi')
+        db.session.add(identifier)
+        groups[value] = (identifier, *get_or_create_groups(identifier))
+    for src in sources:
+        src_id, src_idg, src_vg = groups[src]
+        for i in range(n_targets):
+            trg_id, trg_idg, trg_vg = groups[f'X{i}']
+            rel = Relationship(
+                source=src_id, target=trg_id, relation=Relation.Cites)
+            db.session.add(rel)
+            add_group_relationship(rel, src_idg, trg_idg, src_vg, trg_vg)
+    db.session.commit()
+    return groups
+
+
+@pytest.mark.parametrize('n_targets', [5000])
+def test_merge_identity_groups(db, report, n_targets):
+    """Merge two identity groups with duplicate relationships."""
+    groups = _create_citations(['A', 'B'], n_targets)
+    assert Relationship.query.count() == 2 * n_targets
+
+    start = time.perf_counter()
+    merge_identity_groups(groups['A'][1], groups['B'][1])
+    db.session.commit()
+    duration = time.perf_counter() - start
+    report(f'merged {2 * n_targets} relationships in {duration:.2f}s')
+
+    # Identity and version group relationships were squashed
+    assert GroupRelationship.query.count() == 2 * n_targets
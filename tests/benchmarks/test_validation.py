@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 CERN.
+#
+# Asclepias Broker is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Benchmark event payload validation.
+
+Run with ``ASCLEPIAS_BENCHMARKS=1 pytest tests/benchmarks``.
+"""
+
+import time
+
+import jsonschema
+import pytest
+from flask import current_app
+from helpers import generate_payload
+
+from asclepias_broker.events.api import EventAPI
+from asclepias_broker.jsonschemas import EVENT_SCHEMA, SCHOLIX_SCHEMA
+from asclepias_broker.schemas.loaders import RelationshipSchema
+
+pytestmark = pytest.mark.benchmark
+
+
+def _validate_payload_uncached(event):
+    """Event validation as done before caching the validator."""
+    schema_host = current_app.config['JSONSCHEMAS_HOST']
+    schema_store = {
+        f'{schema_host}/scholix-v3.json': SCHOLIX_SCHEMA,
+        f'{schema_host}/event.json': EVENT_SCHEMA,
+    }
+    resolver = jsonschema.RefResolver(schema_host, EVENT_SCHEMA, schema_store)
+    jsonschema.Draft4Validator(EVENT_SCHEMA, resolver=resolver).validate(event)
+    for payload in event:
+        assert not RelationshipSchema(check_existing=True).validate(payload)
+
+
+def _timeit(func, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def test_validation_per_1k_payloads(db, report):
+    """Compare the validation cost per 1k payloads."""
+    # Events have at most 100 payloads
+    events = [
+        generate_payload([
+            (f'10.1234/{i}', 'Cites', f'10.1234/{i + 1}')
+            for i in range(start, start + 100)])
+        for start in range(0, 1000, 100)]
+    # Some of the identifiers are already known
+    for event in events[:5]:
+        EventAPI.handle_event(event, no_index=True, eager=True)
+
+    def _validate_all(validate):
+        for event in events:
+            validate(event)
+
+    before = _timeit(_validate_all, _validate_payload_uncached)
+    after = _timeit(_validate_all, EventAPI.validate_payload)
+    report(f'validation per 1k payloads: '
+           f'before {before:.3f}s, after {after:.3f}s')
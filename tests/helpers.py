@@ -185,6 +185,33 @@ def create_objects_from_relations(relationships: List[Tuple],
     db.session.commit()
 
 
+def create_relationships(relationships: List[Tuple]) -> List[Relationship]:
+    """Create the Identifiers and Relationships of a list of relationships.
+
+    Unlike :func:`create_objects_from_relations`, no groups are created, and
+    the session is only flushed.
+
+    E.g.:
+        relationships = [
+            ('A', Relation.Cites, 'B'),
+            ('A', Relation.IsIdenticalTo, 'C'),
+        ]
+    """
+    def _get_or_create(value):
+        return Identifier.get(value, 'doi') or \
+            Identifier(value=value, scheme='doi')
+
+    rel_obj = []
+    for src, rel, tar in relationships:
+        r = Relationship(
+            source=_get_or_create(src), target=_get_or_create(tar),
+            relation=rel)
+        db.session.add(r)
+        db.session.flush()
+        rel_obj.append(r)
+    return rel_obj
+
+
 def assert_grouping(grouping):
     """Determine if database state corresponds to 'grouping' definition.
 
@@ -279,8 +306,13 @@ def assert_grouping(grouping):
     # Make sure that GroupRelationshipM2M are correct
     id_grp_rels = [r for r, t in zip(rel_map, relationship_types)
                    if t == GroupType.Identity]
-    # There are as many GroupRelationshipM2M objects as Identity Groups
-    assert GroupRelationshipM2M.query.count() == len(id_grp_rels)
+    # There are as many GroupRelationshipM2M objects as Identity group
+    # relationships within Version group relationships (none within a single
+    # Version group)
+    n_grrel_m2m = sum([len(x[1]) for x in relationship_groups
+                       if isinstance(rel_map[x[0]], GroupRelationship) and
+                       relationship_types[x[0]] == GroupType.Version])
+    assert GroupRelationshipM2M.query.count() == n_grrel_m2m
 
     # Same number of GroupRelationshipMetadata as GRelationships of type ID
     assert GroupRelationshipMetadata.query.count() == len(id_grp_rels)
@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 CERN.
+#
+# Asclepias Broker is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Test event processing."""
+
+import threading
+
+import pytest
+from flask import current_app
+from helpers import create_objects_from_relations, generate_payload
+
+from asclepias_broker.core.models import Identifier, Relation, Relationship
+from asclepias_broker.events.api import EventAPI
+from asclepias_broker.events.models import Event, EventOrigin, EventStatus, \
+    ObjectEvent, PayloadHash, PayloadType
+from asclepias_broker.events.rerun import EventRerun
+from asclepias_broker.graph.api import get_group_from_id, \
+    merge_identity_groups, merge_version_groups
+from asclepias_broker.graph.locks import LockNotAvailable, \
+    lock_identifier_groups, lock_identifier_values, run_with_lock_retries
+from asclepias_broker.graph.models import GroupRelationship, GroupType
+from asclepias_broker.graph.tasks import process_event, remove_relationship
+from asclepias_broker.utils import is_postgresql
+
+
+def test_event_object_events(db):
+    """Test the objects events created while processing an event."""
+    event = EventAPI.handle_event(generate_payload([
+        ['A', 'Cites', 'B'],
+        ['A', 'Cites', 'C'],
+        # Repeated payloads of the same event are skipped
+        ['A', 'Cites', 'B'],
+    ]), no_index=True)
+    event = Event.get(event.id)
+    assert event.status == EventStatus.Done
+    # Links parsed on ingestion are stored for the worker
+    assert event.parsed == [
+        ['A', 'doi', 'Cites', 'B', 'doi'],
+        ['A', 'doi', 'Cites', 'C', 'doi'],
+        ['A', 'doi', 'Cites', 'B', 'doi'],
+    ]
+    assert Identifier.query.count() == 3
+    assert Relationship.query.count() == 2
+
+    object_events = ObjectEvent.query.filter_by(event_id=event.id).all()
+    assert len(object_events) == 6
+    rel_events = {
+        (oe.object.source.value, oe.object.target.value): oe.payload_index
+        for oe in object_events
+        if oe.payload_type == PayloadType.Relationship
+    }
+    assert rel_events == {('A', 'B'): 0, ('A', 'C'): 1}
+
+    # Already known relationships of a later event are skipped
+    event = EventAPI.handle_event(generate_payload([
+        ['A', 'Cites', 'C'],
+        ['D', 'Cites', 'A'],
+    ]), no_index=True)
+    assert Identifier.query.count() == 4
+    assert Relationship.query.count() == 3
+    object_events = ObjectEvent.query.filter_by(event_id=event.id).all()
+    assert len(object_events) == 3
+    assert {oe.payload_index for oe in object_events} == {1}
+
+
+def test_event_processed_payloads(db):
+    """Test that already processed payloads are skipped."""
+    event = EventAPI.handle_event(generate_payload([
+        ['A', 'Cites', 'B'],
+        ['A', 'Cites', 'B'],
+    ]), no_index=True)
+    event = Event.get(event.id)
+    assert event.skipped_payloads == 1
+    assert PayloadHash.query.count() == 1
+    payload_hash = PayloadHash.query.one()
+    assert payload_hash.event_id == event.id
+    assert payload_hash.payload_index == 0
+
+    # Key order does not change the content hash
+    payload = generate_payload(['A', 'Cites', 'B'])[0]
+    assert PayloadHash.compute(payload) == PayloadHash.compute(
+        dict(reversed(list(payload.items()))))
+
+    event = EventAPI.handle_event(generate_payload([
+        ['A', 'Cites', 'B'],
+        ['A', 'Cites', 'C'],
+    ]), no_index=True)
+    event = Event.get(event.id)
+    assert event.status == EventStatus.Done
+    assert event.skipped_payloads == 1
+    assert PayloadHash.query.count() == 2
+    assert Relationship.query.count() == 2
+    object_events = ObjectEvent.query.filter_by(event_id=event.id).all()
+    assert {oe.payload_index for oe in object_events} == {1}
+
+    # A rerun ignores the hashes stored by the event itself
+    EventAPI.rerun_event(event, no_index=True, eager=True)
+    event = Event.get(event.id)
+    assert event.status == EventStatus.Done
+    assert event.skipped_payloads == 1
+    assert PayloadHash.query.count() == 2
+
+    # The hashes of deleted relationships are deleted
+    relationship = Relationship.query.join(
+        Identifier, Relationship.target_id == Identifier.id).filter(
+            Identifier.value == 'B').one()
+    assert PayloadHash.query.filter_by(
+        relationship_id=relationship.id).count() == 1
+    remove_relationship(relationship, indexing_enabled=False)
+    assert PayloadHash.query.count() == 1
+    event = EventAPI.handle_event(generate_payload([
+        ['A', 'Cites', 'B'],
+    ]), no_index=True)
+    assert Event.get(event.id).skipped_payloads == 0
+    assert Relationship.query.count() == 2
+
+
+def test_event_metadata_merge(db):
+    """Test the metadata of an event merging groups it also describes."""
+    def _links(p):
+        return [
+            [f'{p}A', 'Cites', f'{p}X',
+             {'Source': {'Title': 'A title'}, 'LinkPublicationDate':
+              '2018-01-02'}],
+            [f'{p}B', 'Cites', f'{p}X', {'Source': {'Title': 'B title'}}],
+            [f'{p}A', 'IsIdenticalTo', f'{p}B'],
+            [f'{p}B', 'Cites', f'{p}Y', {'Target': {'Title': 'Y title'}}],
+        ]
+
+    for p in ('event', 'ref'):
+        EventAPI.handle_event(generate_payload([
+            [f'{p}A', 'Cites', f'{p}Z', {'Source': {'Title': 'Old title'}}],
+        ]), no_index=True)
+
+    # The whole event, grouped before its metadata is applied...
+    event = EventAPI.handle_event(
+        generate_payload(_links('event')), no_index=True)
+    assert Event.get(event.id).status == EventStatus.Done
+
+    # ...and the same links as separate events
+    for link in _links('ref'):
+        EventAPI.handle_event(generate_payload(link), no_index=True)
+
+    def _metadata(p):
+        group = get_group_from_id(f'{p}A')
+        return (
+            group.data.json,
+            get_group_from_id(f'{p}Y').data.json,
+            GroupRelationship.query.filter_by(
+                source=group, target=get_group_from_id(f'{p}X'),
+                type=GroupType.Identity).one().data.json,
+        )
+
+    assert _metadata('event') == _metadata('ref')
+    assert _metadata('event')[0]['Title'] == 'B title'
+
+
+def test_event_origin(db):
+    """Test the event origins and the backlog per lane."""
+    user_event = EventAPI.handle_event(
+        generate_payload(['A', 'Cites', 'B']), no_index=True)
+    harvester_event = EventAPI.handle_event(
+        generate_payload(['C', 'Cites', 'D']), no_index=True,
+        origin=EventOrigin.Harvester)
+    assert Event.get(user_event.id).origin == EventOrigin.User
+    assert Event.get(harvester_event.id).origin == EventOrigin.Harvester
+
+    new_event = Event(payload=[], status=EventStatus.New,
+                      origin=EventOrigin.Harvester)
+    error_event = Event(payload=[], status=EventStatus.Error,
+                        origin=EventOrigin.User)
+    db.session.add_all([new_event, error_event])
+    db.session.commit()
+    assert Event.getBacklog() == {
+        EventOrigin.Harvester: 1,
+        EventOrigin.Rerun: 1,
+    }
+
+
+def test_event_rerun(db):
+    """Test the checkpointed event reruns."""
+    events = []
+    for src in ('A', 'B', 'C'):
+        event = EventAPI.handle_event(
+            generate_payload([src, 'Cites', 'X']), no_index=True)
+        events.append(event.id)
+    Event.query.update({Event.status: EventStatus.Error})
+    db.session.commit()
+
+    query = Event.query.filter(Event.status == EventStatus.Error)
+    rerun = EventRerun('test', query, eager=True, batch_size=1)
+    # Resume after the first event
+    first = Event.get(events[0])
+    rerun.checkpoint = (first.created, str(first.id))
+    progress = rerun.run()
+    assert progress.dispatched == 2
+    assert progress.failed == 0
+    assert rerun.checkpoint is None
+    assert Event.get(events[0]).status == EventStatus.Error
+    assert Event.get(events[1]).status == EventStatus.Done
+    assert Event.get(events[2]).status == EventStatus.Done
+    # The payloads of the rerun events are not skipped as already processed
+    assert Event.get(events[1]).skipped_payloads == 0
+    assert Event.get(events[2]).skipped_payloads == 0
+
+
+def test_event_rerun_resume(db, monkeypatch):
+    """Test resuming a rerun that stopped to wait for its events."""
+    events = []
+    for src in ('A', 'B'):
+        event = EventAPI.handle_event(
+            generate_payload([src, 'Cites', 'X']), no_index=True)
+        events.append(event.id)
+    Event.query.update({Event.status: EventStatus.Error})
+    db.session.commit()
+    # The dispatched events are not processed until they are marked Done
+    dispatched = []
+    monkeypatch.setattr(EventAPI, 'rerun_event', classmethod(
+        lambda cls, event, no_index: dispatched.append(event.id)))
+
+    def _rerun():
+        query = Event.query.filter(Event.status == EventStatus.Error)
+        return EventRerun('test', query, max_in_flight=1).run(block=False)
+
+    progress = _rerun()
+    assert progress.waiting
+    assert dispatched == events[:1]
+
+    # A new rerun resumes after the processed event
+    Event.get(events[0]).status = EventStatus.Done
+    db.session.commit()
+    progress = _rerun()
+    assert progress.waiting
+    assert progress.completed == 1
+    assert dispatched == events
+
+    Event.get(events[1]).status = EventStatus.Done
+    db.session.commit()
+    progress = _rerun()
+    assert not progress.waiting
+    assert progress.completed == 1
+    assert dispatched == events
+    assert EventRerun('test', None).checkpoint is None
+
+
+def test_event_archive(db):
+    """Test archiving and rehydrating the payloads of processed events."""
+    payload = generate_payload([
+        ['A', 'Cites', 'B'],
+        ['A', 'Cites', 'C'],
+    ])
+    event = EventAPI.handle_event(payload, no_index=True)
+    assert EventAPI.archive_events(0) == 1
+    # Already archived events are skipped
+    assert EventAPI.archive_events(0) == 0
+
+    event = Event.get(event.id)
+    assert event.payload is None
+    assert event.archive.codec == 'gzip'
+    assert event.archive.n_payloads == 2
+    assert event.get_payload() == payload
+    object_events = ObjectEvent.query.filter_by(event_id=event.id)
+    assert {oe.payload_index: oe.payload['Target']['Identifier']['ID']
+            for oe in object_events} == {0: 'B', 1: 'C'}
+
+
+def test_event_partition(db):
+    """Test the partitions of the events."""
+    create_objects_from_relations([
+        ('A', Relation.Cites, 'C'),
+        ('B', Relation.Cites, 'C'),
+        ('D', Relation.Cites, 'E'),
+    ])
+    merge_identity_groups(get_group_from_id('A'), get_group_from_id('B'))
+    merge_version_groups(
+        get_group_from_id('D', group_type=GroupType.Version),
+        get_group_from_id('E', group_type=GroupType.Version))
+    db.session.commit()
+
+    def _partition(*links):
+        event = Event(payload=[], parsed=[
+            [src, 'doi', 'Cites', trg, 'doi'] for src, trg in links])
+        return EventAPI.get_partition(event, 16)
+
+    assert 0 <= _partition(('A', 'C')) < 16
+    # Events are partitioned by the Version groups of their sources
+    assert _partition(('A', 'C')) == _partition(('B', 'X'))
+    assert _partition(('D', 'A')) == _partition(('E', 'C'))
+    assert _partition(('A', 'C'), ('B', 'D')) == _partition(('A', 'C'))
+    # Unknown identifiers are partitioned by their value
+    assert _partition(('X', 'Y')) == _partition(('X', 'A'))
+    # Events whose sources span several partitions have none
+    sources = {}
+    for value in ('C', 'D', 'X', 'Y', 'Z'):
+        sources.setdefault(_partition((value, 'A')), value)
+    assert len(sources) > 1
+    src_a, src_b = list(sources.values())[:2]
+    assert _partition((src_a, 'A'), (src_b, 'A')) is None
+
+
+def test_event_concurrent_new_identifier(db):
+    """Test that concurrent events create a new identifier only once."""
+    if not is_postgresql():
+        pytest.skip('Advisory locks require PostgreSQL.')
+    events = []
+    for src in ('A', 'B'):
+        event = Event(
+            payload=generate_payload([src, 'Cites', '10.1234/new']),
+            parsed=[[src, 'doi', 'Cites', '10.1234/new', 'doi']],
+            status=EventStatus.New)
+        db.session.add(event)
+        events.append(event)
+    db.session.commit()
+    event_ids = [str(e.id) for e in events]
+
+    # Both workers wait for the lock on the new identifier, which is held
+    # here, and then process their events one after the other
+    lock_identifier_values([('10.1234/NEW', 'doi')])
+    app = current_app._get_current_object()
+
+    def _process(event_id):
+        with app.app_context():
+            process_event.apply(
+                kwargs=dict(event_uuid=event_id, indexing_enabled=False),
+                throw=True)
+            db.session.remove()
+
+    workers = [threading.Thread(target=_process, args=(event_id, ))
+               for event_id in event_ids]
+    for worker in workers:
+        worker.start()
+    workers[0].join(timeout=1)
+    assert workers[0].is_alive()
+    db.session.commit()
+    for worker in workers:
+        worker.join()
+
+    assert {Event.get(i).status for i in event_ids} == {EventStatus.Done}
+    assert Identifier.query.filter_by(value='10.1234/new').count() == 1
+    assert Relationship.query.count() == 2
+
+
+def test_event_concurrent_opposite_order(db):
+    """Test concurrent events locking the same groups in opposite order."""
+    if not is_postgresql():
+        pytest.skip('Advisory locks require PostgreSQL.')
+    create_objects_from_relations([
+        ('A', Relation.IsIdenticalTo, 'B'),
+        ('C', Relation.IsIdenticalTo, 'D'),
+    ])
+    events = []
+    for src, trg in (('A', 'C'), ('D', 'B')):
+        event = Event(
+            payload=generate_payload([src, 'Cites', trg]),
+            parsed=[[src, 'doi', 'Cites', trg, 'doi']],
+            status=EventStatus.New)
+        db.session.add(event)
+        events.append(event)
+    db.session.commit()
+    event_ids = [str(e.id) for e in events]
+
+    # The groups of both events are held here, so that both workers lock
+    # their identifiers, are refused the groups, and wait for them
+    lock_identifier_groups([Identifier.get(v, 'doi').id for v in 'AD'])
+    app = current_app._get_current_object()
+
+    def _process(event_id):
+        with app.app_context():
+            process_event.apply(
+                kwargs=dict(event_uuid=event_id, indexing_enabled=False),
+                throw=True)
+            db.session.remove()
+
+    workers = [threading.Thread(target=_process, args=(event_id, ))
+               for event_id in event_ids]
+    for worker in workers:
+        worker.start()
+    workers[0].join(timeout=1)
+    assert all(worker.is_alive() for worker in workers)
+    db.session.commit()
+    for worker in workers:
+        worker.join()
+
+    assert {Event.get(i).status for i in event_ids} == {EventStatus.Done}
+    assert Relationship.query.filter_by(relation=Relation.Cites).count() == 2
+    assert get_group_from_id('A').id == get_group_from_id('B').id
+
+
+def test_lock_retries(db, monkeypatch):
+    """Test running a transaction again when its locks are refused."""
+    monkeypatch.setitem(current_app.config, 'ASCLEPIAS_GRAPH_LOCK_ATTEMPTS', 2)
+    waited = []
+    monkeypatch.setattr(
+        'asclepias_broker.graph.locks.lock_keys', waited.append)
+    attempts = []
+
+    def _add_identifier(value):
+        db.session.add(Identifier(value=value, scheme='doi'))
+        db.session.flush()
+        attempts.append(value)
+        if len(attempts) == 1:
+            raise LockNotAvailable([1, 2])
+        db.session.commit()
+        return value
+
+    assert run_with_lock_retries(_add_identifier, 'A') == 'A'
+    assert attempts == ['A', 'A']
+    # The second attempt waited for the refused locks first
+    assert waited == [[], [1, 2]]
+    assert Identifier.query.count() == 1
+
+    attempts.clear()
+    monkeypatch.setitem(current_app.config, 'ASCLEPIAS_GRAPH_LOCK_ATTEMPTS', 1)
+    with pytest.raises(LockNotAvailable):
+        run_with_lock_retries(_add_identifier, 'B')
+    assert Identifier.query.count() == 1
@@ -6,16 +6,35 @@
 # under the terms of the MIT License; see LICENSE file for more details.
 
 """Test broker model."""
+import io
+import json
+import os
+import uuid
+
+import pytest
+import sqlalchemy as sa
 from helpers import assert_grouping, create_objects_from_relations, \
-    generate_payload
+    create_relationships, generate_payload
 
 from asclepias_broker.core.models import Identifier, Relation, Relationship
 from asclepias_broker.events.api import EventAPI
-from asclepias_broker.graph.api import get_group_from_id, \
-    get_or_create_groups, merge_identity_groups, merge_version_groups
-from asclepias_broker.graph.models import Group, GroupM2M, GroupType, \
-    Identifier2Group
+from asclepias_broker.events.models import Event, EventStatus
+from asclepias_broker.graph.api import delete_relationship, \
+    get_group_from_id, get_or_create_groups, merge_identity_groups, \
+    merge_version_groups, update_groups, update_groups_many
+from asclepias_broker.graph.builder import build_graph
+from asclepias_broker.graph.cache import group_cache
+from asclepias_broker.graph.check import CHECKS, check_graph
+from asclepias_broker.graph.export import export_graph
+from asclepias_broker.graph.indexes import EXPLAINED_QUERIES, \
+    SUPERSEDED_INDEXES, create_columns, create_indexes, explain_queries
+from asclepias_broker.graph.locks import acquire_locks, lock_key
+from asclepias_broker.graph.models import Group, GroupM2M, GroupRelationship, \
+    GroupType, Identifier2Group, Relationship2GroupRelationship
 from asclepias_broker.metadata.api import update_metadata
+from asclepias_broker.metadata.models import GroupMetadata
+from asclepias_broker.search.indexer import build_group_metadata
+from asclepias_broker.utils import is_postgresql
 
 
 def _handle_events(events, no_index=False):
@@ -675,3 +694,635 @@ def test_merge_identity_groups(db):
     assert id_grp1 == id_grp2 == id_grp3 == id_grp4 and \
         id_grp1.json['Title'] == 'Title of D v2'
     assert_grouping(grouping)
+
+
+def test_graph_builder(db):
+    """Test that the offline builder is equivalent to the incremental path."""
+    rels = [
+        ('A', Relation.Cites, 'C'),
+        ('B', Relation.Cites, 'D'),
+        ('E', Relation.Cites, 'A'),
+        ('A', Relation.IsIdenticalTo, 'B'),
+        ('C', Relation.HasVersion, 'D'),
+    ]
+    relationships = create_relationships(rels)
+    db.session.commit()
+
+    grouping = (
+        [
+            # Identity groups
+            ['A', 'B'],
+            ['C'],
+            ['D'],
+            ['E'],
+            # Version groups
+            [0],
+            [1],  # {C, D}
+            [3],
+        ],
+        [
+            # Identifier relationships
+            ('A', Relation.Cites, 'C'),
+            ('B', Relation.Cites, 'D'),
+            ('E', Relation.Cites, 'A'),
+            ('A', Relation.IsIdenticalTo, 'B'),
+            ('C', Relation.HasVersion, 'D'),
+            # Identity group relationships
+            (0, Relation.Cites, 1),
+            (0, Relation.Cites, 2),
+            (3, Relation.Cites, 0),
+            # Version group relationships
+            (4, Relation.Cites, 5),
+            (6, Relation.Cites, 4),
+        ],
+        [
+            (5, [0]),
+            (6, [1]),
+            (7, [2]),
+            (8, [5, 6]),
+            (9, [7]),
+        ]
+    )
+
+    for relationship in relationships:
+        update_groups(relationship)
+    db.session.commit()
+    assert_grouping(grouping)
+
+    # The builder replaces the groups of the incremental path
+    counts = build_graph()
+    assert counts['group'] == 7
+    assert_grouping(grouping)
+
+    # Building again from scratch gives the same groups
+    build_graph(batch_size=2)
+    assert_grouping(grouping)
+
+
+def test_graph_builder_merged_relationships(db):
+    """Test the builder on relationships within merged groups."""
+    rels = [
+        ('E', Relation.Cites, 'F'),
+        ('E', Relation.IsIdenticalTo, 'F'),
+        ('A', Relation.IsIdenticalTo, 'B'),
+        ('A', Relation.Cites, 'B'),
+        ('C', Relation.HasVersion, 'D'),
+        ('C', Relation.Cites, 'D'),
+    ]
+    relationships = create_relationships(rels)
+    db.session.commit()
+
+    # No group relationships from the merged groups to themselves, whether
+    # the relationships are processed before or after the merges
+    grouping = (
+        [
+            # Identity groups
+            ['A', 'B'],
+            ['C'],
+            ['D'],
+            ['E', 'F'],
+            # Version groups
+            [0],
+            [1],  # {C, D}
+            [3],
+        ],
+        [
+            # Identifier relationships
+            ('E', Relation.Cites, 'F'),
+            ('E', Relation.IsIdenticalTo, 'F'),
+            ('A', Relation.IsIdenticalTo, 'B'),
+            ('A', Relation.Cites, 'B'),
+            ('C', Relation.HasVersion, 'D'),
+            ('C', Relation.Cites, 'D'),
+            # Identity group relationships
+            (1, Relation.Cites, 2),
+        ],
+        [
+            (6, [5]),
+        ]
+    )
+
+    for relationship in relationships:
+        update_groups(relationship)
+    db.session.commit()
+    assert_grouping(grouping)
+
+    build_graph()
+    assert_grouping(grouping)
+
+
+def test_group_cache(db):
+    """Test the cache of the groups of identifiers."""
+    a = Identifier(value='A', scheme='doi')
+    b = Identifier(value='B', scheme='doi')
+    db.session.add_all([a, b])
+    db.session.commit()
+    group_cache.clear()
+
+    # Groups created in a rolled back savepoint are not cached
+    db.session.begin_nested()
+    get_or_create_groups(a)
+    db.session.rollback()
+    db.session.commit()
+    assert group_cache.get(a.id) is None
+
+    id_a, ver_a = get_or_create_groups(a)
+    id_b, ver_b = get_or_create_groups(b)
+    db.session.commit()
+    hits = group_cache.stats()['hits']
+    assert get_or_create_groups(a) == (id_a, ver_a)
+    assert get_group_from_id('B', group_type=GroupType.Version) == ver_b
+    assert group_cache.stats()['hits'] == hits + 2
+
+    # Merging the groups invalidates their entries
+    merged_id, merged_ver = merge_identity_groups(id_a, id_b)
+    assert group_cache.get(a.id) is None
+    assert group_cache.get(b.id) is None
+    db.session.commit()
+    assert get_or_create_groups(a) == (merged_id, merged_ver)
+    assert get_or_create_groups(b) == (merged_id, merged_ver)
+    db.session.commit()
+    assert group_cache.get(a.id) == (merged_id.id, merged_ver.id)
+
+
+def test_group_cache_trusted(db):
+    """Test that cached groups are used without querying them."""
+    rels = [('A', Relation.Cites, 'B')]
+    rel_id = create_relationships(rels)[0].id
+    group_cache.clear()
+    a = Identifier.get('A', 'doi')
+    id_a, ver_a = get_or_create_groups(a)
+    id_a_id, ver_a_id = id_a.id, ver_a.id
+    db.session.commit()
+    a.id
+    db.session.expunge_all()
+
+    statements = []
+
+    def _count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = db.session.get_bind()
+    sa.event.listen(engine, 'before_cursor_execute', _count)
+    try:
+        id_a, ver_a = get_or_create_groups(a)
+    finally:
+        sa.event.remove(engine, 'before_cursor_execute', _count)
+    assert statements == []
+    assert (id_a.id, ver_a.id) == (id_a_id, ver_a_id)
+    assert id_a.type == GroupType.Identity
+    db.session.rollback()
+
+    # Stale entries (e.g. of groups merged by another worker) are resolved
+    # again when updating the groups
+    group_cache.set(a.id, (uuid.uuid4(), uuid.uuid4()))
+    db.session.commit()
+    update_groups(Relationship.query.get(rel_id))
+    db.session.commit()
+    assert group_cache.get(a.id) == (id_a_id, ver_a_id)
+
+    # ...and dropped if a transaction failed with them
+    group_cache.set(a.id, (uuid.uuid4(), uuid.uuid4()))
+    db.session.commit()
+    get_or_create_groups(a)
+    db.session.rollback()
+    group_cache.discard_used()
+    assert group_cache.get(a.id) is None
+
+
+def test_grouping_locks(db):
+    """Test the advisory lock keys of the grouping."""
+    a = Identifier(value='A', scheme='doi')
+    db.session.add(a)
+    db.session.commit()
+    key = lock_key(a.id)
+    assert key == lock_key(str(a.id))
+    assert -2 ** 63 <= key < 2 ** 63
+    # Locking is a no-op on SQLite
+    assert acquire_locks([a.id]) is False
+    id_group, ver_group = get_or_create_groups(a)
+    assert get_or_create_groups(a) == (id_group, ver_group)
+
+
+def test_version_group_root(db):
+    """Test the root Identity groups of the Version groups."""
+    rels = [
+        ('B', Relation.HasVersion, 'C'),
+        ('A', Relation.HasVersion, 'B'),
+        ('C', Relation.Cites, 'D'),
+        ('A', Relation.IsIdenticalTo, 'E'),
+    ]
+    relationships = create_relationships(rels)
+
+    def _root(value):
+        return get_group_from_id(value, group_type=GroupType.Version).root
+
+    update_groups(relationships[0])
+    db.session.commit()
+    assert _root('C') == get_group_from_id('B')
+    update_groups(relationships[1])
+    update_groups(relationships[2])
+    db.session.commit()
+    assert _root('B') == _root('C') == get_group_from_id('A')
+    assert _root('D') == get_group_from_id('D')
+    # The root follows the merges of its Identity group
+    update_groups(relationships[3])
+    db.session.commit()
+    assert _root('C') == get_group_from_id('A') == get_group_from_id('E')
+
+    build_graph()
+    assert _root('C') == get_group_from_id('A')
+    assert _root('D') == get_group_from_id('D')
+
+
+@pytest.mark.parametrize('rels', [
+    [('A', Relation.HasVersion, 'B'),
+     ('C', Relation.HasVersion, 'D'),
+     ('B', Relation.IsIdenticalTo, 'C')],
+    [('C', Relation.HasVersion, 'D'),
+     ('A', Relation.HasVersion, 'B'),
+     ('C', Relation.IsIdenticalTo, 'B')],
+])
+def test_version_group_root_merge_order(db, rels):
+    """Test the root of merged Version groups, in any merge order."""
+    for relationship in create_relationships(rels):
+        update_groups(relationship)
+    db.session.commit()
+
+    def _metadata():
+        group = get_group_from_id('D', group_type=GroupType.Version)
+        doc = build_group_metadata(group)
+        return (group.root, [i['ID'] for i in doc['Identifier']],
+                sorted(i['ID'] for i in doc['SearchIdentifier']))
+
+    assert _metadata() == \
+        (get_group_from_id('A'), ['A'], ['A', 'B', 'C', 'D'])
+    build_graph()
+    assert _metadata() == \
+        (get_group_from_id('A'), ['A'], ['A', 'B', 'C', 'D'])
+
+
+def test_update_groups_many(db):
+    """Test updating the groups of many relationships in bulk."""
+    rels = [
+        ('C', Relation.Cites, 'A'),
+        ('C', Relation.Cites, 'B'),
+        ('A', Relation.Cites, 'D'),
+        ('B', Relation.Cites, 'D'),
+        ('A', Relation.IsIdenticalTo, 'B'),
+        ('E', Relation.Cites, 'A'),
+        ('E', Relation.Cites, 'B'),
+    ]
+    relationships = create_relationships(rels)
+
+    results = update_groups_many(relationships)
+    db.session.commit()
+    assert len(results) == len(rels)
+    (_, _, merged_id_group), (_, _, merged_ver_group) = results[4]
+    assert merged_id_group == get_group_from_id('A')
+    assert merged_ver_group == \
+        get_group_from_id('B', group_type=GroupType.Version)
+
+    grouping = (
+        [
+            # Identity groups
+            ['A', 'B'],
+            ['C'],
+            ['D'],
+            ['E'],
+            # Version groups
+            [0],
+            [1],
+            [2],
+            [3],
+        ],
+        [
+            # Identifier relationships
+            ('C', Relation.Cites, 'A'),
+            ('C', Relation.Cites, 'B'),
+            ('A', Relation.Cites, 'D'),
+            ('B', Relation.Cites, 'D'),
+            ('A', Relation.IsIdenticalTo, 'B'),
+            ('E', Relation.Cites, 'A'),
+            ('E', Relation.Cites, 'B'),
+            # Identity group relationships
+            (1, Relation.Cites, 0),
+            (0, Relation.Cites, 2),
+            (3, Relation.Cites, 0),
+            # Version group relationships
+            (5, Relation.Cites, 4),
+            (4, Relation.Cites, 6),
+            (7, Relation.Cites, 4),
+        ],
+        [
+            (7, [0, 1]),
+            (8, [2, 3]),
+            (9, [5, 6]),
+            (10, [7]),
+            (11, [8]),
+            (12, [9]),
+        ]
+    )
+    assert_grouping(grouping)
+
+
+def test_delete_relationship(db):
+    """Test deleting relationships, which splits the groups they merged."""
+    rels = [
+        ('A', Relation.Cites, 'C'),
+        ('B', Relation.Cites, 'D'),
+        ('E', Relation.Cites, 'A'),
+        ('A', Relation.IsIdenticalTo, 'B'),
+        ('C', Relation.HasVersion, 'D'),
+        ('B', Relation.IsIdenticalTo, 'F'),
+    ]
+    relationships = create_relationships(rels)
+    update_groups_many(relationships)
+    db.session.commit()
+    abf_group = get_group_from_id('A')
+    assert get_group_from_id('F') == abf_group
+
+    # The parts of the split group get new groups
+    abf_group_id = abf_group.id
+    abf_version_group_id = get_group_from_id(
+        'A', group_type=GroupType.Version).id
+    idx_ig, del_ig, idx_vg, del_vg, _ = \
+        delete_relationship(relationships[3])
+    db.session.commit()
+    assert get_group_from_id('A') != get_group_from_id('B')
+    assert get_group_from_id('B') == get_group_from_id('F')
+    assert abf_group_id not in {get_group_from_id(i).id for i in 'ABF'}
+    assert Group.query.get(abf_group_id) is None
+    assert len(idx_ig) == len(idx_vg) == 2
+    assert del_ig == {str(abf_group_id)}
+    assert del_vg == {str(abf_version_group_id)}
+
+    delete_relationship(relationships[5])
+    delete_relationship(relationships[4])
+    db.session.commit()
+    assert get_group_from_id('C', group_type=GroupType.Version).root == \
+        get_group_from_id('C')
+    assert get_group_from_id('D', group_type=GroupType.Version).root == \
+        get_group_from_id('D')
+
+    grouping = (
+        [
+            # Identity groups
+            ['A'],
+            ['B'],
+            ['C'],
+            ['D'],
+            ['E'],
+            ['F'],
+            # Version groups
+            [0],
+            [1],
+            [2],
+            [3],
+            [4],
+            [5],
+        ],
+        [
+            # Identifier relationships
+            ('A', Relation.Cites, 'C'),
+            ('B', Relation.Cites, 'D'),
+            ('E', Relation.Cites, 'A'),
+            # Identity group relationships
+            (0, Relation.Cites, 2),
+            (1, Relation.Cites, 3),
+            (4, Relation.Cites, 0),
+            # Version group relationships
+            (6, Relation.Cites, 8),
+            (7, Relation.Cites, 9),
+            (10, Relation.Cites, 6),
+        ],
+        [
+            (3, [0]),
+            (4, [1]),
+            (5, [2]),
+            (6, [3]),
+            (7, [4]),
+            (8, [5]),
+        ]
+    )
+    assert_grouping(grouping)
+
+    # Group relationships left without relationships are deleted
+    delete_relationship(relationships[2])
+    db.session.commit()
+    assert_grouping((
+        grouping[0],
+        [
+            ('A', Relation.Cites, 'C'),
+            ('B', Relation.Cites, 'D'),
+            (0, Relation.Cites, 2),
+            (1, Relation.Cites, 3),
+            (6, Relation.Cites, 8),
+            (7, Relation.Cites, 9),
+        ],
+        [
+            (2, [0]),
+            (3, [1]),
+            (4, [2]),
+            (5, [3]),
+        ]
+    ))
+
+
+def test_graph_check(db, monkeypatch):
+    """Test the consistency checks of the groups."""
+    rels = [
+        ('A', Relation.Cites, 'C'),
+        ('B', Relation.Cites, 'C'),
+        ('A', Relation.IsIdenticalTo, 'B'),
+    ]
+    relationships = create_relationships(rels)
+    update_groups_many(relationships)
+    db.session.commit()
+    grouping = (
+        [['A', 'B'], ['C'], [0], [1]],
+        [
+            ('A', Relation.Cites, 'C'),
+            ('B', Relation.Cites, 'C'),
+            ('A', Relation.IsIdenticalTo, 'B'),
+            (0, Relation.Cites, 1),
+            (2, Relation.Cites, 3),
+        ],
+        [(3, [0, 1]), (4, [3])],
+    )
+    assert_grouping(grouping)
+
+    output = io.StringIO()
+    summary = check_graph(output)
+    assert not any(s['violations'] for s in summary.values())
+    assert len(output.getvalue().splitlines()) == len(summary)
+
+    # Break some invariants
+    GroupMetadata.query.filter_by(
+        group_id=get_group_from_id('C').id).delete()
+    Relationship2GroupRelationship.query.delete()
+    db.session.add(Group(type=GroupType.Identity, id=uuid.uuid4()))
+    db.session.commit()
+
+    output = io.StringIO()
+    summary = check_graph(output, batch_size=1)
+    report = [json.loads(line) for line in output.getvalue().splitlines()]
+    violations = {r['check'] for r in report if 'violation' in r}
+    assert violations == {
+        'empty_identity_group',
+        'identity_group_without_version_group',
+        'identity_group_without_metadata',
+        'identity_group_relationship_without_relationships',
+        'relationship_without_group_relationship',
+    }
+    assert summary['relationship_without_group_relationship'] == \
+        dict(violations=2, repaired=0, remaining=2)
+
+    # Violations are checked again after repairing them
+    check = next(c for c in CHECKS if c.name == 'empty_identity_group')
+    monkeypatch.setattr(check, 'repair', lambda rows: None)
+    summary = check_graph(io.StringIO(), checks=[check.name], repair=True)
+    assert summary[check.name] == dict(violations=1, repaired=0, remaining=1)
+    monkeypatch.undo()
+
+    summary = check_graph(io.StringIO(), repair=True, batch_size=1)
+    assert summary['relationship_without_group_relationship'] == \
+        dict(violations=2, repaired=2, remaining=0)
+    summary = check_graph(io.StringIO())
+    assert not any(s['violations'] for s in summary.values())
+    assert_grouping(grouping)
+
+
+def test_graph_export(db, tmpdir):
+    """Test the CSR export of the group graphs."""
+    numpy = pytest.importorskip('numpy')
+    rels = [
+        ('A', Relation.Cites, 'C'),
+        ('B', Relation.Cites, 'D'),
+        ('E', Relation.Cites, 'A'),
+        ('A', Relation.IsSupplementTo, 'D'),
+        ('C', Relation.HasVersion, 'D'),
+    ]
+    relationships = create_relationships(rels)
+    update_groups_many(relationships)
+    db.session.commit()
+
+    output_dir = str(tmpdir)
+    manifest = export_graph(output_dir, batch_size=2)
+    assert manifest['graphs']['identity'] == dict(nodes=5, edges=4)
+    assert manifest['graphs']['version'] == dict(nodes=4, edges=4)
+
+    for group_type in GroupType:
+        name = group_type.name.lower()
+
+        def _load(array):
+            return numpy.load(os.path.join(output_dir, f'{name}_{array}.npy'),
+                              mmap_mode='r')
+        nodes, indptr = _load('nodes'), _load('indptr')
+        indices, relations = _load('indices'), _load('relations')
+        assert indices.dtype == numpy.int32
+        edges = {
+            (nodes[i].decode(), nodes[indices[j]].decode(),
+             Relation(relations[j]))
+            for i in range(len(nodes))
+            for j in range(indptr[i], indptr[i + 1])}
+        assert edges == {
+            (str(r.source_id), str(r.target_id), r.relation)
+            for r in GroupRelationship.query.filter_by(type=group_type)}
+
+
+@pytest.mark.parametrize('statements,created', [
+    # Processed payload hashes
+    (['DROP TABLE payloadhash',
+      'ALTER TABLE event DROP COLUMN skipped_payloads'],
+     dict(tables=['payloadhash'], columns=['event.skipped_payloads'],
+          indexes=[])),
+    # Parsed links of the events
+    (['ALTER TABLE event DROP COLUMN parsed'],
+     dict(tables=[], columns=['event.parsed'], indexes=[])),
+    # Origins of the events
+    (['ALTER TABLE event DROP COLUMN origin'],
+     dict(tables=[], columns=['event.origin'], indexes=[])),
+    # Groups marked for the debounced indexing
+    (['DROP TABLE dirtygroup'],
+     dict(tables=['dirtygroup'], columns=[], indexes=[])),
+    # Archived event payloads
+    (['DROP TABLE eventpayloadarchive'],
+     dict(tables=['eventpayloadarchive'], columns=[], indexes=[])),
+    # Lock waits of the events
+    (['ALTER TABLE event DROP COLUMN lock_wait'],
+     dict(tables=[], columns=['event.lock_wait'], indexes=[])),
+])
+def test_upgrade_columns(db, statements, created):
+    """Test creating the tables and columns missing from older databases."""
+    for statement in statements:
+        db.engine.execute(statement)
+    assert create_columns() == created
+    assert create_columns() == dict(tables=[], columns=[], indexes=[])
+
+
+def test_upgrade_group_root(db):
+    """Test creating the roots of the Version groups of older databases."""
+    if not is_postgresql():
+        pytest.skip('SQLite cannot drop foreign key columns.')
+    db.engine.execute('ALTER TABLE "group" DROP COLUMN root_id')
+    assert create_columns() == dict(
+        tables=[], columns=['group.root_id'], indexes=['ix_group_root'])
+    update_groups(create_relationships([('A', Relation.HasVersion, 'B')])[0])
+    db.session.commit()
+    assert get_group_from_id('B', group_type=GroupType.Version).root == \
+        get_group_from_id('A')
+
+
+def test_graph_indexes(db, monkeypatch):
+    """Test creating the missing indexes and explaining the hot queries."""
+    assert create_indexes() == dict(
+        tables=[], columns=[], created=[], dropped=[])
+
+    # A database from before the composite indexes
+    db.engine.execute('DROP INDEX ix_relationship_target_relation')
+    db.engine.execute('DROP INDEX ix_grouprelationship_version_target')
+    db.engine.execute('CREATE INDEX ix_relationship_target '
+                      'ON relationship (target_id)')
+    db.engine.execute('CREATE INDEX ix_grouprelationship_target '
+                      'ON grouprelationship (target_id)')
+    db.engine.execute('DROP INDEX ix_grouprelationship_target_relation_type')
+    # The superseded indexes are kept by default
+    assert create_indexes() == dict(
+        tables=[], columns=[],
+        created=['ix_relationship_target_relation',
+                 'ix_grouprelationship_target_relation_type',
+                 'ix_grouprelationship_version_target'],
+        dropped=[])
+    # They are only dropped when their replacement exists
+    monkeypatch.setitem(
+        SUPERSEDED_INDEXES['grouprelationship'],
+        'ix_grouprelationship_target', 'ix_missing')
+    assert create_indexes(drop_superseded=True) == dict(
+        tables=[], columns=[], created=[],
+        dropped=['ix_relationship_target'])
+    monkeypatch.undo()
+    assert create_indexes(drop_superseded=True) == dict(
+        tables=[], columns=[], created=[],
+        dropped=['ix_grouprelationship_target'])
+
+    # A database from before the new tables and columns
+    db.engine.execute('DROP TABLE dirtygroup')
+    db.engine.execute('ALTER TABLE event DROP COLUMN lock_wait')
+    db.engine.execute('DROP INDEX ix_payloadhash_relationship_id')
+    db.engine.execute('ALTER TABLE payloadhash DROP COLUMN relationship_id')
+    assert create_indexes() == dict(
+        tables=['dirtygroup'],
+        columns=['event.lock_wait', 'payloadhash.relationship_id'],
+        created=['ix_payloadhash_relationship_id'],
+        dropped=[])
+    assert create_columns() == dict(tables=[], columns=[], indexes=[])
+    db.session.add(Event(payload=[], status=EventStatus.Done, lock_wait=1.5))
+    db.session.commit()
+    assert Event.query.one().lock_wait == 1.5
+
+    plans = explain_queries()
+    assert set(plans) == set(EXPLAINED_QUERIES)
+    assert all(plans.values())
+    assert 'ix_relationship_target_relation' in '\n'.join(
+        plans['citations'])
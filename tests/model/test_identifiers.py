@@ -6,11 +6,17 @@
 # under the terms of the MIT License; see LICENSE file for more details.
 
 """Test broker model."""
+import io
+import uuid
+
 import pytest
-from helpers import generate_payload
+from helpers import create_relationships, generate_payload
 
-from asclepias_broker.core.models import Identifier
+from asclepias_broker.core.models import Identifier, Relation, Relationship
 from asclepias_broker.events.api import EventAPI
+from asclepias_broker.events.models import Event, EventStatus, PayloadHash
+from asclepias_broker.graph.api import dedup_identifiers, update_groups
+from asclepias_broker.graph.check import check_graph
 
 
 @pytest.mark.parametrize(
@@ -85,3 +91,94 @@ def test_identities(events, result_sets, db, es):
             id_ = Identifier.query.filter_by(value=v).one()
             ids = set(i.value for i in id_.get_identities())
             assert ids == rs
+
+
+def test_identities_closure(db):
+    """Test the closure of identities, with cycles and other relations."""
+    rels = [
+        ('A', Relation.IsIdenticalTo, 'B'),
+        ('C', Relation.IsIdenticalTo, 'B'),
+        ('C', Relation.IsIdenticalTo, 'A'),
+        ('D', Relation.IsIdenticalTo, 'C'),
+        ('D', Relation.Cites, 'E'),
+        ('E', Relation.HasVersion, 'F'),
+    ]
+    create_relationships(rels)
+    db.session.commit()
+
+    for value in 'ABCD':
+        ids = Identifier.get(value, 'doi').get_identities()
+        assert sorted(i.value for i in ids) == ['A', 'B', 'C', 'D']
+    for value in 'EF':
+        id_ = Identifier.get(value, 'doi')
+        assert id_.get_identities() == [id_]
+
+
+def test_identifier_hash(db):
+    """Test looking up identifiers by the hash of their normalized value."""
+    doi = Identifier(value='10.1234/ABC', scheme='doi')
+    ads = Identifier(value='2018ApJ...1A', scheme='ads')
+    db.session.add_all([doi, ads])
+    db.session.commit()
+    assert doi.value_hash == Identifier.compute_hash('10.1234/ABC', 'doi')
+
+    assert Identifier.get('10.1234/abc', 'doi') == doi
+    assert Identifier.get('https://doi.org/10.1234/Abc', 'DOI') == doi
+    assert Identifier.get('10.1234/abc', 'url') is None
+    assert Identifier.get('2018ApJ...1A', 'ads') == ads
+    # ADS bibcodes are case-sensitive
+    assert Identifier.get('2018apj...1a', 'ads') is None
+    assert Identifier(value='10.1234/abc', scheme='doi') \
+        .fetch_or_create_id() == doi
+    # Values that do not match their scheme are hashed as they are
+    assert Identifier.compute_hash('Not-A-DOI', 'doi') == \
+        Identifier.compute_hash('not-a-doi', 'doi')
+
+
+def test_dedup_identifiers(db):
+    """Test backfilling the identifier hashes and merging duplicates."""
+    ids = {v: uuid.uuid4() for v in ('A', 'a', 'X', 'Y')}
+    # Identifiers from before the hashes
+    db.session.execute(Identifier.__table__.insert(), [
+        dict(id=id_, value=f'10.1234/{v}', scheme='doi', value_hash=None)
+        for v, id_ in ids.items()])
+    rels = [
+        ('A', Relation.Cites, 'X'),
+        ('a', Relation.Cites, 'X'),
+        ('a', Relation.Cites, 'Y'),
+        ('X', Relation.IsIdenticalTo, 'a'),
+        ('A', Relation.IsIdenticalTo, 'a'),
+    ]
+    event = Event(payload=[], status=EventStatus.Done)
+    db.session.add(event)
+    for idx, (src, relation, tar) in enumerate(rels):
+        rel = Relationship(source_id=ids[src], target_id=ids[tar],
+                           relation=relation, id=uuid.uuid4())
+        db.session.add(rel)
+        db.session.flush()
+        update_groups(rel)
+        db.session.add(PayloadHash(
+            hash=f'{idx:064}', event_id=event.id, payload_index=idx,
+            relationship_id=rel.id))
+    db.session.commit()
+    assert Identifier.get('10.1234/a', 'doi').id == ids['a']
+
+    assert dedup_identifiers(batch_size=2) == dict(backfilled=3, merged=1)
+    assert Identifier.query.filter(Identifier.value_hash.is_(None)) \
+        .count() == 0
+    canonical = Identifier.get('10.1234/a', 'doi')
+    assert canonical == Identifier.get('10.1234/A', 'doi')
+    assert Identifier.query.count() == 3
+    assert {(r.source.value, r.relation, r.target.value)
+            for r in Relationship.query} == {
+        (canonical.value, Relation.Cites, '10.1234/X'),
+        (canonical.value, Relation.Cites, '10.1234/Y'),
+        ('10.1234/X', Relation.IsIdenticalTo, canonical.value),
+    }
+    # The payload hashes of the deleted relationships are deleted
+    assert {h.relationship_id for h in PayloadHash.query} == \
+        {r.id for r in Relationship.query}
+    assert sorted(i.value for i in canonical.identity_group.identifiers) \
+        == sorted([canonical.value, '10.1234/X'])
+    summary = check_graph(io.StringIO())
+    assert all(s['violations'] == 0 for s in summary.values())
@@ -8,10 +8,12 @@
 """Test citation queries."""
 
 import pytest
-from helpers import generate_payload
+from helpers import create_relationships, generate_payload
+from sqlalchemy import event
 
-from asclepias_broker.core.models import Identifier
+from asclepias_broker.core.models import Identifier, Relation
 from asclepias_broker.events.api import EventAPI
+from asclepias_broker.graph.api import update_groups_many
 from asclepias_broker.search.api import RelationshipAPI
 
 TEST_CASES = [
@@ -160,3 +162,87 @@ def test_grouping_query(test_case_name, events, results, db, es):
         # cited_id = Identifier.query.filter_by(value=cited_id_value).one()
         # TODO: Fix this test
         # ret = RelationshipAPI.get_citations2(cited_id, 'IsCitedBy')
+
+
+def _create_relationships(db, rels):
+    update_groups_many(create_relationships(rels))
+    db.session.commit()
+
+
+def test_citations_queries(db):
+    """Test that citations are fetched with a fixed number of queries."""
+    _create_relationships(db, [
+        ('A', Relation.IsIdenticalTo, 'A2'),
+        ('P', Relation.HasVersion, 'A'),
+        ('P', Relation.HasVersion, 'S'),
+        ('X', Relation.Cites, 'A'),
+        ('X2', Relation.IsIdenticalTo, 'X'),
+        ('X2', Relation.Cites, 'A2'),
+        ('Y', Relation.Cites, 'S'),
+        ('Z', Relation.Cites, 'P'),
+    ])
+
+    def _get_citations():
+        queries = []
+
+        def _count(*args):
+            queries.append(args)
+        event.listen(db.engine, 'before_cursor_execute', _count)
+        try:
+            citations = RelationshipAPI.get_citations(
+                Identifier.get('A', 'doi'), with_parents=True,
+                with_siblings=True, expand_target=True)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', _count)
+        return citations, len(queries)
+
+    citations, n_queries = _get_citations()
+    *citations, (target_ids, target_rels) = citations
+    assert [([i.value for i in ids], {(r.source.value, r.target.value)
+                                      for r in rels})
+            for ids, rels in citations] == [
+        (['X', 'X2'], {('X', 'A'), ('X2', 'A2')}),
+        (['Y'], {('Y', 'S')}),
+        (['Z'], {('Z', 'P')}),
+    ]
+    assert {i.value for i in target_ids} == {'A', 'A2', 'P', 'S'}
+    assert {(r.source.value, r.relation, r.target.value)
+            for r in target_rels} == {
+        ('P', Relation.HasVersion, 'A'),
+        ('P', Relation.HasVersion, 'S'),
+        ('A', Relation.IsIdenticalTo, 'A2'),
+    }
+
+    _create_relationships(
+        db, [(f'C{i}', Relation.Cites, 'A') for i in range(20)])
+    citations, more_queries = _get_citations()
+    assert len(citations) == 3 + 20 + 1
+    assert more_queries == n_queries
+
+
+def test_citations_page(db):
+    """Test the keyset pagination of the citations."""
+    _create_relationships(db, [
+        ('A', Relation.IsIdenticalTo, 'A2'),
+        ('X', Relation.Cites, 'A'),
+        ('X2', Relation.IsIdenticalTo, 'X'),
+        ('X2', Relation.Cites, 'A2'),
+    ] + [(f'C{i}', Relation.Cites, 'A') for i in range(4)])
+    target = RelationshipAPI.get_target(Identifier.get('A', 'doi'))
+    assert {i.value for i in target[0]} == {'A', 'A2'}
+
+    pages, cursor = [], None
+    while True:
+        citations, cursor = RelationshipAPI.get_citations_page(
+            target, 2, after=cursor)
+        pages.append([sorted(i.value for i in ids) for ids, _ in citations])
+        if cursor is None:
+            break
+    assert [len(page) for page in pages] == [2, 2, 1]
+    assert sorted(c for page in pages for c in page) == sorted(
+        [['X', 'X2']] + [[f'C{i}'] for i in range(4)])
+    # Each page has the same citations as the full results
+    full = {tuple(i.value for i in ids): len(rels) for ids, rels in
+            RelationshipAPI.get_citations(Identifier.get('A', 'doi'))}
+    assert full[('X', 'X2')] == 2
+    assert len(full) == 5